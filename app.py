@@ -13,12 +13,14 @@ import click
 from pathlib import Path
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from sqlalchemy import inspect
+from sqlalchemy import event, inspect
 
 from config import Config
 from extensions import csrf, db, login_manager, migrate
 from models import User
+from services import generation_service, metrics, profiling, query_stats, tracing, user_cache
 from views.api import api_bp
+from views.metrics import metrics_bp
 from views.spa import spa_bp
 
 
@@ -37,20 +39,29 @@ def create_app(config_object: object | None = None) -> Flask:
     apply_proxy_fix(app)
     ensure_secret_key(app)
     ensure_database_url(app)
+    generation_service.configure_image_decoder(app)
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
+    # ユーザーキャッシュはプロセス内共有なので、アプリ生成時に前のアプリの内容を持ち越さない
+    user_cache.clear()
     csrf.init_app(app)
     login_manager.login_view = "spa.index"
     register_auth_handlers()
+    # ユーザー読み込みなど他の before_request のクエリも数えるため、最初に登録する
+    register_query_stats(app)
     register_user_status_handlers(app)
     register_security_handlers(app)
     register_request_logging(app)
+    register_metrics(app)
+    register_profiling(app)
+    tracing.configure(app)
     register_cli(app)
 
     register_blueprints(app)
     maybe_auto_migrate(app)
     maybe_auto_init_user(app)
+    maybe_resume_pending_uploads(app)
     return app
 
 
@@ -106,8 +117,8 @@ def ensure_database_url(app: Flask) -> None:
 def ensure_initial_user(app: Flask) -> None:
     """環境変数からイニシャルユーザーを作成する。"""
 
-    inspector = inspect(db.engine)
-    if "users" not in inspector.get_table_names():
+    # 全テーブルを列挙せず、users の有無だけを確認する
+    if not inspect(db.engine).has_table("users"):
         app.logger.info(
             "User table not found. Run 'flask --app app.py db upgrade' or 'flask --app app.py init-db'."
         )
@@ -125,6 +136,7 @@ def ensure_initial_user(app: Flask) -> None:
         if existing_user.role != "admin":
             existing_user.role = "admin"
             db.session.commit()
+            user_cache.invalidate(existing_user.id)
             app.logger.info("既存のイニシャルユーザーに管理者権限を付与しました。")
         return
 
@@ -162,10 +174,29 @@ def maybe_auto_init_user(app: Flask) -> None:
         ensure_initial_user(app)
 
 
+def maybe_resume_pending_uploads(app: Flask) -> None:
+    """後追いアップロード有効時、スプールに残った pending の生成画像を再投入する。"""
+
+    mode = (app.config.get("GENERATION_UPLOAD_MODE") or "sync").strip().lower()
+    if mode != "write_behind":
+        return
+
+    with app.app_context():
+        try:
+            resumed = generation_service.resume_pending_uploads()
+        except Exception as exc:  # noqa: BLE001
+            db.session.rollback()
+            app.logger.warning("pending アップロードの再投入に失敗しました: %s", exc)
+            return
+    if resumed:
+        app.logger.info("pending の生成画像 %d 件のアップロードを再投入しました。", resumed)
+
+
 def register_blueprints(app: Flask) -> None:
     """Blueprintをまとめて登録するヘルパー。"""
 
     app.register_blueprint(api_bp)
+    app.register_blueprint(metrics_bp)
     app.register_blueprint(spa_bp)
 
 
@@ -247,11 +278,103 @@ def register_request_logging(app: Flask) -> None:
             "user_id": user_id,
             "remote_addr": request.headers.get("X-Forwarded-For", request.remote_addr),
         }
+        stats = query_stats.current()
+        if stats is not None:
+            payload["db_queries"] = stats.count
+            payload["db_time_ms"] = stats.total_ms
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            payload["trace_id"] = trace_id
         app.logger.info(json.dumps(payload, ensure_ascii=False))
         response.headers["X-Request-Id"] = g.get("request_id", "")
         return response
 
 
+def register_metrics(app: Flask) -> None:
+    """ルート別レイテンシ・処理中リクエスト数とDBコミット時間をPrometheusメトリクスへ記録する。"""
+
+    @app.before_request
+    def track_request_in_flight():
+        if request.url_rule is not None and request.url_rule.rule == "/metrics":
+            return
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        g.request_in_flight = True
+
+    @app.teardown_request
+    def release_request_in_flight(exc):
+        if g.pop("request_in_flight", False):
+            metrics.REQUESTS_IN_FLIGHT.dec()
+
+    @app.after_request
+    def observe_request_latency(response):
+        start_time = g.get("request_start")
+        if not isinstance(start_time, (int, float)):
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        if route == "/metrics":
+            return response
+        metrics.REQUEST_LATENCY.labels(
+            method=request.method,
+            route=route,
+            status=str(response.status_code),
+        ).observe(time.perf_counter() - start_time)
+        return response
+
+    # db.session は全アプリ共通のため、リスナーは一度だけ登録する
+    if not event.contains(db.session, "before_commit", _start_commit_timer):
+        event.listen(db.session, "before_commit", _start_commit_timer)
+        event.listen(db.session, "after_commit", _observe_commit_timer)
+        event.listen(db.session, "after_rollback", _discard_commit_timer)
+
+
+def _start_commit_timer(session) -> None:
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _observe_commit_timer(session) -> None:
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        metrics.DB_COMMIT_LATENCY.observe(time.perf_counter() - started)
+
+
+def _discard_commit_timer(session) -> None:
+    session.info.pop("commit_started", None)
+
+
+def register_profiling(app: Flask) -> None:
+    """管理者の指定またはサンプリングで選んだリクエストをプロファイルし、request_id で保存する。"""
+
+    @app.before_request
+    def start_request_profile():
+        # request_id は register_request_logging の before_request で付与済み
+        profiling.start_request()
+
+    @app.after_request
+    def mark_request_profile(response):
+        return profiling.mark_response(response)
+
+    @app.teardown_request
+    def finish_request_profile(exc):
+        profiling.finish_request()
+
+
+def register_query_stats(app: Flask) -> None:
+    """リクエストごとの SQL 実行回数・合計時間を集計する（結果は register_request_logging のログへ）。"""
+
+    if not app.config.get("DB_QUERY_STATS_ENABLED", True):
+        return
+    with app.app_context():
+        query_stats.install(db.engine, slow_query_ms=app.config.get("DB_SLOW_QUERY_MS"))
+
+    @app.before_request
+    def start_query_stats():
+        query_stats.begin_request()
+
+    @app.teardown_request
+    def finish_query_stats(exc):
+        query_stats.end_request()
+
+
 def register_cli(app: Flask) -> None:
     """DB初期化用のCLIコマンドを登録する。"""
 
@@ -0,0 +1,271 @@
+"""gunicorn のサービングプロファイルごとに、1コンテナで同時に処理できる生成数を計測する負荷試験。
+
+使い方:
+    python benchmarks/concurrent_generations.py [--profile gthread] [--workers 1] [--threads 8]
+        [--requests 16] [--concurrency 8] [--model-latency 1.0] [--json]
+
+一時ディレクトリの SQLite とローカル保存でアプリを gunicorn 上に起動し、モデル呼び出しを
+--model-latency 秒スリープするだけの偽物に差し替えて、ログイン済みの複数クライアントから
+ラフ＋指示モードの生成を同時に投げる。sync では workers 件、gthread では workers × threads 件まで
+並行に処理できるはずで、「実効並列度」（リクエスト数 × モデル応答時間 ÷ 全体の経過時間）に表れる。
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.cookiejar
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+USERNAME = "bench"
+PASSWORD = "bench-password"
+
+
+def _png_bytes() -> bytes:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (200, 120, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def serving_app():
+    """gunicorn から `benchmarks.concurrent_generations:serving_app()` として読み込むアプリ。"""
+
+    from app import create_app
+    from illust import GeneratedImage
+    from services import generation_service
+    from services.stage_timer import stage
+
+    latency = float(os.environ.get("BENCH_MODEL_LATENCY", "1"))
+    png = _png_bytes()
+
+    def fake_generate_image(*args, timer=None, **kwargs):
+        with stage(timer, "model_call"):
+            time.sleep(latency)
+        return GeneratedImage(raw_bytes=png, mime_type="image/png", prompt="benchmark")
+
+    generation_service.generate_image = fake_generate_image
+    return create_app()
+
+
+def _prepare_database() -> None:
+    from app import create_app
+    from extensions import db
+    from models import User
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user = User(username=USERNAME, email=f"{USERNAME}@example.com")
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn が起動直後に終了しました。")
+        try:
+            with urllib.request.urlopen(f"{base_url}/api/health", timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn の起動待ちがタイムアウトしました。")
+
+
+class _Client:
+    """Cookie と CSRF トークンを保持する最小限の HTTP クライアント。"""
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self._opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self._csrf = ""
+
+    def _request(self, path: str, *, data: bytes | None = None, headers: dict[str, str] | None = None) -> dict:
+        request = urllib.request.Request(f"{self.base_url}{path}", data=data, headers=headers or {})
+        with self._opener.open(request, timeout=300) as response:
+            return json.loads(response.read())
+
+    def login(self) -> None:
+        self._csrf = self._request("/api/csrf")["csrf_token"]
+        self._request(
+            "/api/auth/login",
+            data=json.dumps({"username": USERNAME, "password": PASSWORD}).encode("utf-8"),
+            headers={"Content-Type": "application/json", "X-CSRFToken": self._csrf},
+        )
+        # ログインでセッションが切り替わるので取り直す
+        self._csrf = self._request("/api/csrf")["csrf_token"]
+
+    def generate(self, png: bytes) -> dict:
+        boundary = uuid4().hex
+        fields = {
+            "mode": "rough_with_instructions",
+            "color_instruction": "orange",
+            "pose_instruction": "standing",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+        }
+        body = BytesIO()
+        for name, value in fields.items():
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="rough_image"; filename="rough.png"\r\n'
+            "Content-Type: image/png\r\n\r\n".encode()
+        )
+        body.write(png)
+        body.write(f"\r\n--{boundary}--\r\n".encode())
+        return self._request(
+            "/api/generations",
+            data=body.getvalue(),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}", "X-CSRFToken": self._csrf},
+        )
+
+
+def _run_load(base_url: str, *, requests: int, concurrency: int, model_latency: float) -> dict[str, object]:
+    png = _png_bytes()
+    clients = [_Client(base_url) for _ in range(concurrency)]
+    for client in clients:
+        client.login()
+
+    def one(index: int) -> tuple[float, bool]:
+        started = time.perf_counter()
+        try:
+            payload = clients[index % concurrency].generate(png)
+            ok = payload.get("generation", {}).get("status") == "succeeded"
+        except (urllib.error.URLError, ConnectionError, ValueError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    return {
+        "requests": requests,
+        "succeeded": sum(1 for _, ok in outcomes if ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3),
+        "latency_p50_s": round(statistics.median(latencies), 3),
+        "latency_max_s": round(latencies[-1], 3),
+        # サーバー側で同時に進んでいたモデル呼び出しの平均本数
+        "effective_concurrency": round(requests * model_latency / elapsed, 2),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", choices=["sync", "gthread"], default="gthread", help="GUNICORN_PROFILE")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn のワーカー数")
+    parser.add_argument("--threads", type=int, default=8, help="gthread のワーカーあたりスレッド数")
+    parser.add_argument("--requests", type=int, default=16, help="送信する生成リクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に投げるクライアント数")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="偽モデルの応答時間（秒）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    parser.add_argument("--verbose", action="store_true", help="gunicorn・アプリのログを表示する")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bench-serving-") as workdir:
+        port = _free_port()
+        env = {
+            **os.environ,
+            "APP_ENV": "development",
+            "SECRET_KEY": "benchmark-secret",
+            "DATABASE_URL": f"sqlite:///{Path(workdir) / 'bench.db'}",
+            "CHAT_IMAGE_STORAGE": "local",
+            "GENERATION_IMAGE_STORAGE": "local",
+            "GENERATION_IMAGE_DIR": str(Path(workdir) / "generated_images"),
+            "GENERATION_IMAGE_CODEC": "original",
+            "METRICS_ENABLED": "false",
+            "GUNICORN_PROFILE": args.profile,
+            "GUNICORN_THREADS": str(args.threads),
+            "BENCH_MODEL_LATENCY": str(args.model_latency),
+        }
+        # マルチプロセス集計用のファイルを作業ディレクトリへ書かせない
+        env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        os.environ.update(env)
+        os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        _prepare_database()
+
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "--config",
+                str(ROOT / "gunicorn.conf.py"),
+                "--bind",
+                f"127.0.0.1:{port}",
+                "--workers",
+                str(args.workers),
+                "--log-level",
+                "warning",
+                "benchmarks.concurrent_generations:serving_app()",
+            ],
+            cwd=ROOT,
+            env=env,
+            stderr=None if args.verbose else subprocess.DEVNULL,
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            _wait_until_ready(base_url, process)
+            result = _run_load(
+                base_url,
+                requests=args.requests,
+                concurrency=args.concurrency,
+                model_latency=args.model_latency,
+            )
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    capacity = args.workers * (args.threads if args.profile == "gthread" else 1)
+    result = {
+        "profile": args.profile,
+        "workers": args.workers,
+        "threads": args.threads if args.profile == "gthread" else 1,
+        "capacity": capacity,
+        "model_latency_s": args.model_latency,
+        **result,
+    }
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(
+            f"{result['profile']} workers={result['workers']} threads={result['threads']}"
+            f" (capacity {result['capacity']}), model latency {result['model_latency_s']}s"
+        )
+        print(
+            f"  {result['succeeded']}/{result['requests']} succeeded in {result['elapsed_s']}s"
+            f"  throughput {result['throughput_rps']} req/s  p50 {result['latency_p50_s']}s"
+            f"  max {result['latency_max_s']}s  effective concurrency {result['effective_concurrency']}"
+        )
+    return 0 if result["succeeded"] == result["requests"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
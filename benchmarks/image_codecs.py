@@ -0,0 +1,99 @@
+"""生成画像の保存コーデックごとのサイズとエンコード時間を比較するベンチマーク。
+
+使い方:
+    python benchmarks/image_codecs.py path/to/generated.png [...] [--quality 90] [--repeat 3] [--json]
+
+画像を指定しない場合は、グラデーションとノイズを含む 2048x2048 の合成 PNG を使う。
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services import image_codec  # noqa: E402
+
+
+def _synthetic_png(size: int = 2048) -> bytes:
+    image = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(0)
+    for _ in range(400):
+        x, y = rng.randrange(size), rng.randrange(size)
+        radius = rng.randrange(8, 120)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), outline=color, width=3)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _measure(raw_bytes: bytes, policy: str, *, quality: int, repeat: int) -> dict[str, object]:
+    if not image_codec.is_supported(policy):
+        return {"policy": policy, "supported": False}
+
+    timings: list[float] = []
+    encoded = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encoded = image_codec.encode(raw_bytes, policy, quality=quality)
+        timings.append(time.perf_counter() - started)
+
+    encoded_size = len(encoded.raw_bytes) if encoded else len(raw_bytes)
+    return {
+        "policy": policy,
+        "supported": True,
+        "mime_type": encoded.mime_type if encoded else None,
+        "bytes": encoded_size,
+        "ratio": round(encoded_size / len(raw_bytes), 4),
+        "encode_ms_median": round(statistics.median(timings) * 1000, 1),
+        "kept_original": encoded is None,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", type=Path, help="比較に使う画像ファイル")
+    parser.add_argument("--quality", type=int, default=90, help="webp / avif の品質（デフォルト 90）")
+    parser.add_argument("--repeat", type=int, default=3, help="各方針の計測回数（中央値を採用）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+
+    inputs = [(path.name, path.read_bytes()) for path in args.images] or [("synthetic-2048.png", _synthetic_png())]
+    policies = [policy for policy in image_codec.CODEC_POLICIES if policy != "original"]
+
+    results = []
+    for name, raw_bytes in inputs:
+        rows = [_measure(raw_bytes, policy, quality=args.quality, repeat=args.repeat) for policy in policies]
+        results.append({"input": name, "original_bytes": len(raw_bytes), "results": rows})
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return 0
+
+    for entry in results:
+        print(f"{entry['input']}: original {entry['original_bytes']:,} bytes")
+        for row in entry["results"]:
+            if not row["supported"]:
+                print(f"  {row['policy']:<14} (unsupported)")
+                continue
+            note = " (kept original)" if row["kept_original"] else ""
+            print(
+                f"  {row['policy']:<14} {row['bytes']:>12,} bytes  x{row['ratio']:<6}"
+                f" {row['encode_ms_median']:>8} ms{note}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,543 @@
+"""偽の Gemini バックエンドで起動したアプリに、実際の利用に近いリクエストの組み合わせで負荷をかける。
+
+使い方:
+    python benchmarks/load_test.py [--users 16] [--duration 60] [--profile gthread] [--workers 1] [--threads 8]
+        [--mix rough=3,reference=1,edit=1,list=4,asset=4,chat=2] [--model-latency lognormal:8,0.4]
+        [--model-errors 503:0.02] [--database-url mysql://...] [--output result.json] [--compare base.json]
+
+既定では一時ディレクトリの SQLite・ローカル保存と MODEL_BACKEND=fake でアプリを gunicorn 上に起動し、
+仮想ユーザーごとにログイン・CSRF 取得・チャットセッション作成を済ませてから、--duration 秒のあいだ
+--mix の重みでリクエストを選んで投げ続ける（思考時間なし）。--target を指定すると起動済みのサーバーへ
+--username / --password のアカウントで負荷をかける。
+
+結果はエンドポイント別のスループット・p50/p95/p99・エラー率と、/metrics から定期的に読んだ処理中リクエスト数
+（ワーカーの埋まり具合 = 処理中 ÷ workers × threads）で、--output で JSON に保存し --compare で前回と比較できる。
+httpx が必要（pip install httpx）。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+PASSWORD = "loadtest-password"
+LOCAL_METRICS_TOKEN = "loadtest-metrics-token"
+
+SCENARIOS = ("rough", "reference", "edit", "list", "asset", "chat")
+DEFAULT_MIX = "rough=3,reference=1,edit=1,list=4,asset=4,chat=2"
+
+
+def _png_bytes(size: tuple[int, int], color: tuple[int, int, int], *, mode: str = "RGB") -> bytes:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new(mode, size, color if mode == "RGB" else color[0]).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    weights: dict[str, float] = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, raw_weight = item.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"シナリオは {', '.join(SCENARIOS)} のいずれかです: {name}")
+        weights[name] = float(raw_weight or 1)
+    if not any(weight > 0 for weight in weights.values()):
+        raise ValueError("--mix に重みが正のシナリオがありません。")
+    return weights
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+@dataclass
+class EndpointStats:
+    latencies_ms: list[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    errors: int = 0
+
+    def record(self, latency_ms: float, status: str, ok: bool) -> None:
+        self.latencies_ms.append(latency_ms)
+        self.statuses[status] += 1
+        if not ok:
+            self.errors += 1
+
+    def summary(self, elapsed: float) -> dict[str, Any]:
+        values = sorted(self.latencies_ms)
+        count = len(values)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / count, 4) if count else 0.0,
+            "throughput_rps": round(count / elapsed, 3) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(_percentile(values, 0.50), 1),
+                "p95": round(_percentile(values, 0.95), 1),
+                "p99": round(_percentile(values, 0.99), 1),
+                "mean": round(sum(values) / count, 1) if count else 0.0,
+                "max": round(values[-1], 1) if values else 0.0,
+            },
+            "statuses": dict(sorted(self.statuses.items())),
+        }
+
+
+class VirtualUser:
+    """1人分のログイン済みセッション（Cookie・CSRF トークン・作成済みアセット）。"""
+
+    def __init__(self, client: Any, username: str, password: str) -> None:
+        self.client = client
+        self.username = username
+        self.password = password
+        self.csrf = ""
+        self.chat_session_id: Optional[int] = None
+        self.asset_urls: list[str] = []
+
+    async def setup(self, *, chat: bool) -> None:
+        self.csrf = (await self.client.get("/api/csrf")).json()["csrf_token"]
+        response = await self.client.post(
+            "/api/auth/login",
+            json={"username": self.username, "password": self.password},
+            headers={"X-CSRFToken": self.csrf},
+        )
+        response.raise_for_status()
+        # ログインでセッションが切り替わるので取り直す
+        self.csrf = (await self.client.get("/api/csrf")).json()["csrf_token"]
+        if chat:
+            response = await self.client.post(
+                "/api/chat/sessions", json={"title": "load test"}, headers={"X-CSRFToken": self.csrf}
+            )
+            response.raise_for_status()
+            self.chat_session_id = response.json()["session"]["id"]
+
+    async def _generate(self, data: dict[str, str], files: dict[str, tuple[str, bytes, str]]) -> Any:
+        response = await self.client.post(
+            "/api/generations", data=data, files=files, headers={"X-CSRFToken": self.csrf}
+        )
+        if response.status_code == 200:
+            self.asset_urls.extend(asset["url"] for asset in response.json().get("assets", []) if asset.get("url"))
+            del self.asset_urls[:-20]
+        return response
+
+    async def run(self, scenario: str, images: dict[str, bytes]) -> Any:
+        if scenario == "rough":
+            return await self._generate(
+                {
+                    "mode": "rough_with_instructions",
+                    "color_instruction": "orange",
+                    "pose_instruction": "standing",
+                    "aspect_ratio": "auto",
+                    "resolution": "auto",
+                },
+                {"rough_image": ("rough.png", images["rough"], "image/png")},
+            )
+        if scenario == "reference":
+            return await self._generate(
+                {
+                    "mode": "reference_style_colorize",
+                    "reference_instruction": "match the palette",
+                    "aspect_ratio": "auto",
+                    "resolution": "auto",
+                },
+                {
+                    "reference_image": ("reference.png", images["reference"], "image/png"),
+                    "rough_image": ("rough.png", images["rough"], "image/png"),
+                },
+            )
+        if scenario == "edit":
+            return await self._generate(
+                {"mode": "inpaint_outpaint", "edit_mode": "inpaint", "edit_instruction": "add a hat"},
+                {
+                    "edit_base_image": ("base.png", images["rough"], "image/png"),
+                    "edit_mask_image": ("mask.png", images["mask"], "image/png"),
+                },
+            )
+        if scenario == "list":
+            return await self.client.get("/api/generations")
+        if scenario == "asset":
+            if not self.asset_urls:
+                return None
+            return await self.client.get(random.choice(self.asset_urls))
+        if scenario == "chat":
+            return await self.client.post(
+                f"/api/chat/sessions/{self.chat_session_id}/messages",
+                json={"message": "この絵の配色についてアドバイスをください。"},
+                headers={"X-CSRFToken": self.csrf},
+            )
+        raise ValueError(scenario)
+
+
+async def _sample_in_flight(client: Any, stop: asyncio.Event, interval: float) -> dict[str, list[float]]:
+    from prometheus_client.parser import text_string_to_metric_families
+
+    samples: dict[str, list[float]] = {"requests": [], "generations": []}
+    while not stop.is_set():
+        try:
+            response = await client.get("/metrics")
+            if response.status_code == 200:
+                totals = {"app_http_requests_in_flight": 0.0, "app_generations_in_flight": 0.0}
+                for family in text_string_to_metric_families(response.text):
+                    if family.name in totals:
+                        totals[family.name] = sum(sample.value for sample in family.samples)
+                samples["requests"].append(totals["app_http_requests_in_flight"])
+                samples["generations"].append(totals["app_generations_in_flight"])
+        except Exception:  # noqa: BLE001
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+    return samples
+
+
+async def run_load(
+    base_url: str,
+    *,
+    accounts: list[tuple[str, str]],
+    duration: float,
+    mix: dict[str, float],
+    sample_interval: float,
+    seed: Optional[int],
+    metrics_token: Optional[str] = None,
+) -> dict[str, Any]:
+    import httpx
+
+    rng = random.Random(seed)
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+    images = {
+        "rough": _png_bytes((512, 512), (200, 120, 40)),
+        "reference": _png_bytes((512, 512), (40, 120, 200)),
+        "mask": _png_bytes((512, 512), (255, 255, 255), mode="L"),
+    }
+    stats: dict[str, EndpointStats] = defaultdict(EndpointStats)
+    limits = httpx.Limits(max_connections=len(accounts) + 1)
+    timeout = httpx.Timeout(300.0)
+
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) for _ in accounts]
+    monitor = httpx.AsyncClient(
+        base_url=base_url,
+        timeout=timeout,
+        headers={"Authorization": f"Bearer {metrics_token}"} if metrics_token else None,
+    )
+    try:
+        users = [VirtualUser(client, *account) for client, account in zip(clients, accounts)]
+        await asyncio.gather(*(user.setup(chat="chat" in names) for user in users))
+
+        deadline = time.perf_counter() + duration
+
+        async def drive(user: VirtualUser) -> None:
+            while time.perf_counter() < deadline:
+                scenario = rng.choices(names, weights)[0]
+                if scenario == "asset" and not user.asset_urls:
+                    scenario = "list"
+                started = time.perf_counter()
+                try:
+                    response = await user.run(scenario, images)
+                    status = str(response.status_code)
+                    ok = response.status_code < 400
+                except httpx.HTTPError as exc:
+                    status, ok = exc.__class__.__name__, False
+                stats[scenario].record((time.perf_counter() - started) * 1000, status, ok)
+
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(_sample_in_flight(monitor, stop, sample_interval))
+        started = time.perf_counter()
+        await asyncio.gather(*(drive(user) for user in users))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        samples = await sampler
+    finally:
+        await asyncio.gather(*(client.aclose() for client in clients), monitor.aclose())
+
+    total = EndpointStats()
+    for endpoint in stats.values():
+        total.latencies_ms.extend(endpoint.latencies_ms)
+        total.statuses.update(endpoint.statuses)
+        total.errors += endpoint.errors
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "total": total.summary(elapsed),
+        "endpoints": {name: stats[name].summary(elapsed) for name in SCENARIOS if name in stats},
+        "in_flight_samples": samples,
+    }
+
+
+def _saturation(samples: dict[str, list[float]], capacity: Optional[int]) -> dict[str, Any]:
+    def describe(values: list[float]) -> dict[str, float]:
+        if not values:
+            return {"mean": 0.0, "peak": 0.0}
+        return {"mean": round(sum(values) / len(values), 2), "peak": max(values)}
+
+    requests = describe(samples["requests"])
+    result: dict[str, Any] = {
+        "capacity": capacity,
+        "samples": len(samples["requests"]),
+        "requests_in_flight": requests,
+        "generations_in_flight": describe(samples["generations"]),
+    }
+    if capacity:
+        result["utilization_mean"] = round(requests["mean"] / capacity, 3)
+        result["utilization_peak"] = round(requests["peak"] / capacity, 3)
+    return result
+
+
+# --- ローカルサーバーの起動 ------------------------------------------------------
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    import urllib.request
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn が起動直後に終了しました（--verbose でログを確認できます）。")
+        try:
+            with urllib.request.urlopen(f"{base_url}/api/health", timeout=1):
+                return
+        except OSError:
+            # 接続拒否・ウォームアップ中のタイムアウト（URLError も OSError）
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn の起動待ちがタイムアウトしました。")
+
+
+def _prepare_accounts(count: int) -> list[tuple[str, str]]:
+    """テーブルを作成し、仮想ユーザー用のアカウントを用意する（既存なら再利用）。"""
+
+    from app import create_app
+    from extensions import db
+    from models import User
+
+    accounts = [(f"loadtest-{index}", PASSWORD) for index in range(count)]
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        existing = {user.username for user in User.query.filter(User.username.like("loadtest-%")).all()}
+        for username, password in accounts:
+            if username in existing:
+                continue
+            user = User(username=username, email=f"{username}@example.com")
+            user.set_password(password)
+            db.session.add(user)
+        db.session.commit()
+    return accounts
+
+
+def _server_env(args: argparse.Namespace, workdir: Path) -> dict[str, str]:
+    env = {
+        **os.environ,
+        "APP_ENV": "development",
+        "APP_DEBUG": "false",
+        "SECRET_KEY": "loadtest-secret",
+        "DATABASE_URL": args.database_url or f"sqlite:///{workdir / 'loadtest.db'}",
+        "CHAT_IMAGE_STORAGE": "local",
+        "CHAT_IMAGE_DIR": str(workdir / "chat_images"),
+        "GENERATION_IMAGE_STORAGE": "local",
+        "GENERATION_IMAGE_DIR": str(workdir / "generated_images"),
+        "GENERATION_IMAGE_CODEC": "original",
+        "METRICS_ENABLED": "true",
+        # 本番相当の設定ではトークンなしの /metrics は返さない
+        "METRICS_TOKEN": LOCAL_METRICS_TOKEN,
+        "PROMETHEUS_MULTIPROC_DIR": str(workdir / "prometheus"),
+        "GUNICORN_PROFILE": args.profile,
+        "GUNICORN_THREADS": str(args.threads),
+        "MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": args.model_latency,
+        "FAKE_MODEL_ERRORS": args.model_errors,
+        "FAKE_MODEL_IMAGE_SIZE": args.image_size,
+    }
+    if args.seed is not None:
+        env["FAKE_MODEL_SEED"] = str(args.seed)
+    return env
+
+
+def _print_summary(result: dict[str, Any]) -> None:
+    config = result["config"]
+    print(
+        f"{config['target']} users={config['users']} duration={config['duration_s']}s"
+        f" mix={config['mix']} model_latency={config.get('model_latency')}"
+    )
+    print(f"{'endpoint':<10} {'reqs':>6} {'rps':>8} {'err%':>6} {'p50':>9} {'p95':>9} {'p99':>9}  (ms)")
+    for name, summary in [*result["endpoints"].items(), ("total", result["total"])]:
+        latency = summary["latency_ms"]
+        print(
+            f"{name:<10} {summary['requests']:>6} {summary['throughput_rps']:>8} {summary['error_rate'] * 100:>6.1f}"
+            f" {latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9}"
+        )
+    saturation = result["saturation"]
+    line = (
+        f"in flight: mean {saturation['requests_in_flight']['mean']} peak {saturation['requests_in_flight']['peak']}"
+        f" (generations mean {saturation['generations_in_flight']['mean']})"
+    )
+    if saturation.get("capacity"):
+        line += (
+            f"  capacity {saturation['capacity']}  utilization mean {saturation['utilization_mean']:.0%}"
+            f" peak {saturation['utilization_peak']:.0%}"
+        )
+    print(line)
+
+
+def _print_comparison(result: dict[str, Any], baseline: dict[str, Any]) -> None:
+    def change(current: float, previous: float) -> str:
+        if not previous:
+            return "n/a"
+        return f"{(current - previous) / previous:+.1%}"
+
+    print(f"\ncompared with {baseline.get('started_at', 'baseline')}:")
+    print(f"{'endpoint':<10} {'rps':>18} {'p95 ms':>22} {'err%':>14}")
+    pairs = [(name, baseline.get("endpoints", {}).get(name)) for name in result["endpoints"]]
+    pairs.append(("total", baseline.get("total")))
+    for name, previous in pairs:
+        if not previous:
+            continue
+        current = result["total"] if name == "total" else result["endpoints"][name]
+        rps = f"{previous['throughput_rps']}→{current['throughput_rps']} ({change(current['throughput_rps'], previous['throughput_rps'])})"
+        p95_now, p95_before = current["latency_ms"]["p95"], previous["latency_ms"]["p95"]
+        p95 = f"{p95_before}→{p95_now} ({change(p95_now, p95_before)})"
+        errors = f"{previous['error_rate'] * 100:.1f}→{current['error_rate'] * 100:.1f}"
+        print(f"{name:<10} {rps:>18} {p95:>22} {errors:>14}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=16, help="同時に操作する仮想ユーザー数")
+    parser.add_argument("--duration", type=float, default=60, help="負荷をかける秒数")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"シナリオの重み（既定: {DEFAULT_MIX}）")
+    parser.add_argument("--seed", type=int, help="シナリオ選択と偽モデルの乱数シード")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="/metrics を読む間隔（秒）")
+    parser.add_argument("--target", help="起動済みサーバーの URL（指定時はサーバーを起動しない）")
+    parser.add_argument("--username", help="--target 時に全仮想ユーザーで共有するアカウント")
+    parser.add_argument("--password", help="--target 時のパスワード")
+    parser.add_argument(
+        "--metrics-token", default=os.environ.get("METRICS_TOKEN"), help="--target 時の /metrics 用 Bearer トークン"
+    )
+    parser.add_argument("--capacity", type=int, help="--target 時の同時処理数（workers × threads）")
+    parser.add_argument("--profile", choices=["sync", "gthread"], default="gthread", help="GUNICORN_PROFILE")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn のワーカー数")
+    parser.add_argument("--threads", type=int, default=8, help="gthread のワーカーあたりスレッド数")
+    parser.add_argument("--database-url", help="DATABASE_URL（未指定は一時ディレクトリの SQLite）")
+    parser.add_argument("--model-latency", default="lognormal:2,0.4", help="FAKE_MODEL_LATENCY")
+    parser.add_argument("--model-errors", default="", help="FAKE_MODEL_ERRORS（例: 503:0.02,429:0.01）")
+    parser.add_argument("--image-size", default="1024x1024", help="FAKE_MODEL_IMAGE_SIZE")
+    parser.add_argument("--output", type=Path, help="結果を JSON で保存するパス")
+    parser.add_argument("--compare", type=Path, help="比較する過去の結果 JSON")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で標準出力へ出す")
+    parser.add_argument("--verbose", action="store_true", help="gunicorn・アプリのログを表示する")
+    args = parser.parse_args(argv)
+
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        parser.error("httpx が必要です（pip install httpx）。")
+    mix = parse_mix(args.mix)
+    load_options = {"duration": args.duration, "mix": mix, "sample_interval": args.sample_interval, "seed": args.seed}
+
+    if args.target:
+        if not (args.username and args.password):
+            parser.error("--target には --username と --password が必要です。")
+        accounts = [(args.username, args.password)] * args.users
+        outcome = asyncio.run(
+            run_load(args.target.rstrip("/"), accounts=accounts, metrics_token=args.metrics_token, **load_options)
+        )
+        config: dict[str, Any] = {"target": args.target, "capacity": args.capacity}
+        capacity = args.capacity
+    else:
+        with tempfile.TemporaryDirectory(prefix="loadtest-") as raw_workdir:
+            workdir = Path(raw_workdir)
+            env = _server_env(args, workdir)
+            os.environ.update(env)
+            accounts = _prepare_accounts(args.users)
+            port = _free_port()
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "--config",
+                    str(ROOT / "gunicorn.conf.py"),
+                    "--bind",
+                    f"127.0.0.1:{port}",
+                    "--workers",
+                    str(args.workers),
+                    "--timeout",
+                    "300",
+                    "--log-level",
+                    "warning",
+                    "wsgi:app",
+                ],
+                cwd=ROOT,
+                env=env,
+                stdout=None if args.verbose else subprocess.DEVNULL,
+                stderr=None if args.verbose else subprocess.DEVNULL,
+            )
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                _wait_until_ready(base_url, process)
+                outcome = asyncio.run(
+                    run_load(base_url, accounts=accounts, metrics_token=LOCAL_METRICS_TOKEN, **load_options)
+                )
+            finally:
+                process.terminate()
+                process.wait(timeout=60)
+        capacity = args.workers * (args.threads if args.profile == "gthread" else 1)
+        database = "sqlite" if not args.database_url else args.database_url.split(":", 1)[0]
+        config = {
+            "target": "local",
+            "profile": args.profile,
+            "workers": args.workers,
+            "threads": args.threads if args.profile == "gthread" else 1,
+            "database": database,
+            "model_latency": args.model_latency,
+            "model_errors": args.model_errors,
+            "image_size": args.image_size,
+        }
+
+    result = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {**config, "users": args.users, "duration_s": args.duration, "mix": args.mix, "seed": args.seed},
+        "elapsed_s": outcome["elapsed_s"],
+        "total": outcome["total"],
+        "endpoints": outcome["endpoints"],
+        "saturation": _saturation(outcome["in_flight_samples"], capacity),
+    }
+    if args.output:
+        args.output.write_text(json.dumps(result, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        _print_summary(result)
+        if args.compare:
+            _print_comparison(result, json.loads(args.compare.read_text(encoding="utf-8")))
+    return 0 if result["total"]["requests"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
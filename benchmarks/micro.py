@@ -0,0 +1,327 @@
+"""画像デコード・保存・シリアライズ・プロンプト組み立てのマイクロベンチマークを、保存済みのベースラインと比較する。
+
+使い方:
+    python benchmarks/micro.py [--filter decode] [--repeat 7] [--min-time 0.2] [--tolerance 0.25]
+        [--baseline benchmarks/baselines/micro.json] [--update-baseline] [--json]
+
+各ケースは1回あたりの所要時間（マイクロ秒）を --repeat 回計測し、最小値をベースラインの最小値と比べる
+（最小値は他プロセスの割り込みなどのノイズを受けにくい。中央値も記録する）。
+--tolerance（既定 25%）より遅くなったケースがあれば終了コード 1 になる。ベースラインは計測したマシンに
+依存するため、比較は同じ環境（CI の同じランナーなど）で行い、意図した変更の後は --update-baseline で更新する。
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from PIL import Image, ImageDraw
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "micro.json"
+
+# 長辺のピクセル数（正方形の合成画像）
+IMAGE_SIZES = {"1k": 1024, "4k": 4096, "8k": 8192}
+
+
+def _synthetic_image(size: int, *, mode: str = "RGB") -> Image.Image:
+    """圧縮率が極端にならないよう、グラデーションに図形を重ねた画像。"""
+
+    gradient = Image.linear_gradient("L").resize((size, size))
+    image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.ROTATE_90), gradient.point(lambda v: 255 - v)))
+    draw = ImageDraw.Draw(image)
+    step = max(size // 16, 1)
+    for offset in range(0, size, step):
+        draw.line((offset, 0, size - offset, size), fill=(offset % 256, 64, 200), width=max(size // 512, 1))
+    if mode != "RGB":
+        image = image.convert(mode)
+    return image
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format="PNG", compress_level=1)
+    else:
+        image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _mask_data_url(size: int) -> str:
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=255)
+    return "data:image/png;base64," + base64.b64encode(_encode(mask, "PNG")).decode("ascii")
+
+
+def _make_app(workdir: Path) -> Any:
+    from app import create_app
+
+    return create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{workdir / 'micro.db'}",
+            "SECRET_KEY": "benchmark-secret",
+            "APP_AUTO_MIGRATE": False,
+            "APP_AUTO_INIT_USER": False,
+            "METRICS_ENABLED": False,
+            "GENERATION_IMAGE_STORAGE": "local",
+            "GENERATION_IMAGE_DIR": str(workdir / "generated_images"),
+            "STORAGE_LOCAL_FSYNC": "none",
+        }
+    )
+
+
+def _cases(sizes: list[str]) -> Iterator[tuple[str, Callable[[], object]]]:
+    """(名前, 計測対象) を返す。入力の準備は計測に含めない。"""
+
+    from models import ChatAttachment, ChatMessage, Generation
+    from services import chat_service, generation_service, storage
+    from views import api
+
+    for size_name in sizes:
+        image = _synthetic_image(IMAGE_SIZES[size_name])
+        for image_format in ("PNG", "JPEG"):
+            raw_bytes = _encode(image, image_format)
+            mime_type = f"image/{image_format.lower()}"
+            yield (
+                f"decode_image_bytes[{image_format.lower()}-{size_name}]",
+                lambda raw_bytes=raw_bytes, mime_type=mime_type: generation_service.decode_image_bytes(
+                    raw_bytes, mime_type=mime_type
+                ),
+            )
+        del image
+
+    for size_name in sizes:
+        data_url = _mask_data_url(IMAGE_SIZES[size_name])
+        yield (
+            f"decode_data_url_image[mask-{size_name}]",
+            lambda data_url=data_url: generation_service.decode_data_url_image(data_url, label="マスク画像"),
+        )
+
+    for size_name in sizes[:2]:
+        rgba = _synthetic_image(IMAGE_SIZES[size_name], mode="RGBA")
+        yield f"ensure_rgb[rgba-{size_name}]", lambda rgba=rgba: generation_service.ensure_rgb(rgba)
+
+    payload = _encode(_synthetic_image(1024), "PNG")
+    counter = iter(range(10**9))
+    stored = storage.save_bytes(
+        raw_bytes=payload,
+        extension=".png",
+        storage_backend="local",
+        bucket_name=None,
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+        object_prefix="bench",
+        content_type="image/png",
+    )
+    yield (
+        f"storage.save_bytes[local-{len(payload) // 1024}KiB]",
+        lambda: storage.save_bytes(
+            raw_bytes=payload,
+            extension=".png",
+            storage_backend="local",
+            bucket_name=None,
+            local_dir_key="GENERATION_IMAGE_DIR",
+            default_local_dir="generated_images",
+            object_prefix="bench",
+            content_type="image/png",
+            object_name=f"bench/{next(counter) % 64}.png",
+        ),
+    )
+    yield (
+        f"storage.load_bytes[local-{len(payload) // 1024}KiB]",
+        lambda: storage.load_bytes(
+            storage_backend="local",
+            bucket_name=None,
+            object_name=stored.object_name,
+            local_dir_key="GENERATION_IMAGE_DIR",
+            default_local_dir="generated_images",
+            expected_sha256=stored.sha256,
+        ),
+    )
+
+    created_at = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    generations = [
+        Generation(
+            id=index,
+            user_id=1,
+            mode="rough_with_instructions",
+            status="succeeded",
+            aspect_ratio="1:1",
+            resolution="1K",
+            created_at=created_at + timedelta(seconds=index),
+            finished_at=created_at + timedelta(seconds=index + 20),
+        )
+        for index in range(1000)
+    ]
+    yield "_serialize_generation[x1000]", lambda: [api._serialize_generation(row) for row in generations]
+
+    messages = []
+    for index in range(1000):
+        message = ChatMessage(
+            id=index,
+            session_id=1,
+            role="user" if index % 2 == 0 else "assistant",
+            text=f"メッセージ {index}: " + "配色と構図について相談したいです。" * 4,
+            mode_id="text_chat",
+            created_at=created_at + timedelta(seconds=index),
+        )
+        if index % 5 == 0:
+            message.attachments = [ChatAttachment(id=index, kind="image", mime_type="image/png")]
+        messages.append(message)
+    yield "_serialize_chat_message[x1000]", lambda: [api._serialize_chat_message(message) for message in messages]
+
+    history = messages[:500]
+    summary = "これまでの要約: " + "ユーザーは水彩風の塗りを希望している。" * 20
+    yield (
+        "build_text_prompt[history-500]",
+        lambda: chat_service.build_text_prompt(history, "この続きを提案してください。", summary=summary),
+    )
+
+
+def _measure(fn: Callable[[], object], *, repeat: int, min_time: float) -> dict[str, float]:
+    fn()  # 初回のみ発生するコスト（プラグイン登録など）を除く
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(int(min_time / elapsed) + 1, 10))
+
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - started) / loops)
+    return {
+        "median_us": round(statistics.median(samples) * 1e6, 2),
+        "min_us": round(min(samples) * 1e6, 2),
+        "stdev_us": round(statistics.pstdev(samples) * 1e6, 2),
+        "loops": loops,
+    }
+
+
+def _environment() -> dict[str, str]:
+    from PIL import __version__ as pillow_version
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "pillow": pillow_version,
+        "machine": platform.machine(),
+        "system": platform.system(),
+    }
+
+
+def _compare(results: dict[str, dict[str, float]], baseline: dict[str, Any], tolerance: float) -> dict[str, dict[str, Any]]:
+    comparison: dict[str, dict[str, Any]] = {}
+    previous = baseline.get("results", {})
+    for name, result in results.items():
+        if name not in previous:
+            comparison[name] = {"status": "new"}
+            continue
+        ratio = result["min_us"] / previous[name]["min_us"] if previous[name]["min_us"] else 1.0
+        if ratio > 1 + tolerance:
+            status = "slower"
+        elif ratio < 1 - tolerance:
+            status = "faster"
+        else:
+            status = "same"
+        comparison[name] = {"status": status, "ratio": round(ratio, 3), "baseline_us": previous[name]["min_us"]}
+    return comparison
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", action="append", default=[], help="名前に含む文字列で絞り込む（複数指定可）")
+    parser.add_argument("--sizes", default="1k,4k,8k", help="画像ケースのサイズ（1k,4k,8k から選択）")
+    parser.add_argument("--repeat", type=int, default=7, help="計測の繰り返し回数（最小値で比較する）")
+    parser.add_argument("--min-time", type=float, default=0.2, help="1回の計測に使う最小秒数")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="遅くなったと判定する比率（0.25 = 25%%）")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="ベースライン JSON")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果でベースラインを書き換える")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+
+    sizes = [size.strip().lower() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in IMAGE_SIZES]
+    if unknown:
+        parser.error(f"--sizes は {', '.join(IMAGE_SIZES)} から選んでください: {', '.join(unknown)}")
+
+    results: dict[str, dict[str, float]] = {}
+    with tempfile.TemporaryDirectory(prefix="bench-micro-") as workdir:
+        app = _make_app(Path(workdir))
+        with app.test_request_context():
+            for name, fn in _cases(sizes):
+                if args.filter and not any(pattern in name for pattern in args.filter):
+                    continue
+                results[name] = _measure(fn, repeat=args.repeat, min_time=args.min_time)
+                if not args.json:
+                    print(f"  measured {name}", file=sys.stderr)
+
+    baseline: dict[str, Any] = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    comparison = _compare(results, baseline, args.tolerance)
+    environment = _environment()
+    regressions = sorted(name for name, entry in comparison.items() if entry["status"] == "slower")
+
+    if args.json:
+        print(
+            json.dumps(
+                {"environment": environment, "results": results, "comparison": comparison, "regressions": regressions},
+                ensure_ascii=False,
+                indent=2,
+            )
+        )
+    else:
+        if baseline and baseline.get("environment") != environment:
+            print(f"note: baseline was recorded on {baseline.get('environment')}; this run is {environment}")
+        print(f"{'case':<44} {'min':>12} {'median':>12} {'baseline':>12} {'ratio':>7}")
+        for name, result in results.items():
+            entry = comparison[name]
+            baseline_text = f"{entry['baseline_us']:.1f}us" if "baseline_us" in entry else "-"
+            ratio_text = f"{entry['ratio']:.2f}" if "ratio" in entry else "-"
+            flag = {"slower": "  SLOWER", "faster": "  faster", "new": "  new"}.get(entry["status"], "")
+            print(
+                f"{name:<44} {result['min_us']:>10.1f}us {result['median_us']:>10.1f}us"
+                f" {baseline_text:>12} {ratio_text:>7}{flag}"
+            )
+
+    if args.update_baseline:
+        merged = {**baseline.get("results", {}), **results}
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(
+            json.dumps(
+                {
+                    "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "environment": environment,
+                    "results": dict(sorted(merged.items())),
+                },
+                ensure_ascii=False,
+                indent=2,
+            )
+            + "\n",
+            encoding="utf-8",
+        )
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
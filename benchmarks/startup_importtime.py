@@ -0,0 +1,120 @@
+"""起動時の import 時間を `python -X importtime` で計測し、回帰を検出するベンチマーク。
+
+使い方:
+    python benchmarks/startup_importtime.py [--module app] [--repeat 5] [--top 15] [--max-ms 1500] [--json]
+
+計測は毎回新しいインタープリターで行い、対象モジュールの累積時間の中央値を採用する。
+起動時に読み込まれてはならない重い SDK（--forbid、デフォルトは google-genai / google-cloud-storage など）が
+import されていた場合や、--max-ms を超えた場合は終了コード 1 を返す。
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 初回利用時まで import を遅延している SDK
+DEFAULT_FORBIDDEN = ("google.genai", "google.cloud.storage", "google.api_core", "boto3")
+
+
+def _run_importtime(module: str) -> list[tuple[int, int, str]]:
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    env.setdefault("SECRET_KEY", "importtime-benchmark")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} に失敗しました:\n{completed.stderr[-2000:]}")
+
+    rows: list[tuple[int, int, str]] = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def _depth(name: str) -> int:
+    # -X importtime はネストの深さを「| 」の後の2スペース単位のインデントで表す
+    return (len(name) - len(name.lstrip(" ")) - 1) // 2
+
+
+def _measure(module: str, *, repeat: int, top: int, forbidden: list[str]) -> dict[str, object]:
+    totals: list[int] = []
+    rows: list[tuple[int, int, str]] = []
+    for _ in range(repeat):
+        rows = _run_importtime(module)
+        total = next((cumulative for _, cumulative, name in rows if name.strip() == module), 0)
+        totals.append(total)
+
+    imported = {name.strip() for _, _, name in rows}
+    # 対象モジュールの直下で import されたもの（インデント1段）を累積時間順に並べる
+    top_level = [row for row in rows if _depth(row[2]) == 1]
+    slowest = sorted(top_level, key=lambda row: row[1], reverse=True)[:top]
+    return {
+        "module": module,
+        "repeat": repeat,
+        "total_ms_median": round(statistics.median(totals) / 1000, 1),
+        "total_ms_min": round(min(totals) / 1000, 1),
+        "module_count": len(imported),
+        "forbidden_imported": sorted(name for name in forbidden if name in imported),
+        "slowest": [
+            {"module": name.strip(), "cumulative_ms": round(cumulative / 1000, 1), "self_ms": round(self_us / 1000, 1)}
+            for self_us, cumulative, name in slowest
+        ],
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="app", help="計測するモジュール（デフォルト app）")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数（中央値を採用）")
+    parser.add_argument("--top", type=int, default=15, help="表示する直下の import の件数")
+    parser.add_argument("--max-ms", type=float, default=None, help="累積時間の上限（超えたら終了コード 1）")
+    parser.add_argument(
+        "--forbid",
+        action="append",
+        default=None,
+        help="起動時に import されてはならないモジュール（複数指定可）",
+    )
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+
+    forbidden = args.forbid if args.forbid is not None else list(DEFAULT_FORBIDDEN)
+    result = _measure(args.module, repeat=max(args.repeat, 1), top=args.top, forbidden=forbidden)
+    failures: list[str] = []
+    if result["forbidden_imported"]:
+        failures.append(f"起動時に import されています: {', '.join(result['forbidden_imported'])}")
+    if args.max_ms is not None and result["total_ms_median"] > args.max_ms:
+        failures.append(f"import 時間 {result['total_ms_median']} ms が上限 {args.max_ms} ms を超えています")
+    result["failures"] = failures
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(
+            f"import {result['module']}: median {result['total_ms_median']} ms"
+            f" (min {result['total_ms_min']} ms, {result['module_count']} modules, n={result['repeat']})"
+        )
+        for row in result["slowest"]:
+            print(f"  {row['module']:<40} {row['cumulative_ms']:>8} ms  (self {row['self_ms']} ms)")
+        for failure in failures:
+            print(f"NG: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
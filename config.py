@@ -139,14 +139,78 @@ class Config:
     INITIAL_USER_USERNAME = os.environ.get("INITIAL_USER_USERNAME")
     INITIAL_USER_EMAIL = os.environ.get("INITIAL_USER_EMAIL")
     INITIAL_USER_PASSWORD = os.environ.get("INITIAL_USER_PASSWORD")
+    # Prometheus 形式の /metrics（Bearer トークン必須。METRICS_TOKEN 未設定で返すのは DEBUG / TESTING 時のみ）
+    METRICS_ENABLED = _env_bool(os.environ.get("METRICS_ENABLED"))
+    METRICS_TOKEN = _env("METRICS_TOKEN")
+    # ログインユーザー情報のプロセス内キャッシュ秒数（0でキャッシュ無効）
+    USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "30"))
     APP_AUTO_MIGRATE = _env_bool(os.environ.get("APP_AUTO_MIGRATE"))
     APP_AUTO_INIT_USER = _env_bool(os.environ.get("APP_AUTO_INIT_USER"))
+    # gunicorn ワーカーの起動直後（最初のリクエスト前）に DB 接続・SDK クライアント等を初期化する
+    WARMUP_ENABLED = _env_bool(os.environ.get("WARMUP_ENABLED", "true"))
+    WARMUP_DB_CONNECTIONS = int(os.environ.get("WARMUP_DB_CONNECTIONS", "1"))
+    WARMUP_PROBE_PATH = _env("WARMUP_PROBE_PATH")
+    # リクエスト単位のサンプリングプロファイラー（管理者の X-Profile: 1 / ?profile=1、または抽選）
+    PROFILING_ENABLED = _env_bool(os.environ.get("PROFILING_ENABLED"))
+    PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", "0"))
+    PROFILING_PATH_PREFIXES = tuple(
+        prefix.strip() for prefix in os.environ.get("PROFILING_PATH_PREFIXES", "/api/").split(",") if prefix.strip()
+    )
+    PROFILING_INTERVAL_MS = float(os.environ.get("PROFILING_INTERVAL_MS", "5"))
+    PROFILING_DIR = os.environ.get("PROFILING_DIR", "profiles")
+    PROFILING_MAX_FILES = int(os.environ.get("PROFILING_MAX_FILES", "100"))
+    # OpenTelemetry のトレース（otlp / console / file。otlp の送信先は OTEL_EXPORTER_OTLP_ENDPOINT）
+    TRACING_ENABLED = _env_bool(os.environ.get("TRACING_ENABLED"))
+    TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "otlp")
+    TRACING_FILE_PATH = os.environ.get("TRACING_FILE_PATH", "traces.jsonl")
+    TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "rough-to-illustration")
+    TRACING_SAMPLE_RATIO = float(os.environ.get("TRACING_SAMPLE_RATIO", "1.0"))
+    # リクエストごとの SQL 実行回数・合計時間（リクエストログへ出力）と遅いクエリの警告ログ
+    DB_QUERY_STATS_ENABLED = _env_bool(os.environ.get("DB_QUERY_STATS_ENABLED", "true"))
+    DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "200"))
     CHAT_ENABLED = _env_bool(os.environ.get("CHAT_ENABLED", "true"))
     CHAT_IMAGE_STORAGE = _resolve_chat_image_storage(APP_ENV)
     CHAT_IMAGE_BUCKET = os.environ.get("CHAT_IMAGE_BUCKET")
     CHAT_IMAGE_DIR = os.environ.get("CHAT_IMAGE_DIR", "chat_images")
+    # 添付画像の検証・保存を並列に行うワーカー数（プロセス全体）
+    CHAT_ATTACHMENT_WORKERS = int(os.environ.get("CHAT_ATTACHMENT_WORKERS", "4"))
+
+    # チャット履歴は「要約＋トークン予算内の直近ウィンドウ」でプロンプトへ載せる
+    CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+    CHAT_SUMMARY_ENABLED = _env_bool(os.environ.get("CHAT_SUMMARY_ENABLED", "true"))
+    CHAT_SUMMARY_MAX_CHARS = int(os.environ.get("CHAT_SUMMARY_MAX_CHARS", "2000"))
 
     # 生成画像はチャット画像と同じストレージ設定をデフォルトにする
     GENERATION_IMAGE_STORAGE = os.environ.get("GENERATION_IMAGE_STORAGE") or CHAT_IMAGE_STORAGE
     GENERATION_IMAGE_BUCKET = os.environ.get("GENERATION_IMAGE_BUCKET") or CHAT_IMAGE_BUCKET
     GENERATION_IMAGE_DIR = os.environ.get("GENERATION_IMAGE_DIR", "generated_images")
+    # 保存時の再エンコード方針（original / png_optimized / webp_lossless / webp / avif）
+    GENERATION_IMAGE_CODEC = os.environ.get("GENERATION_IMAGE_CODEC", "original")
+    GENERATION_IMAGE_CODEC_QUALITY = int(os.environ.get("GENERATION_IMAGE_CODEC_QUALITY", "90"))
+    # 再エンコードで置き換えた旧オブジェクトを消すまでの猶予（秒）
+    GENERATION_REENCODE_DELETE_GRACE_SECONDS = float(
+        os.environ.get("GENERATION_REENCODE_DELETE_GRACE_SECONDS", "300")
+    )
+    # write_behind: GCS 保存をレスポンス後に行い、完了まではローカルスプールから配信する
+    GENERATION_UPLOAD_MODE = os.environ.get("GENERATION_UPLOAD_MODE", "sync")
+    GENERATION_UPLOAD_WORKERS = int(os.environ.get("GENERATION_UPLOAD_WORKERS", "4"))
+    GENERATION_UPLOAD_MAX_RETRIES = int(os.environ.get("GENERATION_UPLOAD_MAX_RETRIES", "5"))
+    GENERATION_UPLOAD_RETRY_BACKOFF_SECONDS = float(os.environ.get("GENERATION_UPLOAD_RETRY_BACKOFF_SECONDS", "1"))
+    GENERATION_SPOOL_DIR = os.environ.get("GENERATION_SPOOL_DIR", "upload_spool")
+    GENERATION_SPOOL_MAX_BYTES = int(os.environ.get("GENERATION_SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))
+    # 起動時にスプールの無い pending をこの秒数より古ければ failed にする（新しいものは別インスタンスが処理中とみなす）
+    GENERATION_UPLOAD_STALE_SECONDS = float(os.environ.get("GENERATION_UPLOAD_STALE_SECONDS", "3600"))
+    # モデル呼び出しを実行するワーカー数（プロセス内の同時リクエスト数以上にする）
+    MODEL_CALL_WORKERS = int(os.environ.get("MODEL_CALL_WORKERS", "16"))
+    # GCS から読んだ画像のローカルディスクキャッシュ（0で無効。同一コンテナのワーカー間で共有）
+    STORAGE_CACHE_DIR = os.environ.get("STORAGE_CACHE_DIR", "storage_cache")
+    STORAGE_CACHE_MAX_BYTES = int(os.environ.get("STORAGE_CACHE_MAX_BYTES", "0"))
+    # キャッシュから読むたびに内容の sha256 を計算し直す（ディスク上の破損も検出したい場合）
+    STORAGE_CACHE_VERIFY_ON_READ = _env_bool(os.environ.get("STORAGE_CACHE_VERIFY_ON_READ"))
+    # ローカル保存の fsync 方針（none / file / dir）
+    STORAGE_LOCAL_FSYNC = os.environ.get("STORAGE_LOCAL_FSYNC", "file")
+    # memory バックエンド（テスト・ベンチマーク用）の合計サイズ上限（0で無制限）
+    STORAGE_MEMORY_MAX_BYTES = int(os.environ.get("STORAGE_MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))
+    # s3 バックエンド（MinIO などの互換ストレージは endpoint を指定。認証情報は AWS_* 環境変数）
+    STORAGE_S3_ENDPOINT_URL = _env("STORAGE_S3_ENDPOINT_URL")
+    STORAGE_S3_REGION = _env("STORAGE_S3_REGION")
@@ -0,0 +1,90 @@
+"""gunicorn 設定ファイル。
+
+`gunicorn wsgi:app` 実行時にカレントディレクトリの本ファイルが自動で読み込まれる。
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+from pathlib import Path
+
+# サービングプロファイル（GUNICORN_PROFILE）
+# - sync: 1ワーカー1リクエスト（CPU 処理が中心の場合）
+# - gthread: 1ワーカーで GUNICORN_THREADS 件を並行処理する。処理時間の大半が Gemini の応答待ちなので、
+#   プロセスを増やさずに同時生成数を稼げる。Cloud Run の同時実行数は workers × threads に合わせる。
+_profile = (os.environ.get("GUNICORN_PROFILE") or "sync").strip().lower()
+if _profile not in {"sync", "gthread"}:
+    raise RuntimeError(f"GUNICORN_PROFILE は sync / gthread のいずれかを指定してください: {_profile}")
+
+# ワーカー数は gunicorn 標準の WEB_CONCURRENCY（または -w）で指定する
+if _profile == "gthread":
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+
+def on_starting(server) -> None:
+    """マスター起動時に Prometheus マルチプロセス用ディレクトリを初期化する。"""
+
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not multiproc_dir:
+        return
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    Path(multiproc_dir).mkdir(parents=True, exist_ok=True)
+
+
+def when_ready(server) -> None:
+    """マスターの待ち受け開始時に PIL プラグインを登録し、fork 後のワーカーへ引き継ぐ。"""
+
+    from PIL import Image
+
+    Image.preinit()
+    server.log.info("PIL plugins preloaded: %s", ", ".join(sorted(Image.OPEN)))
+
+
+def post_fork(server, worker) -> None:
+    """preload_app 時、マスターで作られた DB 接続・SDK クライアントをワーカーで作り直させる。"""
+
+    if not server.cfg.preload_app:
+        return
+    from flask import Flask
+
+    from services import warmup
+
+    app = server.app.wsgi()
+    warmup.reset_after_fork(app if isinstance(app, Flask) else None)
+
+
+def post_worker_init(worker) -> None:
+    """
+    アプリ読み込み後・最初のリクエスト受付前に、ワーカーのウォームアップを行う。
+
+    post_fork の時点ではアプリが未読み込み（preload_app 無効時）のため、ここで行う。
+    """
+
+    from flask import Flask
+
+    app = worker.wsgi
+    if not isinstance(app, Flask) or not app.config.get("WARMUP_ENABLED"):
+        return
+    from services import warmup
+
+    warmup.run(app)
+
+
+def child_exit(server, worker) -> None:
+    """終了したワーカーのメトリクスファイルを集計対象から外す。"""
+
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+    from services import metrics
+
+    metrics.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker) -> None:
+    """ワーカー終了時に、バッファ中のトレースのスパンを送出する。"""
+
+    from services import tracing
+
+    tracing.shutdown()
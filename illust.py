@@ -2,17 +2,21 @@ from __future__ import annotations
 
 import logging
 import os
-from dataclasses import dataclass
 from functools import lru_cache
 from io import BytesIO
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Optional
 
-from google import genai
-from google.genai import types
 from PIL import Image
 
 from dotenv import load_dotenv
 
+from services import metrics, tracing
+from services.stage_timer import StageTimer, stage
+
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
+
 # .env に記載したAPIキーなどの環境変数を読み込む
 load_dotenv()
 
@@ -33,31 +37,168 @@ def _env_bool(value: Optional[str]) -> bool:
 
 
 
+def _types() -> Any:
+    """google.genai.types を初回利用時に読み込む（SDK の import は起動時間の大半を占めるため）。"""
+
+    from google.genai import types
+
+    return types
+
+
+MODEL_BACKENDS = ("genai", "fake", "http")
+
+
+def model_backend() -> str:
+    """
+    モデル呼び出し先（MODEL_BACKEND）。
+
+    - genai: 実際の Gemini API（既定）
+    - fake: プロセス内の偽クライアント（services.fake_model）
+    - http: MODEL_HTTP_BASE_URL の generateContent 互換サーバー（python -m services.fake_model など）
+    """
+
+    backend = (os.environ.get("MODEL_BACKEND") or "genai").strip().lower()
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"MODEL_BACKEND は {', '.join(MODEL_BACKENDS)} のいずれかを指定してください: {backend}")
+    return backend
+
+
 @lru_cache(maxsize=1)
 def _client() -> genai.Client:
+    backend = model_backend()
+    if backend == "fake":
+        from services.fake_model import FakeModelClient
+
+        return FakeModelClient.from_env()
+
     api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    from google import genai
+
+    if backend == "http":
+        base_url = os.environ.get("MODEL_HTTP_BASE_URL")
+        if not base_url:
+            raise RuntimeError("MODEL_BACKEND=http には MODEL_HTTP_BASE_URL の設定が必要です。")
+        # 偽サーバーはキーを検証しないが、SDK はキーなしでの生成を許さない
+        return genai.Client(
+            api_key=api_key or "fake-key",
+            http_options=_types().HttpOptions(base_url=base_url),
+        )
+
     if not api_key:
         raise MissingApiKeyError("API key is not set.")
     return genai.Client(api_key=api_key)
 
 
-@dataclass
+def _content_size(item: Any) -> tuple[int, int]:
+    """(画像枚数, バイト数)。PIL 画像は未圧縮の画素サイズ、SDK の Image は画像データのサイズで数える。"""
+
+    if isinstance(item, str):
+        return 0, len(item.encode("utf-8"))
+    if isinstance(item, Image.Image):
+        return 1, item.width * item.height * len(item.getbands())
+    image_bytes = getattr(item, "image_bytes", None)
+    if isinstance(image_bytes, bytes):
+        return 1, len(image_bytes)
+    return 0, 0
+
+
+def _response_bytes(response: Any) -> int:
+    total = 0
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "text", None):
+                total += len(part.text.encode("utf-8"))
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is not None and getattr(inline_data, "data", None):
+                total += len(inline_data.data)
+    return total
+
+
+def _generate_content(*, model: str, contents: list[Any], config: Any, operation: str) -> Any:
+    """generate_content を呼び出し、モデル別の所要時間を記録する。"""
+
+    with tracing.span(f"gemini {operation}", **{"gen_ai.request.model": model, "app.model_backend": model_backend()}) as span:
+        if span is not None:
+            sizes = [_content_size(item) for item in contents]
+            tracing.set_attributes(
+                span,
+                **{
+                    "app.input_images": sum(count for count, _ in sizes),
+                    "app.input_bytes": sum(size for _, size in sizes),
+                },
+            )
+        with metrics.timed(metrics.MODEL_CALL_LATENCY, model=model, operation=operation):
+            response = _client().models.generate_content(model=model, contents=contents, config=config)
+        if span is not None:
+            tracing.set_attributes(span, **{"app.output_bytes": _response_bytes(response)})
+        return response
+
+
 class GeneratedImage:
-    """生成画像のメタデータと利用しやすい表現をまとめたコンテナ。"""
+    """生成画像のメタデータと利用しやすい表現をまとめたコンテナ。
+
+    幅・高さはヘッダーだけを読んで求め、画素のデコードは `image` に
+    初めてアクセスしたとき（サムネイル生成や合成など）まで遅延する。
+    """
 
-    image: Image.Image
-    raw_bytes: bytes
-    mime_type: str
-    prompt: str
+    def __init__(
+        self,
+        *,
+        raw_bytes: bytes,
+        mime_type: str,
+        prompt: str,
+        image: Optional[Image.Image] = None,
+    ) -> None:
+        self.raw_bytes = raw_bytes
+        self.mime_type = mime_type
+        self.prompt = prompt
+        self._image = image
+        self._size: Optional[tuple[int, int]] = image.size if image is not None else None
+
+    @classmethod
+    def probe(cls, *, raw_bytes: bytes, mime_type: str, prompt: str) -> "GeneratedImage":
+        """ヘッダーのみを読んでサイズを確定させる。画像として解釈できなければ例外を送出する。"""
+
+        generated = cls(raw_bytes=raw_bytes, mime_type=mime_type, prompt=prompt)
+        _ = generated.size
+        return generated
+
+    @property
+    def size(self) -> tuple[int, int]:
+        if self._size is None:
+            # Image.open はヘッダーだけを読み、画素は load() まで展開しない
+            with Image.open(BytesIO(self.raw_bytes)) as header:
+                self._size = header.size
+        return self._size
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def image(self) -> Image.Image:
+        """デコード済みの画像。初回アクセス時に全画素を展開する。"""
+
+        if self._image is None:
+            decoded = Image.open(BytesIO(self.raw_bytes))
+            decoded.load()
+            self._image = decoded
+        return self._image
 
 
 def generate_text(prompt: str) -> str:
     """プロンプトからテキスト応答を生成する。"""
 
-    response = _client().models.generate_content(
+    response = _generate_content(
         model=DEFAULT_TEXT_MODEL,
         contents=[prompt],
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
+        config=_types().GenerateContentConfig(response_modalities=["TEXT"]),
+        operation="generate_text",
     )
 
     if getattr(response, "text", None):
@@ -76,10 +217,11 @@ def generate_multimodal_text(prompt: str, images: list[Image.Image]) -> str:
     contents: list[Any] = [prompt]
     contents.extend(images)
 
-    response = _client().models.generate_content(
+    response = _generate_content(
         model=DEFAULT_TEXT_MODEL,
         contents=contents,
-        config=types.GenerateContentConfig(response_modalities=["TEXT"]),
+        config=_types().GenerateContentConfig(response_modalities=["TEXT"]),
+        operation="generate_multimodal_text",
     )
 
     if getattr(response, "text", None):
@@ -122,6 +264,7 @@ def generate_image(
     image: Image.Image,
     aspect_ratio: Optional[str] = None,
     resolution: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
 ) -> GeneratedImage:
     """
     プロンプトと画像を使って Gemini 3 Pro Image Preview を叩く関数。
@@ -131,6 +274,7 @@ def generate_image(
         image: ラフ絵 (PIL Image)。
         aspect_ratio: "1:1" / "4:5" / "16:9" など。None の場合はモデル任せ。
         resolution: "1K" / "2K" / "4K" または UI ラベル ("720p" / "1080p" / "2K")。
+        timer: 指定時は model_call / response_decode（ヘッダー解析のみ）の所要時間を記録する。
     """
 
     # 公式ドキュメントに合わせて image_config で制御する 
@@ -147,13 +291,15 @@ def generate_image(
         "response_modalities": ["TEXT", "IMAGE"],
     }
     if image_config_kwargs:
-        config_kwargs["image_config"] = types.ImageConfig(**image_config_kwargs)
+        config_kwargs["image_config"] = _types().ImageConfig(**image_config_kwargs)
 
-    response = _client().models.generate_content(
-        model=DEFAULT_IMAGE_MODEL,
-        contents=[prompt, image],
-        config=types.GenerateContentConfig(**config_kwargs),
-    )
+    with stage(timer, "model_call"):
+        response = _generate_content(
+            model=DEFAULT_IMAGE_MODEL,
+            contents=[prompt, image],
+            config=_types().GenerateContentConfig(**config_kwargs),
+            operation="generate_image",
+        )
 
     image_bytes: Optional[bytes] = None
     mime_type: str = "image/png"
@@ -173,19 +319,13 @@ def generate_image(
     if image_bytes is None:
         raise RuntimeError("APIレスポンスに画像データが含まれていません。")
 
-    byte_stream = BytesIO(image_bytes)
-    generated_image: Image.Image = Image.open(byte_stream)
-    generated_image.load()
+    with stage(timer, "response_decode"):
+        generated = GeneratedImage.probe(raw_bytes=image_bytes, mime_type=mime_type, prompt=prompt)
 
     # ここでファイル保存したければコメントを外す
-    # generated_image.save("generated_image.png")
+    # generated.image.save("generated_image.png")
 
-    return GeneratedImage(
-        image=generated_image,
-        raw_bytes=image_bytes,
-        mime_type=mime_type,
-        prompt=prompt,
-    )
+    return generated
 
 
 def generate_image_with_contents(
@@ -194,6 +334,7 @@ def generate_image_with_contents(
     prompt_for_record: str,
     aspect_ratio: Optional[str] = None,
     resolution: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
 ) -> GeneratedImage:
     if not contents:
         raise ValueError("contents must not be empty")
@@ -210,13 +351,15 @@ def generate_image_with_contents(
         "response_modalities": ["TEXT", "IMAGE"],
     }
     if image_config_kwargs:
-        config_kwargs["image_config"] = types.ImageConfig(**image_config_kwargs)
+        config_kwargs["image_config"] = _types().ImageConfig(**image_config_kwargs)
 
-    response = _client().models.generate_content(
-        model=DEFAULT_IMAGE_MODEL,
-        contents=contents,
-        config=types.GenerateContentConfig(**config_kwargs),
-    )
+    with stage(timer, "model_call"):
+        response = _generate_content(
+            model=DEFAULT_IMAGE_MODEL,
+            contents=contents,
+            config=_types().GenerateContentConfig(**config_kwargs),
+            operation="generate_image",
+        )
 
     image_bytes: Optional[bytes] = None
     mime_type: str = "image/png"
@@ -234,16 +377,12 @@ def generate_image_with_contents(
     if image_bytes is None:
         raise RuntimeError("APIレスポンスに画像データが含まれていません。")
 
-    byte_stream = BytesIO(image_bytes)
-    generated_image: Image.Image = Image.open(byte_stream)
-    generated_image.load()
-
-    return GeneratedImage(
-        image=generated_image,
-        raw_bytes=image_bytes,
-        mime_type=mime_type,
-        prompt=prompt_for_record,
-    )
+    with stage(timer, "response_decode"):
+        return GeneratedImage.probe(
+            raw_bytes=image_bytes,
+            mime_type=mime_type,
+            prompt=prompt_for_record,
+        )
 
 
 def generate_image_with_images(
@@ -251,6 +390,7 @@ def generate_image_with_images(
     images: list[Image.Image],
     aspect_ratio: Optional[str] = None,
     resolution: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
 ) -> GeneratedImage:
     """
     プロンプトと複数画像を使って Gemini 3 Pro Image Preview を叩く関数。
@@ -270,6 +410,7 @@ def generate_image_with_images(
         prompt_for_record=prompt,
         aspect_ratio=aspect_ratio,
         resolution=resolution,
+        timer=timer,
     )
 
 
@@ -282,7 +423,7 @@ def _pil_to_types_image(image: Image.Image, *, mime_type: str = "image/png") ->
         "image/jpg": "JPEG",
     }
     image.save(buffer, format=format_map.get(mime_type, "PNG"))
-    return types.Image(image_bytes=buffer.getvalue(), mime_type=mime_type)
+    return _types().Image(image_bytes=buffer.getvalue(), mime_type=mime_type)
 
 
 def edit_image_with_mask(
@@ -292,6 +433,7 @@ def edit_image_with_mask(
     mask_image: Image.Image,
     edit_mode: str,
     aspect_ratio: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
 ) -> GeneratedImage:
     """
     Apply inpaint/outpaint by sending base + mask as two images to Gemini API.
@@ -314,4 +456,5 @@ def edit_image_with_mask(
         prompt=combined_prompt,
         images=[base_image, mask_image],
         aspect_ratio=aspect_ratio,
+        timer=timer,
     )
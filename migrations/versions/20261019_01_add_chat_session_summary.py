@@ -0,0 +1,33 @@
+"""チャットセッションに履歴要約カラムを追加する。
+
+リビジョンID: 20261019_01_add_chat_session_summary
+親リビジョン: 20260203_02_add_chat_tables
+作成日時: 2026-10-19 10:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+BIGINT = sa.BigInteger().with_variant(sa.Integer(), "sqlite")
+
+# Alembic 用の識別子
+revision = "20261019_01_add_chat_session_summary"
+down_revision = "20260203_02_add_chat_tables"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """要約テキストと要約済みメッセージIDを追加する。"""
+    with op.batch_alter_table("chat_sessions") as batch_op:
+        batch_op.add_column(sa.Column("summary", sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column("summary_message_id", BIGINT, nullable=True))
+
+
+def downgrade() -> None:
+    """要約関連カラムを削除する。"""
+    with op.batch_alter_table("chat_sessions") as batch_op:
+        batch_op.drop_column("summary_message_id")
+        batch_op.drop_column("summary")
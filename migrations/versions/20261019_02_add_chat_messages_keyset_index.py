@@ -0,0 +1,31 @@
+"""チャットメッセージのキーセットページング用インデックスを追加する。
+
+リビジョンID: 20261019_02_add_chat_messages_keyset_index
+親リビジョン: 20261019_01_add_chat_session_summary
+作成日時: 2026-10-19 11:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+# Alembic 用の識別子
+revision = "20261019_02_add_chat_messages_keyset_index"
+down_revision = "20261019_01_add_chat_session_summary"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """(session_id, id) の複合インデックスを作成する。"""
+    op.create_index(
+        "ix_chat_messages_session_id_id",
+        "chat_messages",
+        ["session_id", "id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """(session_id, id) の複合インデックスを削除する。"""
+    op.drop_index("ix_chat_messages_session_id_id", table_name="chat_messages")
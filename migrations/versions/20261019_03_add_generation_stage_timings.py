@@ -0,0 +1,32 @@
+"""生成履歴に段階別の所要時間カラムを追加する。
+
+リビジョンID: 20261019_03_add_generation_stage_timings
+親リビジョン: 20261019_02_add_chat_messages_keyset_index
+作成日時: 2026-10-19 12:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+# Alembic 用の識別子
+revision = "20261019_03_add_generation_stage_timings"
+down_revision = "20261019_02_add_chat_messages_keyset_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """stage_timings(JSON) を追加する。"""
+    with op.batch_alter_table("generations") as batch_op:
+        batch_op.add_column(
+            sa.Column("stage_timings", sa.JSON().with_variant(mysql.JSON(), "mysql"), nullable=True)
+        )
+
+
+def downgrade() -> None:
+    """stage_timings を削除する。"""
+    with op.batch_alter_table("generations") as batch_op:
+        batch_op.drop_column("stage_timings")
@@ -0,0 +1,36 @@
+"""生成画像に保存状態（後追いアップロード待ちか）カラムを追加する。
+
+リビジョンID: 20261019_04_add_generation_asset_storage_state
+親リビジョン: 20261019_03_add_generation_stage_timings
+作成日時: 2026-10-19 13:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+# Alembic 用の識別子
+revision = "20261019_04_add_generation_asset_storage_state"
+down_revision = "20261019_03_add_generation_stage_timings"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """storage_state を追加する（既存行は stored）。"""
+    with op.batch_alter_table("generation_assets") as batch_op:
+        batch_op.add_column(
+            sa.Column("storage_state", sa.String(length=16), nullable=False, server_default="stored")
+        )
+        batch_op.create_check_constraint(
+            "ck_generation_assets_storage_state",
+            "storage_state IN ('pending','stored')",
+        )
+
+
+def downgrade() -> None:
+    """storage_state を削除する。"""
+    with op.batch_alter_table("generation_assets") as batch_op:
+        batch_op.drop_constraint("ck_generation_assets_storage_state", type_="check")
+        batch_op.drop_column("storage_state")
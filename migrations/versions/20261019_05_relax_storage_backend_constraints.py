@@ -0,0 +1,45 @@
+"""保存先バックエンドの CHECK 制約を登録制バックエンド向けに緩める。
+
+リビジョンID: 20261019_05_relax_storage_backend_constraints
+親リビジョン: 20261019_04_add_generation_asset_storage_state
+作成日時: 2026-10-19 14:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+# Alembic 用の識別子
+revision = "20261019_05_relax_storage_backend_constraints"
+down_revision = "20261019_04_add_generation_asset_storage_state"
+branch_labels = None
+depends_on = None
+
+_TABLES = (
+    ("generation_assets", "ck_generation_assets"),
+    ("chat_attachments", "ck_chat_attachments"),
+)
+
+
+def upgrade() -> None:
+    """local/gcs 固定の制約を外し、リモート（gcs/s3）の必須項目チェックに置き換える。"""
+    for table, prefix in _TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(f"{prefix}_storage", type_="check")
+            batch_op.drop_constraint(f"{prefix}_gcs_required_fields", type_="check")
+            batch_op.create_check_constraint(
+                f"{prefix}_remote_required_fields",
+                "(storage_backend NOT IN ('gcs','s3')) OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
+            )
+
+
+def downgrade() -> None:
+    """local/gcs 固定の制約へ戻す（local/gcs 以外の行が残っていると失敗する）。"""
+    for table, prefix in _TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(f"{prefix}_remote_required_fields", type_="check")
+            batch_op.create_check_constraint(f"{prefix}_storage", "storage_backend IN ('local','gcs')")
+            batch_op.create_check_constraint(
+                f"{prefix}_gcs_required_fields",
+                "(storage_backend != 'gcs') OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
+            )
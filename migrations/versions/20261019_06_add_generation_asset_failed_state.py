@@ -0,0 +1,36 @@
+"""生成画像の保存状態に failed（アップロード前にスプールが失われた）を追加する。
+
+リビジョンID: 20261019_06_add_generation_asset_failed_state
+親リビジョン: 20261019_05_relax_storage_backend_constraints
+作成日時: 2026-10-19 15:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+# Alembic 用の識別子
+revision = "20261019_06_add_generation_asset_failed_state"
+down_revision = "20261019_05_relax_storage_backend_constraints"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """storage_state の CHECK 制約に failed を加える。"""
+    with op.batch_alter_table("generation_assets") as batch_op:
+        batch_op.drop_constraint("ck_generation_assets_storage_state", type_="check")
+        batch_op.create_check_constraint(
+            "ck_generation_assets_storage_state",
+            "storage_state IN ('pending','stored','failed')",
+        )
+
+
+def downgrade() -> None:
+    """failed を除いた制約へ戻す（failed の行が残っていると失敗する）。"""
+    with op.batch_alter_table("generation_assets") as batch_op:
+        batch_op.drop_constraint("ck_generation_assets_storage_state", type_="check")
+        batch_op.create_check_constraint(
+            "ck_generation_assets_storage_state",
+            "storage_state IN ('pending','stored')",
+        )
@@ -24,6 +24,7 @@ from sqlalchemy.orm import relationship
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from extensions import db, login_manager
+from services import user_cache
 
 BIGINT = BigInteger().with_variant(Integer, "sqlite")
 
@@ -81,6 +82,18 @@ class User(db.Model, UserMixin):
 
         return self.role == "admin"
 
+    def to_snapshot(self) -> user_cache.UserSnapshot:
+        """ログインセッション用の不変スナップショットを作る。"""
+
+        return user_cache.UserSnapshot(
+            id=self.id,
+            username=self.username,
+            email=self.email,
+            role=self.role,
+            is_active=bool(self.is_active),
+            is_initial_user=self.is_initial_user,
+        )
+
 
 class Preset(db.Model):
     """
@@ -146,6 +159,8 @@ class Generation(db.Model):
     started_at = db.Column(DateTime, nullable=True)
     finished_at = db.Column(DateTime, nullable=True)
     duration_ms = db.Column(BIGINT, nullable=True)
+    # 段階別の所要時間(ms)。例: {"upload_read": 3, "decode": 41, "model_call": 18250, ...}
+    stage_timings = db.Column(JSON().with_variant(MySQLJSON, "mysql"), nullable=True)
 
     # プロンプトは保存しない要件なので、ここには持たない
     # エラーは残す
@@ -183,7 +198,7 @@ class GenerationAsset(db.Model):
     id = db.Column(BIGINT, primary_key=True)
     generation_id = db.Column(BIGINT, ForeignKey("generations.id"), nullable=False)
 
-    # local / gcs
+    # services.storage_backends に登録した名前（local / gcs / s3 / memory など）
     storage_backend = db.Column(String(16), nullable=False, default="gcs")
 
     # GCSの場合：bucket と object_name を持つ（署名URLは都度生成する想定）
@@ -196,6 +211,10 @@ class GenerationAsset(db.Model):
     height = db.Column(BIGINT, nullable=True)
     sha256 = db.Column(String(64), nullable=True)
 
+    # stored: ストレージ保存済み / pending: ローカルスプールに置いたまま後追いアップロード待ち
+    # failed: アップロード前にスプールが失われた（インスタンス停止など）
+    storage_state = db.Column(String(16), nullable=False, default="stored", server_default="stored")
+
     # 将来の削除に備えたソフトデリート
     deleted_at = db.Column(DateTime, nullable=True)
 
@@ -204,10 +223,12 @@ class GenerationAsset(db.Model):
     generation = relationship("Generation", back_populates="assets")
 
     __table_args__ = (
-        CheckConstraint("storage_backend IN ('local','gcs')", name="ck_generation_assets_storage"),
         CheckConstraint(
-            "(storage_backend != 'gcs') OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
-            name="ck_generation_assets_gcs_required_fields",
+            "storage_state IN ('pending','stored','failed')", name="ck_generation_assets_storage_state"
+        ),
+        CheckConstraint(
+            "(storage_backend NOT IN ('gcs','s3')) OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
+            name="ck_generation_assets_remote_required_fields",
         ),
         Index("ix_generation_assets_generation_id", "generation_id"),
         Index("ix_generation_assets_sha256", "sha256"),
@@ -222,6 +243,12 @@ class ChatSession(db.Model):
     id = db.Column(BIGINT, primary_key=True)
     user_id = db.Column(BIGINT, ForeignKey("users.id"), nullable=False)
     title = db.Column(String(120), nullable=False)
+
+    # 古い履歴を畳み込んだ要約（プロンプトは「要約＋直近ウィンドウ」で組み立てる）
+    summary = db.Column(Text, nullable=True)
+    # 要約へ畳み込み済みの最終メッセージID（これ以下のメッセージは summary に含まれる）
+    summary_message_id = db.Column(BIGINT, nullable=True)
+
     created_at = db.Column(DateTime, nullable=False, server_default=func.now())
     updated_at = db.Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
 
@@ -256,6 +283,7 @@ class ChatMessage(db.Model):
     __table_args__ = (
         CheckConstraint("role IN ('user','assistant','system')", name="ck_chat_messages_role"),
         Index("ix_chat_messages_session_created_at", "session_id", "created_at"),
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
     )
 
 
@@ -282,19 +310,33 @@ class ChatAttachment(db.Model):
     message = relationship("ChatMessage", back_populates="attachments")
 
     __table_args__ = (
-        CheckConstraint("storage_backend IN ('local','gcs')", name="ck_chat_attachments_storage"),
         CheckConstraint(
-            "(storage_backend != 'gcs') OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
-            name="ck_chat_attachments_gcs_required_fields",
+            "(storage_backend NOT IN ('gcs','s3')) OR (bucket IS NOT NULL AND object_name IS NOT NULL)",
+            name="ck_chat_attachments_remote_required_fields",
         ),
         Index("ix_chat_attachments_message_id", "message_id"),
     )
 
 
 @login_manager.user_loader
-def load_user(user_id: str) -> Optional[User]:
-    """ログインセッションからユーザーを復元する。"""
+def load_user(user_id: str) -> Optional[User | user_cache.UserSnapshot]:
+    """ログインセッションからユーザーを復元する。
+
+    USER_CACHE_TTL_SECONDS が正の値なら、TTL 内はプロセス内キャッシュのスナップショットを返し
+    users テーブルを参照しない。0 以下ならキャッシュを使わず毎回DBから読む。
+    """
 
     if not user_id:
         return None
-    return User.query.get(int(user_id))
+    user_key = int(user_id)
+    ttl_seconds = float(current_app.config.get("USER_CACHE_TTL_SECONDS") or 0)
+    if ttl_seconds <= 0:
+        return db.session.get(User, user_key)
+
+    cached = user_cache.get(user_key, ttl_seconds)
+    if cached is not None:
+        return cached
+    user = db.session.get(User, user_key)
+    if user is None:
+        return None
+    return user_cache.put(user.to_snapshot())
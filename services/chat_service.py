@@ -1,17 +1,26 @@
 ﻿from __future__ import annotations
 
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, TypeVar
 
-from flask import current_app
+from flask import Flask, current_app
 from PIL import Image
+from sqlalchemy import Row, and_, or_
+from sqlalchemy.orm import selectinload
 from werkzeug.datastructures import FileStorage
 
 from extensions import db
 from illust import generate_multimodal_text, generate_text
 from models import ChatAttachment, ChatMessage, ChatSession
-from services import storage
-from services.generation_service import decode_image_bytes, mime_type_for_image, read_uploaded_bytes
+from services import metrics, storage
+from services.generation_service import (
+    GenerationError,
+    decode_image_stream,
+    mime_type_for_image,
+    submit_model_call,
+)
 
 
 @dataclass(frozen=True)
@@ -35,6 +44,20 @@ CHAT_MODES: list[ChatMode] = [
     CHAT_MODE_TEXT,
 ]
 
+_HISTORY_BATCH_SIZE = 20
+# 1回の要約更新で畳み込むメッセージ数の上限（残りは次のターンで畳み込む）
+_SUMMARY_FOLD_LIMIT = 200
+
+# 要約更新はリクエスト外で実行する（同一セッションは同時に1件まで）
+_summary_executor: Optional[ThreadPoolExecutor] = None
+_summary_lock = threading.Lock()
+_summary_in_flight: set[int] = set()
+# 添付画像の取り込み（デコード・保存）を並列に行うプール（プロセス全体で同時実行数を制限する）
+_attachment_pool: Optional[ThreadPoolExecutor] = None
+_attachment_lock = threading.Lock()
+
+_R = TypeVar("_R")
+
 
 @dataclass
 class StoredAttachment:
@@ -51,6 +74,46 @@ class StoredAttachment:
     sha256: str
 
 
+@dataclass
+class IngestedImage:
+    """保存済みの添付画像と、モデル入力用にデコードした画像。"""
+
+    attachment: StoredAttachment
+    image: Image.Image
+
+
+@dataclass
+class DecodedUpload:
+    """検証・デコード済みで、まだ保存していない添付画像。"""
+
+    file: FileStorage
+    mime_type: str
+    width: int
+    height: int
+    image: Image.Image
+
+
+@dataclass(frozen=True)
+class AttachmentError:
+    """添付画像ごとの失敗内容。"""
+
+    index: int
+    filename: str | None
+    message: str
+
+
+class AttachmentIngestError(GenerationError):
+    """添付画像の一部が検証・保存に失敗した場合の例外。"""
+
+    def __init__(self, errors: list[AttachmentError], *, label: str = "添付画像") -> None:
+        messages = [
+            error.message if error.message.startswith(label) else f"{label}{error.index + 1}: {error.message}"
+            for error in errors
+        ]
+        super().__init__(" / ".join(messages))
+        self.errors = errors
+
+
 def _storage_backend() -> str:
     return (current_app.config.get("CHAT_IMAGE_STORAGE") or "local").strip().lower()
 
@@ -70,49 +133,189 @@ def _extension_for_mime(mime_type: str) -> str:
 def save_uploaded_image(file: Optional[FileStorage], *, label: str) -> StoredAttachment:
     """アップロード画像を保存して添付情報を返す。"""
 
-    raw_bytes, filename, mime_type = read_uploaded_bytes(file, label=label, reset_stream=True)
-    image = decode_image_bytes(
-        raw_bytes,
+    return _store_decoded_upload(_decode_upload(file, label=label))
+
+
+def _decode_upload(file: Optional[FileStorage], *, label: str) -> DecodedUpload:
+    if file is None or file.filename == "":
+        raise GenerationError(f"{label}を選択してください。")
+    # アップロード本体は bytes に読み出さず、ストリームのまま検証する
+    image = decode_image_stream(
+        file.stream,
         label=label,
-        filename=filename,
-        mime_type=mime_type,
+        filename=file.filename,
+        mime_type=file.mimetype,
         convert_to_rgb=False,
     )
-    stored = storage.save_bytes(
-        raw_bytes=raw_bytes,
-        extension=_extension_for_mime(mime_type_for_image(image)),
+    # 保存時に先頭から読み直せるよう戻す
+    file.stream.seek(0)
+    width, height = image.size
+    return DecodedUpload(
+        file=file,
+        mime_type=mime_type_for_image(image),
+        width=width,
+        height=height,
+        # 検証時にデコード済みの画素を使い回し、モデル入力用に読み直さない
+        image=image if image.mode == "RGB" else image.convert("RGB"),
+    )
+
+
+def _store_decoded_upload(upload: DecodedUpload) -> StoredAttachment:
+    stored = storage.save_stream(
+        stream=upload.file.stream,
+        extension=_extension_for_mime(upload.mime_type),
         storage_backend=_storage_backend(),
         bucket_name=_bucket_name(),
         local_dir_key="CHAT_IMAGE_DIR",
         default_local_dir="chat_images",
         object_prefix="chat_images",
-        content_type=mime_type_for_image(image),
+        content_type=upload.mime_type,
     )
-    width, height = image.size
+    upload.file.stream.seek(0)
     return StoredAttachment(
         kind="image",
         storage_backend=stored.storage_backend,
         bucket=stored.bucket,
         object_name=stored.object_name,
-        mime_type=mime_type_for_image(image),
+        mime_type=upload.mime_type,
         byte_size=stored.byte_size,
-        width=width,
-        height=height,
+        width=upload.width,
+        height=upload.height,
         sha256=stored.sha256,
     )
 
 
-def load_chat_image_bytes(attachment: ChatAttachment) -> Optional[bytes]:
-    """添付画像のバイト列を取得する。"""
+def _attachment_executor() -> ThreadPoolExecutor:
+    global _attachment_pool
+    with _attachment_lock:
+        if _attachment_pool is None:
+            workers = max(int(current_app.config.get("CHAT_ATTACHMENT_WORKERS", 4)), 1)
+            _attachment_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-attachment")
+        return _attachment_pool
+
+
+def _run_in_app(app: Flask, work: Callable[..., _R], *args) -> _R:
+    with app.app_context():
+        return work(*args)
+
+
+def _map_attachments(work: Callable[..., _R], arguments: list[tuple]) -> list[_R | Exception]:
+    """添付画像ごとの処理をプールで並列に実行し、入力順に結果（または例外）を返す。"""
+
+    app = current_app._get_current_object()
+    if len(arguments) == 1:
+        # 1枚だけならスレッドへ渡すオーバーヘッドを避ける
+        try:
+            return [_run_in_app(app, work, *arguments[0])]
+        except Exception as exc:  # noqa: BLE001
+            return [exc]
+
+    executor = _attachment_executor()
+    futures = [executor.submit(_run_in_app, app, work, *args) for args in arguments]
+    outcomes: list[_R | Exception] = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as exc:  # noqa: BLE001
+            outcomes.append(exc)
+    return outcomes
+
+
+def _raise_attachment_errors(files: list[FileStorage], outcomes: list, *, label: str) -> None:
+    errors = [
+        AttachmentError(index=index, filename=files[index].filename, message=_attachment_error_message(outcome))
+        for index, outcome in enumerate(outcomes)
+        if isinstance(outcome, Exception)
+    ]
+    if not errors:
+        return
+    for outcome in outcomes:
+        if isinstance(outcome, Exception) and not isinstance(outcome, GenerationError):
+            # 入力起因でない失敗は従来どおり 500 系として扱う
+            raise outcome
+    raise AttachmentIngestError(errors, label=label)
+
+
+def decode_uploaded_images(files: list[FileStorage], *, label: str = "添付画像") -> list[DecodedUpload]:
+    """
+    添付画像の検証・デコードをスレッドプールで並列に行う（保存はしない）。
+
+    結果は files と同じ順序で返す。失敗したファイルがあれば AttachmentIngestError を送出する。
+    """
+
+    if not files:
+        return []
+    outcomes = _map_attachments(
+        lambda file, file_label: _decode_upload(file, label=file_label),
+        [(file, f"{label}{index + 1}") for index, file in enumerate(files)],
+    )
+    _raise_attachment_errors(files, outcomes, label=label)
+    return outcomes
+
+
+def store_decoded_images(uploads: list[DecodedUpload], *, label: str = "添付画像") -> list[StoredAttachment]:
+    """
+    デコード済みの添付画像をスレッドプールで並列に保存する。
+
+    1件でも失敗した場合は保存済みの画像を削除してから AttachmentIngestError を送出する。
+    """
+
+    if not uploads:
+        return []
+    outcomes = _map_attachments(_store_decoded_upload, [(upload,) for upload in uploads])
+    if any(isinstance(outcome, Exception) for outcome in outcomes):
+        for outcome in outcomes:
+            if isinstance(outcome, StoredAttachment):
+                _discard_attachment(outcome)
+        _raise_attachment_errors([upload.file for upload in uploads], outcomes, label=label)
+    return outcomes
+
+
+def ingest_uploaded_images(files: list[FileStorage], *, label: str = "添付画像") -> list[IngestedImage]:
+    """
+    添付画像の検証・デコード・保存をスレッドプールで並列に行う。
+
+    結果は files と同じ順序で返す。1件でも失敗した場合は保存済みの画像を削除し、
+    失敗したファイルごとの内容を AttachmentIngestError にまとめて送出する。
+    """
+
+    uploads = decode_uploaded_images(files, label=label)
+    attachments = store_decoded_images(uploads, label=label)
+    return [
+        IngestedImage(attachment=attachment, image=upload.image)
+        for upload, attachment in zip(uploads, attachments)
+    ]
+
+
+def _attachment_error_message(exc: Exception) -> str:
+    return str(exc) if isinstance(exc, GenerationError) else "添付画像の保存に失敗しました。"
+
+
+def _discard_attachment(attachment: StoredAttachment) -> None:
+    try:
+        storage.delete_bytes(
+            storage_backend=attachment.storage_backend,
+            bucket_name=attachment.bucket,
+            object_name=attachment.object_name,
+            local_dir_key="CHAT_IMAGE_DIR",
+            default_local_dir="chat_images",
+        )
+    except Exception as exc:  # noqa: BLE001
+        current_app.logger.warning("Failed to discard attachment %s: %s", attachment.object_name, exc)
+
+
+def open_chat_image(attachment: ChatAttachment) -> Optional[BinaryIO]:
+    """添付画像を配信用に開く。"""
 
     if not attachment.object_name:
         return None
-    return storage.load_bytes(
+    return storage.open_object(
         storage_backend=attachment.storage_backend,
         bucket_name=attachment.bucket,
         object_name=attachment.object_name,
         local_dir_key="CHAT_IMAGE_DIR",
         default_local_dir="chat_images",
+        expected_sha256=attachment.sha256,
     )
 
 
@@ -125,6 +328,39 @@ def create_session(user_id: int, *, title: str) -> ChatSession:
     return session
 
 
+def list_session_rows(
+    user_id: int,
+    *,
+    before_id: Optional[int] = None,
+    limit: int = 30,
+) -> tuple[list[Row], bool]:
+    """セッション一覧を更新日時の新しい順にキーセットページングで取得する。
+
+    ORMオブジェクトは組み立てず (id, title, updated_at) の行だけを返す。
+    カーソルは直前ページ最後のセッションIDで、その行の updated_at をサブクエリで引いて
+    (updated_at, id) の複合キーで比較する（DBに保存された値同士で比較するため方言差が出ない）。
+    """
+
+    query = db.session.query(ChatSession.id, ChatSession.title, ChatSession.updated_at).filter(
+        ChatSession.user_id == user_id
+    )
+    if before_id is not None:
+        anchor = (
+            db.session.query(ChatSession.updated_at)
+            .filter(ChatSession.id == before_id, ChatSession.user_id == user_id)
+            .scalar_subquery()
+        )
+        query = query.filter(
+            or_(
+                ChatSession.updated_at < anchor,
+                and_(ChatSession.updated_at == anchor, ChatSession.id < before_id),
+            )
+        )
+    rows = query.order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    return rows[:limit], has_more
+
+
 def touch_session(session: ChatSession) -> None:
     """セッションの更新日時を更新する。"""
 
@@ -180,25 +416,97 @@ def add_message(
     return message
 
 
-def fetch_recent_text_history(session: ChatSession, *, limit: int = 8) -> list[ChatMessage]:
-    """直近のテキスト履歴を取得する。"""
+def fetch_message_page(
+    session: ChatSession,
+    *,
+    before_id: Optional[int] = None,
+    limit: int = 30,
+) -> tuple[list[ChatMessage], bool]:
+    """メッセージを新しい側からキーセットページングで取得する。
 
-    return (
-        ChatMessage.query.filter_by(session_id=session.id)
-        .filter(ChatMessage.text.isnot(None))
-        .order_by(ChatMessage.created_at.desc())
-        .limit(limit)
-        .all()[::-1]
+    `before_id` より古いメッセージを最大 `limit` 件、古い順で返す。
+    添付は selectinload で1クエリにまとめて読み込む。戻り値の2要素目はさらに古いページの有無。
+    """
+
+    query = ChatMessage.query.options(selectinload(ChatMessage.attachments)).filter(
+        ChatMessage.session_id == session.id
     )
+    if before_id is not None:
+        query = query.filter(ChatMessage.id < before_id)
+    rows = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    return rows[:limit][::-1], has_more
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """テキストのトークン数を概算する。
+
+    日本語などの全角文字は1文字1トークン、ASCII系は4文字1トークンとして数える。
+    厳密なトークナイザではなく、プロンプト長の上限管理に使う目安値。
+    """
+
+    if not text:
+        return 0
+    wide = sum(1 for char in text if ord(char) > 0x2E7F)
+    narrow = len(text) - wide
+    return wide + (narrow + 3) // 4
+
+
+def _history_token_budget() -> int:
+    return max(int(current_app.config.get("CHAT_HISTORY_TOKEN_BUDGET", 2000)), 0)
+
+
+def _pending_history_query(session: ChatSession):
+    query = ChatMessage.query.filter_by(session_id=session.id).filter(ChatMessage.text.isnot(None))
+    if session.summary_message_id is not None:
+        query = query.filter(ChatMessage.id > session.summary_message_id)
+    return query
 
 
-def build_text_prompt(history: list[ChatMessage], user_text: str) -> str:
+def _iter_pending_newest_first(session: ChatSession, batch_size: int) -> Iterator[ChatMessage]:
+    """要約済み以降のメッセージを新しい順に、id のキーセットでバッチ取得しながら返す。"""
+
+    query = _pending_history_query(session).order_by(ChatMessage.id.desc())
+    last_id: Optional[int] = None
+    while True:
+        batch_query = query if last_id is None else query.filter(ChatMessage.id < last_id)
+        batch = batch_query.limit(batch_size).all()
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+
+
+def fetch_history_window(
+    session: ChatSession,
+    *,
+    token_budget: Optional[int] = None,
+    batch_size: int = _HISTORY_BATCH_SIZE,
+) -> list[ChatMessage]:
+    """要約済み以降のメッセージから、トークン予算に収まる直近分を古い順で返す。"""
+
+    budget = _history_token_budget() if token_budget is None else token_budget
+    window: list[ChatMessage] = []
+    used = 0
+    for message in _iter_pending_newest_first(session, batch_size):
+        tokens = estimate_tokens(message.text)
+        if used + tokens > budget:
+            break
+        used += tokens
+        window.append(message)
+    return window[::-1]
+
+
+def build_text_prompt(history: list[ChatMessage], user_text: str, *, summary: Optional[str] = None) -> str:
     """テキストチャット用のプロンプトを組み立てる。"""
 
     lines = [
         "You are a helpful assistant for illustration workflows.",
         "Use the prior context if it helps.",
     ]
+    if summary:
+        lines.append("Summary of the earlier conversation:")
+        lines.append(summary)
     for message in history:
         role = "User" if message.role == "user" else "Assistant"
         if message.text:
@@ -209,24 +517,133 @@ def build_text_prompt(history: list[ChatMessage], user_text: str) -> str:
     return "\n".join(lines)
 
 
-def generate_text_reply(session: ChatSession, user_text: str) -> str:
-    """テキストのみの返信を生成する。"""
+def build_summary_prompt(previous_summary: Optional[str], messages: list[ChatMessage], *, max_chars: int) -> str:
+    """既存の要約に古いメッセージを畳み込むためのプロンプトを組み立てる。"""
+
+    lines = [
+        "Update the running summary of a conversation between a user and an assistant",
+        "for illustration workflows. Keep requests, decisions, preferences and open questions.",
+        f"Answer with the updated summary only, in the conversation's language, within {max_chars} characters.",
+        "",
+        "Current summary:",
+        previous_summary or "(none)",
+        "",
+        "New messages to fold into the summary:",
+    ]
+    for message in messages:
+        role = "User" if message.role == "user" else "Assistant"
+        lines.append(f"{role}: {message.text}")
+    return "\n".join(lines)
+
+
+def update_session_summary(session_id: int) -> bool:
+    """予算を超えた古い履歴を要約へ畳み込む。更新した場合は True を返す。
+
+    未要約メッセージの合計が予算を超えたら、直近の予算半分だけを残して残りを要約する。
+    毎ターン要約し直さないよう、ウィンドウが予算いっぱいまで伸びるのを待つ。
+    最新のメッセージとそれと対になるやり取り（最新が返信ならその質問まで）は、
+    単独で予算半分を超えていても畳み込まない。
+    """
+
+    session = db.session.get(ChatSession, session_id)
+    if session is None:
+        return False
+
+    budget = _history_token_budget()
+    keep_budget = budget // 2
+    # 新しい順に数え、直近の予算半分に収まらない最初のメッセージ（fold_from_id）から古い側を畳み込む。
+    # 合計が予算を超えた時点で分割位置は決まっているので、それ以上古いメッセージは読まない。
+    total = 0
+    fold_from_id: Optional[int] = None
+    pinned = True
+    for message in _iter_pending_newest_first(session, _HISTORY_BATCH_SIZE):
+        tokens = estimate_tokens(message.text)
+        if fold_from_id is None and not pinned and total + tokens > keep_budget:
+            fold_from_id = message.id
+        total += tokens
+        if message.role == "user":
+            # 最新の user メッセージまで（＝直近のやり取り）は残す
+            pinned = False
+        if total > budget and fold_from_id is not None:
+            break
+    if total <= budget or fold_from_id is None:
+        return False
+
+    to_fold = (
+        _pending_history_query(session)
+        .filter(ChatMessage.id <= fold_from_id)
+        .order_by(ChatMessage.id.asc())
+        .limit(_SUMMARY_FOLD_LIMIT)
+        .all()
+    )
+    if not to_fold:
+        return False
+
+    max_chars = int(current_app.config.get("CHAT_SUMMARY_MAX_CHARS", 2000))
+    prompt = build_summary_prompt(session.summary, to_fold, max_chars=max_chars)
+    summary = generate_text(prompt).strip()
+    if not summary:
+        return False
+
+    session.summary = summary[:max_chars]
+    session.summary_message_id = to_fold[-1].id
+    db.session.add(session)
+    db.session.commit()
+    return True
+
+
+def _run_summary_update(app: Flask, session_id: int) -> None:
+    try:
+        with app.app_context():
+            try:
+                update_session_summary(session_id)
+            except Exception as exc:  # noqa: BLE001
+                db.session.rollback()
+                app.logger.warning("Chat summary update failed (session=%s): %s", session_id, exc)
+    finally:
+        with _summary_lock:
+            _summary_in_flight.discard(session_id)
+
 
-    history = fetch_recent_text_history(session)
-    if history and history[-1].role == "user" and history[-1].text == user_text:
-        history = history[:-1]
-    prompt = build_text_prompt(history, user_text)
-    return generate_text(prompt)
+def schedule_summary_update(session: ChatSession) -> None:
+    """ターン終了後に要約更新をバックグラウンドで実行する。
+
+    同一セッションの更新が実行中なら重複して投入しない。
+    """
+
+    if not current_app.config.get("CHAT_SUMMARY_ENABLED", True):
+        return
+
+    global _summary_executor
+    session_id = session.id
+    with _summary_lock:
+        if session_id in _summary_in_flight:
+            return
+        _summary_in_flight.add(session_id)
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+        executor = _summary_executor
+    executor.submit(_run_summary_update, current_app._get_current_object(), session_id)
+
+
+def start_multimodal_reply(session: ChatSession, user_text: str, images: list[Image.Image]) -> Future[str]:
+    """
+    履歴の取得とプロンプト組み立てを行い、返信の生成をワーカーで開始する。
+
+    呼び出し側は生成を待つ間に添付画像の保存やメッセージの記録を進められる。
+    """
+
+    with metrics.timed(metrics.PROMPT_BUILD_LATENCY, mode="chat"):
+        # 今回のユーザーメッセージは記録前なので、履歴には含まれない
+        history = fetch_history_window(session)
+        prompt_text = user_text.strip() if user_text.strip() else "Please describe the images."
+        prompt = build_text_prompt(history, prompt_text, summary=session.summary)
+    if images:
+        return submit_model_call(generate_multimodal_text, prompt, images)
+    return submit_model_call(generate_text, prompt)
 
 
 def generate_multimodal_reply(session: ChatSession, user_text: str, images: list[Image.Image]) -> str:
     """画像を含む返信を生成する。"""
 
-    history = fetch_recent_text_history(session)
-    if history and history[-1].role == "user" and history[-1].text == user_text:
-        history = history[:-1]
-    prompt_text = user_text.strip() if user_text.strip() else "Please describe the images."
-    prompt = build_text_prompt(history, prompt_text)
-    if images:
-        return generate_multimodal_text(prompt, images)
-    return generate_text(prompt)
+    return start_multimodal_reply(session, user_text, images).result()
@@ -0,0 +1,330 @@
+"""Gemini の代わりに使う偽のモデルクライアントと、generateContent 互換のローカル HTTP サーバー。
+
+実際の API を呼ばずに負荷試験・レイテンシ計測・リトライの検証を行うためのもの。
+応答時間の分布、エラー（503 / 429 / タイムアウト）の注入、出力画像のサイズを環境変数で指定できる。
+
+- MODEL_BACKEND=fake: illust から FakeModelClient をプロセス内で直接呼ぶ
+- MODEL_BACKEND=http: 本物の google-genai クライアントを MODEL_HTTP_BASE_URL（このサーバー）へ向ける
+
+サーバーの起動:
+    python -m services.fake_model --port 8090 [--latency uniform:0.5,2] [--errors 503:0.05,429:0.02]
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Callable, Optional
+
+from PIL import Image
+
+FAKE_TEXT_REPLY = "This is a fake reply from the stub model."
+
+# 本物の API が返すエラー本文と同じ形
+_ERROR_BODIES: dict[int, dict[str, Any]] = {
+    429: {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"},
+    503: {"code": 503, "message": "The model is overloaded. Please try again later.", "status": "UNAVAILABLE"},
+    504: {"code": 504, "message": "Deadline expired before operation could complete.", "status": "DEADLINE_EXCEEDED"},
+}
+_ERROR_KINDS = ("503", "429", "timeout")
+_IMAGE_SIZE_LONG_EDGE = {"1K": 1024, "2K": 2048, "4K": 4096}
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    応答時間の分布を「種類:パラメーター」で指定する（秒）。
+
+    - constant:S（または数値のみ）
+    - uniform:MIN,MAX
+    - normal:MEAN,STDDEV（負の値は 0 に丸める）
+    - lognormal:MEDIAN,SIGMA（裾の長い分布。実際のモデル応答に近い）
+    """
+
+    kind, _, raw_params = spec.strip().partition(":")
+    if not raw_params:
+        kind, raw_params = "constant", kind
+    try:
+        params = [float(value) for value in raw_params.split(",") if value.strip()]
+    except ValueError as exc:
+        raise ValueError(f"応答時間の指定が不正です: {spec}") from exc
+
+    kind = kind.strip().lower()
+    if kind == "constant" and len(params) == 1:
+        seconds = max(params[0], 0.0)
+        return lambda rng: seconds
+    if kind == "uniform" and len(params) == 2:
+        low, high = params
+        return lambda rng: max(rng.uniform(low, high), 0.0)
+    if kind == "normal" and len(params) == 2:
+        mean, stddev = params
+        return lambda rng: max(rng.gauss(mean, stddev), 0.0)
+    if kind == "lognormal" and len(params) == 2:
+        median, sigma = params
+        mu = math.log(median) if median > 0 else 0.0
+        return lambda rng: rng.lognormvariate(mu, sigma) if median > 0 else 0.0
+    raise ValueError(f"応答時間の指定が不正です: {spec}")
+
+
+def parse_error_rates(spec: str) -> dict[str, float]:
+    """「503:0.05,429:0.02,timeout:0.01」の形式でエラーの発生確率を指定する。"""
+
+    rates: dict[str, float] = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, raw_rate = item.partition(":")
+        kind = kind.strip().lower()
+        if kind not in _ERROR_KINDS:
+            raise ValueError(f"注入できるエラーは {', '.join(_ERROR_KINDS)} です: {kind}")
+        rates[kind] = float(raw_rate)
+    if sum(rates.values()) > 1:
+        raise ValueError("エラーの発生確率の合計が 1 を超えています。")
+    return rates
+
+
+def parse_size(spec: str) -> tuple[int, int]:
+    match = re.fullmatch(r"\s*(\d+)\s*[xX]\s*(\d+)\s*", spec)
+    if not match:
+        raise ValueError(f"画像サイズは WIDTHxHEIGHT で指定してください: {spec}")
+    return int(match.group(1)), int(match.group(2))
+
+
+@lru_cache(maxsize=8)
+def synthetic_png(width: int, height: int) -> bytes:
+    """指定サイズのグラデーション PNG（同じサイズなら毎回同じバイト列）。"""
+
+    horizontal = Image.linear_gradient("L").rotate(90).resize((width, height))
+    vertical = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (horizontal, vertical, Image.new("L", (width, height), 128)))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class InjectedTimeout(TimeoutError):
+    """注入したタイムアウト。"""
+
+
+@dataclass
+class FakeModelBehavior:
+    """偽モデルの振る舞い（応答時間・エラー注入・出力画像サイズ）。"""
+
+    latency: Callable[[random.Random], float] = field(default_factory=lambda: parse_latency("constant:0"))
+    error_rates: dict[str, float] = field(default_factory=dict)
+    timeout_seconds: float = 30.0
+    image_size: tuple[int, int] = (1024, 1024)
+    seed: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeModelBehavior":
+        seed = os.environ.get("FAKE_MODEL_SEED")
+        return cls(
+            latency=parse_latency(os.environ.get("FAKE_MODEL_LATENCY") or "constant:0"),
+            error_rates=parse_error_rates(os.environ.get("FAKE_MODEL_ERRORS") or ""),
+            timeout_seconds=float(os.environ.get("FAKE_MODEL_TIMEOUT_SECONDS") or "30"),
+            image_size=parse_size(os.environ.get("FAKE_MODEL_IMAGE_SIZE") or "1024x1024"),
+            seed=int(seed) if seed else None,
+        )
+
+    def draw(self) -> tuple[float, Optional[str]]:
+        """今回の応答時間（秒）と注入するエラー（なければ None）を決める。"""
+
+        with self._lock:
+            delay = self.latency(self._rng)
+            roll = self._rng.random()
+        threshold = 0.0
+        for kind in _ERROR_KINDS:
+            threshold += self.error_rates.get(kind, 0.0)
+            if roll < threshold:
+                return (self.timeout_seconds if kind == "timeout" else delay), kind
+        return delay, None
+
+    def output_size(self, aspect_ratio: Optional[str], image_size: Optional[str]) -> tuple[int, int]:
+        """要求された解像度・アスペクト比に合わせた出力サイズ。指定がなければ既定サイズ。"""
+
+        long_edge = _IMAGE_SIZE_LONG_EDGE.get((image_size or "").upper())
+        ratio = None
+        if aspect_ratio and ":" in aspect_ratio:
+            width_part, _, height_part = aspect_ratio.partition(":")
+            try:
+                ratio = float(width_part) / float(height_part)
+            except (ValueError, ZeroDivisionError):
+                ratio = None
+        if long_edge is None and ratio is None:
+            return self.image_size
+        long_edge = long_edge or max(self.image_size)
+        ratio = ratio or 1.0
+        if ratio >= 1:
+            return long_edge, max(int(round(long_edge / ratio)), 1)
+        return max(int(round(long_edge * ratio)), 1), long_edge
+
+
+def _api_error(code: int) -> Exception:
+    from google.genai import errors
+
+    payload = {"error": _ERROR_BODIES[code]}
+    error_class = errors.ServerError if code >= 500 else errors.ClientError
+    return error_class(code, payload, None)
+
+
+class FakeModelClient:
+    """
+    google-genai の Client と同じ呼び出し方（client.models.generate_content）ができる偽クライアント。
+
+    応答は本物の GenerateContentResponse で返すので、illust 側の解釈処理はそのまま通る。
+    """
+
+    def __init__(self, behavior: Optional[FakeModelBehavior] = None) -> None:
+        self.behavior = behavior or FakeModelBehavior()
+        self.models = self
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeModelClient":
+        return cls(FakeModelBehavior.from_env())
+
+    def generate_content(self, *, model: str, contents: Any, config: Any = None) -> Any:
+        from google.genai import types
+
+        self.calls += 1
+        delay, error = self.behavior.draw()
+        time.sleep(delay)
+        if error == "timeout":
+            raise InjectedTimeout(f"fake model timed out after {delay:.1f}s")
+        if error:
+            raise _api_error(int(error))
+
+        parts = [types.Part(text=FAKE_TEXT_REPLY)]
+        modalities = [str(value).upper() for value in (getattr(config, "response_modalities", None) or [])]
+        if "IMAGE" in modalities:
+            image_config = getattr(config, "image_config", None)
+            width, height = self.behavior.output_size(
+                getattr(image_config, "aspect_ratio", None),
+                getattr(image_config, "image_size", None),
+            )
+            parts.append(types.Part(inline_data=types.Blob(data=synthetic_png(width, height), mime_type="image/png")))
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts), finish_reason="STOP")]
+        )
+
+
+# --- generateContent 互換の HTTP サーバー ----------------------------------------
+
+_GENERATE_PATH = re.compile(r"^/v1(?:beta|alpha)?/models/(?P<model>[^/:]+):generateContent$")
+
+
+def _handler_for(behavior: FakeModelBehavior) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
+
+        def _send_json(self, status: int, payload: dict[str, Any]) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self) -> None:  # noqa: N802
+            path = self.path.split("?", 1)[0]
+            length = int(self.headers.get("Content-Length") or 0)
+            raw_body = self.rfile.read(length) if length else b""
+            if not _GENERATE_PATH.match(path):
+                self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+            try:
+                request_body = json.loads(raw_body or b"{}")
+            except ValueError:
+                self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "status": "INVALID_ARGUMENT"}})
+                return
+
+            delay, error = behavior.draw()
+            time.sleep(delay)
+            if error:
+                code = 504 if error == "timeout" else int(error)
+                self._send_json(code, {"error": _ERROR_BODIES[code]})
+                return
+
+            generation_config = request_body.get("generationConfig") or {}
+            modalities = [str(value).upper() for value in generation_config.get("responseModalities") or []]
+            parts: list[dict[str, Any]] = [{"text": FAKE_TEXT_REPLY}]
+            if "IMAGE" in modalities:
+                image_config = generation_config.get("imageConfig") or {}
+                width, height = behavior.output_size(image_config.get("aspectRatio"), image_config.get("imageSize"))
+                parts.append(
+                    {
+                        "inlineData": {
+                            "mimeType": "image/png",
+                            "data": base64.b64encode(synthetic_png(width, height)).decode("ascii"),
+                        }
+                    }
+                )
+            self._send_json(
+                200,
+                {
+                    "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP", "index": 0}],
+                    "modelVersion": self.path.split("/models/", 1)[-1].split(":", 1)[0],
+                },
+            )
+
+    return Handler
+
+
+def make_server(host: str = "127.0.0.1", port: int = 0, behavior: Optional[FakeModelBehavior] = None) -> ThreadingHTTPServer:
+    """偽の generateContent サーバーを作る（serve_forever は呼び出し側で行う）。port=0 で空きポート。"""
+
+    server = ThreadingHTTPServer((host, port), _handler_for(behavior or FakeModelBehavior.from_env()))
+    server.daemon_threads = True
+    return server
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="generateContent 互換の偽 Gemini サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", help="応答時間の分布（例: lognormal:8,0.4）。未指定は FAKE_MODEL_LATENCY")
+    parser.add_argument("--errors", help="エラーの発生確率（例: 503:0.05,429:0.02）。未指定は FAKE_MODEL_ERRORS")
+    parser.add_argument("--image-size", help="既定の出力画像サイズ（例: 1024x1024）")
+    parser.add_argument("--seed", type=int, help="乱数シード")
+    args = parser.parse_args(argv)
+
+    behavior = FakeModelBehavior.from_env()
+    if args.latency:
+        behavior.latency = parse_latency(args.latency)
+    if args.errors:
+        behavior.error_rates = parse_error_rates(args.errors)
+    if args.image_size:
+        behavior.image_size = parse_size(args.image_size)
+    if args.seed is not None:
+        behavior._rng.seed(args.seed)
+
+    server = make_server(args.host, args.port, behavior)
+    host, port = server.server_address[:2]
+    print(f"Fake Gemini server listening on http://{host}:{port} (MODEL_BACKEND=http MODEL_HTTP_BASE_URL=http://{host}:{port})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
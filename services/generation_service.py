@@ -2,14 +2,17 @@
 
 import base64
 import binascii
+import os
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Any, BinaryIO, Callable, Mapping, Optional, TypeVar
 
-from flask import current_app
+from flask import Flask, current_app
 from PIL import Image, UnidentifiedImageError
 from werkzeug.datastructures import FileStorage
 
@@ -17,12 +20,14 @@ from extensions import db
 from illust import (
     DEFAULT_IMAGE_MODEL,
     DEFAULT_TEXT_MODEL,
+    GeneratedImage,
     edit_image_with_mask,
     generate_image,
     generate_image_with_contents,
 )
 from models import Generation, GenerationAsset
-from services import storage
+from services import image_codec, metrics, profiling, storage, tracing, upload_spool
+from services.stage_timer import StageTimer, stage
 from services.prompt_builder import (
     build_edit_prompt,
     build_prompt,
@@ -39,6 +44,21 @@ ALLOWED_IMAGE_EXTENSIONS = {
 }
 ALLOWED_IMAGE_LABEL = "PNG/JPEG"
 
+# 保存済み生成画像の再エンコードはリクエスト外の単一ワーカーで行う
+_reencode_executor: Optional[ThreadPoolExecutor] = None
+_reencode_lock = threading.Lock()
+# 後追いアップロード（GENERATION_UPLOAD_MODE=write_behind）用のワーカー
+_upload_executor: Optional[ThreadPoolExecutor] = None
+_upload_lock = threading.Lock()
+# 再エンコードで置き換えた旧オブジェクトの削除待ち（object_name -> 猶予後に削除するタイマー）
+_deferred_deletes: dict[str, threading.Timer] = {}
+_deferred_delete_lock = threading.Lock()
+# モデル呼び出し用のワーカー（呼び出し中にリクエストスレッドで DB 記録・保存を進める）
+_model_executor: Optional[ThreadPoolExecutor] = None
+_model_lock = threading.Lock()
+
+_T = TypeVar("_T")
+
 
 @dataclass
 class GenerationOutcome:
@@ -72,6 +92,10 @@ def extension_for_mime_type(mime_type: str) -> str:
         return ".png"
     if normalized in {"image/jpeg", "image/jpg"}:
         return ".jpg"
+    if normalized == "image/webp":
+        return ".webp"
+    if normalized == "image/avif":
+        return ".avif"
     return ".png"
 
 
@@ -81,10 +105,64 @@ def _limit_value(value: Optional[int]) -> Optional[int]:
     return value if value > 0 else None
 
 
-def _apply_pil_max_image_pixels() -> Optional[int]:
-    max_pixels = _limit_value(current_app.config.get("MAX_IMAGE_PIXELS"))
-    Image.MAX_IMAGE_PIXELS = max_pixels
-    return max_pixels
+@dataclass(frozen=True)
+class ImageLimits:
+    """アップロード画像の幅・高さ・総ピクセル数の上限（None は無制限）。"""
+
+    max_width: Optional[int]
+    max_height: Optional[int]
+    max_pixels: Optional[int]
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "ImageLimits":
+        return cls(
+            max_width=_limit_value(config.get("MAX_IMAGE_WIDTH")),
+            max_height=_limit_value(config.get("MAX_IMAGE_HEIGHT")),
+            max_pixels=_limit_value(config.get("MAX_IMAGE_PIXELS")),
+        )
+
+    def check(self, width: int, height: int, *, label: str) -> None:
+        """ヘッダーから得た寸法が上限内か確認する。超えていれば GenerationError を送出する。"""
+
+        if (self.max_width and width > self.max_width) or (self.max_height and height > self.max_height):
+            parts = []
+            if self.max_width:
+                parts.append(f"最大幅{self.max_width}px")
+            if self.max_height:
+                parts.append(f"最大高さ{self.max_height}px")
+            limit_text = "、".join(parts) if parts else "上限"
+            raise GenerationError(f"{label}のサイズが上限を超えています。{limit_text}までです。")
+
+        if self.max_pixels and width * height > self.max_pixels:
+            raise GenerationError(self.pixel_error(label))
+
+    def pixel_error(self, label: str) -> str:
+        if self.max_pixels:
+            return f"{label}のピクセル数が上限({self.max_pixels}ピクセル)を超えています。"
+        return f"{label}のピクセル数が上限を超えています。"
+
+
+def configure_image_decoder(app: Flask) -> None:
+    """
+    設定から ImageLimits を一度だけ組み立て、PIL の展開上限（Image.MAX_IMAGE_PIXELS）も設定する。
+
+    Image.MAX_IMAGE_PIXELS はプロセス全体の値なので、リクエストごとに書き換えると
+    スレッドワーカー（gthread）で競合する。デコード時には触らない。
+    """
+
+    limits = ImageLimits.from_config(app.config)
+    app.extensions["image_limits"] = limits
+    Image.MAX_IMAGE_PIXELS = limits.max_pixels
+
+
+def image_limits() -> ImageLimits:
+    """現在のアプリの ImageLimits（create_app で組み立て済みのもの）を返す。"""
+
+    limits = current_app.extensions.get("image_limits")
+    if limits is None:
+        limits = ImageLimits.from_config(current_app.config)
+        current_app.extensions["image_limits"] = limits
+    return limits
 
 
 def _validate_upload_metadata(
@@ -131,31 +209,6 @@ def _validate_format_consistency(
             raise GenerationError(f"{label}の拡張子と画像内容が一致しません。{ALLOWED_IMAGE_LABEL}を選択してください。")
 
 
-def _validate_image_dimensions(image: Image.Image, *, label: str) -> None:
-    width, height = image.size
-    max_width = _limit_value(current_app.config.get("MAX_IMAGE_WIDTH"))
-    max_height = _limit_value(current_app.config.get("MAX_IMAGE_HEIGHT"))
-    max_pixels = _limit_value(current_app.config.get("MAX_IMAGE_PIXELS"))
-
-    if (max_width and width > max_width) or (max_height and height > max_height):
-        parts = []
-        if max_width:
-            parts.append(f"最大幅{max_width}px")
-        if max_height:
-            parts.append(f"最大高さ{max_height}px")
-        limit_text = "、".join(parts) if parts else "上限"
-        raise GenerationError(f"{label}のサイズが上限を超えています。{limit_text}までです。")
-
-    if max_pixels and width * height > max_pixels:
-        raise GenerationError(f"{label}のピクセル数が上限({max_pixels}ピクセル)を超えています。")
-
-
-def _pixel_limit_error(label: str, max_pixels: Optional[int]) -> str:
-    if max_pixels:
-        return f"{label}のピクセル数が上限({max_pixels}ピクセル)を超えています。"
-    return f"{label}のピクセル数が上限を超えています。"
-
-
 def read_uploaded_bytes(
     file: Optional[FileStorage],
     *,
@@ -187,7 +240,52 @@ def decode_image_bytes(
 
     if not raw_bytes:
         raise GenerationError(f"{label}が空です。")
+    return _decode_image_source(
+        BytesIO(raw_bytes),
+        label=label,
+        filename=filename,
+        mime_type=mime_type,
+        convert_to_rgb=convert_to_rgb,
+    )
+
 
+def decode_image_stream(
+    stream: BinaryIO,
+    *,
+    label: str = "画像",
+    filename: Optional[str] = None,
+    mime_type: Optional[str] = None,
+    convert_to_rgb: bool = False,
+) -> Image.Image:
+    """ファイルオブジェクトから画像を読み込んで検証する（全体を bytes へ読み出さない）。
+
+    読み込み後はストリーム位置を先頭へ戻す。
+    """
+
+    stream.seek(0, os.SEEK_END)
+    if stream.tell() == 0:
+        raise GenerationError(f"{label}が空です。")
+    stream.seek(0)
+    try:
+        return _decode_image_source(
+            stream,
+            label=label,
+            filename=filename,
+            mime_type=mime_type,
+            convert_to_rgb=convert_to_rgb,
+        )
+    finally:
+        stream.seek(0)
+
+
+def _decode_image_source(
+    source: BinaryIO,
+    *,
+    label: str,
+    filename: Optional[str],
+    mime_type: Optional[str],
+    convert_to_rgb: bool,
+) -> Image.Image:
     extension = _normalize_extension(filename)
     normalized_mime = _normalize_mime_type(mime_type)
     _validate_upload_metadata(
@@ -197,9 +295,29 @@ def decode_image_bytes(
         require_extension=filename is not None,
     )
 
-    max_pixels = _apply_pil_max_image_pixels()
+    limits = image_limits()
+    with metrics.timed(metrics.IMAGE_DECODE_LATENCY):
+        return _decode_validated_image(
+            source,
+            label=label,
+            extension=extension,
+            normalized_mime=normalized_mime,
+            limits=limits,
+            convert_to_rgb=convert_to_rgb,
+        )
+
+
+def _decode_validated_image(
+    source: BinaryIO,
+    *,
+    label: str,
+    extension: Optional[str],
+    normalized_mime: Optional[str],
+    limits: ImageLimits,
+    convert_to_rgb: bool,
+) -> Image.Image:
     try:
-        image = Image.open(BytesIO(raw_bytes))
+        image = Image.open(source)
         format_mime = _mime_type_for_format(image.format)
         if not format_mime:
             raise GenerationError(f"{label}は{ALLOWED_IMAGE_LABEL}のみ対応しています。")
@@ -209,13 +327,14 @@ def decode_image_bytes(
             extension=extension,
             mime_type=normalized_mime,
         )
-        _validate_image_dimensions(image, label=label)
+        # Image.open はヘッダーしか読まないので、画素を展開する前に寸法を検証できる
+        limits.check(*image.size, label=label)
         if convert_to_rgb:
             image = image.convert("RGB")
         else:
             image.load()
     except Image.DecompressionBombError as exc:
-        raise GenerationError(_pixel_limit_error(label, max_pixels)) from exc
+        raise GenerationError(limits.pixel_error(label)) from exc
     except GenerationError:
         raise
     except UnidentifiedImageError as exc:
@@ -245,33 +364,52 @@ def normalize_optional(label: Optional[str]) -> Optional[str]:
     return label
 
 
-def decode_uploaded_image(file: Optional[FileStorage], *, label: str = "画像") -> Image.Image:
+def decode_uploaded_image(
+    file: Optional[FileStorage],
+    *,
+    label: str = "画像",
+    timer: Optional[StageTimer] = None,
+) -> Image.Image:
     """アップロードされた画像ファイルを PIL Image として読み込む。"""
 
-    raw_bytes, filename, mime_type = read_uploaded_bytes(file, label=label)
-    return decode_image_bytes(
-        raw_bytes,
-        label=label,
-        filename=filename,
-        mime_type=mime_type,
-        convert_to_rgb=True,
-    )
+    with stage(timer, "upload_read"):
+        raw_bytes, filename, mime_type = read_uploaded_bytes(file, label=label)
+    with stage(timer, "decode"):
+        return decode_image_bytes(
+            raw_bytes,
+            label=label,
+            filename=filename,
+            mime_type=mime_type,
+            convert_to_rgb=True,
+        )
 
 
-def decode_uploaded_image_raw(file: Optional[FileStorage], *, label: str = "画像") -> Image.Image:
+def decode_uploaded_image_raw(
+    file: Optional[FileStorage],
+    *,
+    label: str = "画像",
+    timer: Optional[StageTimer] = None,
+) -> Image.Image:
     """アップロードされた画像ファイルを変換せずに読み込む。"""
 
-    raw_bytes, filename, mime_type = read_uploaded_bytes(file, label=label)
-    return decode_image_bytes(
-        raw_bytes,
-        label=label,
-        filename=filename,
-        mime_type=mime_type,
-        convert_to_rgb=False,
-    )
+    with stage(timer, "upload_read"):
+        raw_bytes, filename, mime_type = read_uploaded_bytes(file, label=label)
+    with stage(timer, "decode"):
+        return decode_image_bytes(
+            raw_bytes,
+            label=label,
+            filename=filename,
+            mime_type=mime_type,
+            convert_to_rgb=False,
+        )
 
 
-def decode_data_url_image(data_url: str, *, label: str = "画像") -> Image.Image:
+def decode_data_url_image(
+    data_url: str,
+    *,
+    label: str = "画像",
+    timer: Optional[StageTimer] = None,
+) -> Image.Image:
     """Data URL 形式の画像を PIL Image として読み込む。"""
 
     if not data_url:
@@ -290,11 +428,13 @@ def decode_data_url_image(data_url: str, *, label: str = "画像") -> Image.Imag
         raise GenerationError(f"{label}の形式が不正です。")
 
     try:
-        raw_bytes = base64.b64decode(encoded, validate=True)
+        with stage(timer, "upload_read"):
+            raw_bytes = base64.b64decode(encoded, validate=True)
     except (binascii.Error, ValueError) as exc:
         raise GenerationError(f"{label}の形式が不正です。") from exc
 
-    return decode_image_bytes(raw_bytes, label=label, mime_type=mime_type, convert_to_rgb=False)
+    with stage(timer, "decode"):
+        return decode_image_bytes(raw_bytes, label=label, mime_type=mime_type, convert_to_rgb=False)
 
 
 def normalize_mask_image(mask_image: Image.Image) -> Image.Image:
@@ -322,6 +462,7 @@ def _start_generation(
     aspect_ratio: Optional[str],
     resolution: Optional[str],
     edit_mode: Optional[str],
+    started_at: Optional[datetime] = None,
 ) -> Generation:
     generation = Generation(
         user_id=user_id,
@@ -330,7 +471,7 @@ def _start_generation(
         resolution=resolution,
         edit_mode=edit_mode,
         status="running",
-        started_at=datetime.utcnow(),
+        started_at=started_at or datetime.utcnow(),
         model_image=DEFAULT_IMAGE_MODEL,
         model_text=DEFAULT_TEXT_MODEL,
     )
@@ -339,41 +480,74 @@ def _start_generation(
     return generation
 
 
-def _finish_generation_success(generation: Generation, started_at: float) -> None:
+def _finish_generation_success(generation: Generation, timer: StageTimer) -> None:
     generation.status = "succeeded"
     generation.finished_at = datetime.utcnow()
-    generation.duration_ms = int((time.time() - started_at) * 1000)
+    generation.duration_ms = timer.total_ms()
+    generation.stage_timings = timer.as_dict()
 
 
-def _finish_generation_failure(generation: Generation, started_at: float, exc: Exception) -> None:
+def _finish_generation_failure(generation: Generation, timer: StageTimer, exc: Exception) -> None:
     generation.status = "failed"
     generation.finished_at = datetime.utcnow()
-    generation.duration_ms = int((time.time() - started_at) * 1000)
+    generation.duration_ms = timer.total_ms()
+    generation.stage_timings = timer.as_dict()
     generation.error_code = exc.__class__.__name__
     generation.error_message = str(exc)[:255]
     generation.error_detail = str(exc)
 
 
+def _write_behind_enabled(storage_backend: str, bucket_name: Optional[str]) -> bool:
+    mode = (current_app.config.get("GENERATION_UPLOAD_MODE") or "sync").strip().lower()
+    return mode == "write_behind" and storage.is_remote(storage_backend) and bool(bucket_name)
+
+
 def _persist_asset(
     *,
     generation: Generation,
     raw_bytes: bytes,
     mime_type: str,
-    image: Image.Image,
+    width: int,
+    height: int,
+    timer: Optional[StageTimer] = None,
 ) -> GenerationAsset:
-    storage_backend = current_app.config.get("GENERATION_IMAGE_STORAGE", "local")
+    storage_backend = (current_app.config.get("GENERATION_IMAGE_STORAGE") or "local").strip().lower()
     bucket_name = current_app.config.get("GENERATION_IMAGE_BUCKET")
-
-    stored = storage.save_bytes(
-        raw_bytes=raw_bytes,
-        extension=extension_for_mime_type(mime_type),
-        storage_backend=storage_backend,
-        bucket_name=bucket_name,
-        local_dir_key="GENERATION_IMAGE_DIR",
-        default_local_dir="generated_images",
-        object_prefix="generated_images",
-        content_type=mime_type,
-    )
+    extension = extension_for_mime_type(mime_type)
+
+    if _write_behind_enabled(storage_backend, bucket_name):
+        # GCS へのアップロードはコミット後にバックグラウンドで行い、それまではスプールから配信する
+        object_name = storage.build_object_name("generated_images", extension)
+        with stage(timer, "storage_write"):
+            spooled = upload_spool.write(object_name, raw_bytes)
+        if spooled:
+            asset = GenerationAsset(
+                generation_id=generation.id,
+                storage_backend=storage_backend,
+                bucket=bucket_name,
+                object_name=object_name,
+                mime_type=mime_type,
+                byte_size=len(raw_bytes),
+                width=width,
+                height=height,
+                sha256=storage.hash_bytes(raw_bytes),
+                storage_state="pending",
+            )
+            db.session.add(asset)
+            return asset
+        current_app.logger.warning("Upload spool is full; uploading %s synchronously", object_name)
+
+    with stage(timer, "storage_write"):
+        stored = storage.save_bytes(
+            raw_bytes=raw_bytes,
+            extension=extension,
+            storage_backend=storage_backend,
+            bucket_name=bucket_name,
+            local_dir_key="GENERATION_IMAGE_DIR",
+            default_local_dir="generated_images",
+            object_prefix="generated_images",
+            content_type=mime_type,
+        )
 
     asset = GenerationAsset(
         generation_id=generation.id,
@@ -382,14 +556,424 @@ def _persist_asset(
         object_name=stored.object_name,
         mime_type=mime_type,
         byte_size=stored.byte_size,
-        width=image.width,
-        height=image.height,
+        width=width,
+        height=height,
         sha256=stored.sha256,
+        storage_state="stored",
     )
     db.session.add(asset)
     return asset
 
 
+def _complete_generation(
+    generation: Generation,
+    timer: StageTimer,
+    generated: GeneratedImage,
+) -> GenerationOutcome:
+    asset = _persist_asset(
+        generation=generation,
+        raw_bytes=generated.raw_bytes,
+        mime_type=generated.mime_type,
+        width=generated.width,
+        height=generated.height,
+        timer=timer,
+    )
+    with timer.stage("db_flush"):
+        db.session.flush()
+    _finish_generation_success(generation, timer)
+    db.session.commit()
+    return GenerationOutcome(generation=generation, assets=[asset])
+
+
+def _schedule_asset_followups(outcome: GenerationOutcome) -> None:
+    """
+    コミット済みの生成画像の後処理（後追いアップロード・再エンコード）を投入する。
+
+    画像は保存済みなので、投入に失敗しても生成は失敗にしない（pending は次回起動時に再投入される）。
+    """
+
+    for asset in outcome.assets:
+        try:
+            if asset.storage_state == "pending":
+                schedule_asset_upload(asset)
+            else:
+                schedule_asset_reencode(asset)
+        except Exception as exc:  # noqa: BLE001
+            current_app.logger.error("Failed to schedule follow-up work for asset %s: %s", asset.id, exc)
+
+
+def reencode_asset(asset_id: int) -> bool:
+    """
+    保存済みの生成画像を GENERATION_IMAGE_CODEC の方針で再エンコードして差し替える。
+
+    差し替えた場合は True。original 方針・小さくならない場合などは何もしない。
+    """
+
+    policy = image_codec.normalize_policy(current_app.config.get("GENERATION_IMAGE_CODEC"))
+    if policy == "original":
+        return False
+
+    asset = db.session.get(GenerationAsset, asset_id)
+    if asset is None or asset.deleted_at is not None or not asset.object_name:
+        return False
+    if asset.storage_state != "stored":
+        # 後追いアップロードの完了時に改めて投入される
+        return False
+
+    raw_bytes = storage.load_bytes(
+        storage_backend=asset.storage_backend,
+        bucket_name=asset.bucket,
+        object_name=asset.object_name,
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+        expected_sha256=asset.sha256,
+    )
+    if raw_bytes is None:
+        return False
+
+    quality = int(current_app.config.get("GENERATION_IMAGE_CODEC_QUALITY", 90))
+    encoded = image_codec.encode(raw_bytes, policy, quality=quality)
+    if encoded is None:
+        return False
+
+    stored = storage.save_bytes(
+        raw_bytes=encoded.raw_bytes,
+        extension=extension_for_mime_type(encoded.mime_type),
+        storage_backend=asset.storage_backend,
+        bucket_name=asset.bucket,
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+        object_prefix="generated_images",
+        content_type=encoded.mime_type,
+    )
+    previous_object_name = asset.object_name
+    asset.object_name = stored.object_name
+    asset.mime_type = encoded.mime_type
+    asset.byte_size = stored.byte_size
+    asset.sha256 = stored.sha256
+    db.session.commit()
+
+    # 旧オブジェクトは猶予を置いてから消す。コミット直前に旧い行を読んだリクエストや、
+    # 旧い byte_size / mime_type をキャッシュしたクライアントがまだ取りに来るため。
+    defer_object_delete(
+        storage_backend=asset.storage_backend,
+        bucket_name=asset.bucket,
+        object_name=previous_object_name,
+        delay=float(current_app.config.get("GENERATION_REENCODE_DELETE_GRACE_SECONDS", 300)),
+    )
+
+    current_app.logger.info(
+        "Re-encoded asset %s as %s (%d -> %d bytes)",
+        asset_id,
+        encoded.mime_type,
+        len(raw_bytes),
+        stored.byte_size,
+    )
+    return True
+
+
+def _delete_replaced_object(app: Flask, storage_backend: str, bucket_name: Optional[str], object_name: str) -> None:
+    with _deferred_delete_lock:
+        _deferred_deletes.pop(object_name, None)
+    with app.app_context():
+        try:
+            storage.delete_bytes(
+                storage_backend=storage_backend,
+                bucket_name=bucket_name,
+                object_name=object_name,
+                local_dir_key="GENERATION_IMAGE_DIR",
+                default_local_dir="generated_images",
+            )
+        except Exception as exc:  # noqa: BLE001
+            # 失敗しても配信には影響しない（参照されないオブジェクトが残るだけ）
+            app.logger.warning("Failed to delete replaced asset object %s: %s", object_name, exc)
+
+
+def defer_object_delete(
+    *,
+    storage_backend: str,
+    bucket_name: Optional[str],
+    object_name: str,
+    delay: float,
+) -> None:
+    """
+    参照を外した生成画像オブジェクトを delay 秒後に削除する。
+
+    delay が 0 以下なら即座に削除する。猶予中にプロセスが終了した場合は削除されずに残る。
+    """
+
+    app = current_app._get_current_object()
+    if delay <= 0:
+        _delete_replaced_object(app, storage_backend, bucket_name, object_name)
+        return
+    timer = threading.Timer(delay, _delete_replaced_object, args=(app, storage_backend, bucket_name, object_name))
+    timer.daemon = True
+    with _deferred_delete_lock:
+        _deferred_deletes[object_name] = timer
+    timer.start()
+
+
+def run_deferred_deletes() -> int:
+    """猶予中の削除を今すぐ実行する（テスト・保守用）。実行した件数を返す。"""
+
+    with _deferred_delete_lock:
+        timers = list(_deferred_deletes.values())
+    for timer in timers:
+        timer.cancel()
+        timer.function(*timer.args)
+    return len(timers)
+
+
+def upload_pending_asset(asset_id: int) -> bool:
+    """
+    スプール上の生成画像をストレージへアップロードし、storage_state を stored にする。
+
+    アップロードした場合は True。既にアップロード済みなら False。
+    スプールに無い場合は storage_state を failed にして False を返す。
+    """
+
+    asset = db.session.get(GenerationAsset, asset_id)
+    if asset is None or asset.storage_state != "pending" or not asset.object_name:
+        return False
+
+    raw_bytes = upload_spool.read(asset.object_name)
+    if raw_bytes is None:
+        _mark_upload_failed(asset, "spooled bytes are missing")
+        return False
+
+    storage.save_bytes(
+        raw_bytes=raw_bytes,
+        extension="",
+        storage_backend=asset.storage_backend,
+        bucket_name=asset.bucket,
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+        object_prefix="generated_images",
+        content_type=asset.mime_type,
+        object_name=asset.object_name,
+    )
+    asset.storage_state = "stored"
+    db.session.commit()
+    # 状態をコミットしてからスプールを消す（配信側は pending の間スプールを読む）
+    upload_spool.remove(asset.object_name)
+    return True
+
+
+def _run_asset_upload(app: Flask, asset_id: int) -> None:
+    with app.app_context():
+        max_retries = max(int(app.config.get("GENERATION_UPLOAD_MAX_RETRIES", 5)), 0)
+        backoff = float(app.config.get("GENERATION_UPLOAD_RETRY_BACKOFF_SECONDS", 1.0))
+        for attempt in range(max_retries + 1):
+            try:
+                uploaded = upload_pending_asset(asset_id)
+            except Exception as exc:  # noqa: BLE001
+                db.session.rollback()
+                if attempt >= max_retries:
+                    _give_up_asset_upload(asset_id, f"gave up after {attempt + 1} attempts: {exc}")
+                    return
+                app.logger.warning("Asset upload failed (asset=%s, attempt=%d): %s", asset_id, attempt + 1, exc)
+                time.sleep(min(backoff * (2**attempt), 30.0))
+                continue
+            if uploaded:
+                asset = db.session.get(GenerationAsset, asset_id)
+                if asset is not None:
+                    schedule_asset_reencode(asset)
+            return
+
+
+def schedule_asset_upload(asset: GenerationAsset) -> None:
+    """pending の生成画像の後追いアップロードをバックグラウンドへ投入する。"""
+
+    global _upload_executor
+    with _upload_lock:
+        if _upload_executor is None:
+            workers = max(int(current_app.config.get("GENERATION_UPLOAD_WORKERS", 4)), 1)
+            _upload_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asset-upload")
+        executor = _upload_executor
+    executor.submit(_run_asset_upload, current_app._get_current_object(), asset.id)
+
+
+def _mark_upload_failed(asset: GenerationAsset, reason: str) -> None:
+    current_app.logger.error("Marking the upload of asset %s as failed: %s", asset.id, reason)
+    asset.storage_state = "failed"
+    db.session.commit()
+    # failed は配信しないので、スプールに残っていれば容量を解放する
+    if asset.object_name:
+        upload_spool.remove(asset.object_name)
+
+
+def _give_up_asset_upload(asset_id: int, reason: str) -> None:
+    try:
+        asset = db.session.get(GenerationAsset, asset_id)
+        if asset is not None and asset.storage_state == "pending":
+            _mark_upload_failed(asset, reason)
+    except Exception as exc:  # noqa: BLE001
+        # DB に届かない場合は pending のまま残り、次回起動時に再投入される
+        db.session.rollback()
+        current_app.logger.error("Failed to mark the upload of asset %s as failed (%s): %s", asset_id, reason, exc)
+
+
+def resume_pending_uploads() -> int:
+    """
+    プロセス再起動などで取り残された pending の生成画像を再投入する。投入件数を返す。
+
+    スプールが失われた pending は、GENERATION_UPLOAD_STALE_SECONDS より古いものだけ failed にする
+    （スプールは各インスタンスのローカルにあるため、新しい行は別インスタンスがアップロード中の可能性がある）。
+    """
+
+    upload_spool.recalculate()
+    stale_before = datetime.utcnow() - timedelta(
+        seconds=float(current_app.config.get("GENERATION_UPLOAD_STALE_SECONDS", 3600))
+    )
+    scheduled = 0
+    pending = (
+        db.session.query(GenerationAsset, Generation.started_at)
+        .join(Generation, GenerationAsset.generation_id == Generation.id)
+        .filter(GenerationAsset.storage_state == "pending")
+        .all()
+    )
+    for asset, started_at in pending:
+        if asset.object_name and upload_spool.exists(asset.object_name):
+            schedule_asset_upload(asset)
+            scheduled += 1
+        elif started_at is None or started_at < stale_before:
+            _mark_upload_failed(asset, "spooled bytes were lost before the upload")
+    return scheduled
+
+
+def _run_asset_reencode(app: Flask, asset_id: int) -> None:
+    with app.app_context():
+        try:
+            reencode_asset(asset_id)
+        except Exception as exc:  # noqa: BLE001
+            db.session.rollback()
+            app.logger.warning("Asset re-encode failed (asset=%s): %s", asset_id, exc)
+
+
+def schedule_asset_reencode(asset: GenerationAsset) -> None:
+    """コミット済みの生成画像の再エンコードをバックグラウンドへ投入する。"""
+
+    policy = image_codec.normalize_policy(current_app.config.get("GENERATION_IMAGE_CODEC"))
+    if policy == "original":
+        return
+
+    global _reencode_executor
+    with _reencode_lock:
+        if _reencode_executor is None:
+            _reencode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asset-reencode")
+        executor = _reencode_executor
+    executor.submit(_run_asset_reencode, current_app._get_current_object(), asset.id)
+
+
+def submit_model_call(fn: Callable[..., _T], /, *args, **kwargs) -> Future[_T]:
+    """
+    モデル呼び出しをワーカースレッドで開始し、Future を返す。
+
+    呼び出し側は結果を待つ間に DB への記録や入力画像の保存を進められる。
+    fn はアプリコンテキストなしで実行されるので、DB やセッションに触れないこと。
+    """
+
+    global _model_executor
+    with _model_lock:
+        if _model_executor is None:
+            workers = max(int(current_app.config.get("MODEL_CALL_WORKERS", 16)), 1)
+            _model_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model-call")
+        executor = _model_executor
+    # プロファイル中のリクエストなら、モデル呼び出しのスレッドも採取対象にする。
+    # トレースのコンテキストも引き継ぎ、モデル呼び出しのスパンをリクエストのトレースにつなげる
+    return executor.submit(tracing.wrap_with_context(profiling.wrap_for_current_request(fn)), *args, **kwargs)
+
+
+def discard_model_call(future: Future[Any], reason: str) -> None:
+    """
+    結果を使わなくなったモデル呼び出しを片付ける。
+
+    まだ開始していなければ取り消す。実行中なら終わるまで待ち、結果（例外も含む）を捨てて記録する。
+    リクエストが先に失敗したときに、誰も読まない呼び出しがワーカーに残らないようにする。
+    """
+
+    if future.cancel():
+        current_app.logger.warning("Cancelled model call before it started: %s", reason)
+        return
+    try:
+        future.result()
+    except Exception:  # noqa: BLE001
+        pass
+    current_app.logger.warning("Discarded model call result: %s", reason)
+
+
+def _run_generation(
+    *,
+    user_id: int,
+    mode: str,
+    aspect_ratio: Optional[str],
+    resolution: Optional[str],
+    edit_mode: Optional[str],
+    prepare: Callable[[StageTimer], Callable[[], GeneratedImage]],
+) -> GenerationOutcome:
+    """
+    生成モード共通の実行手順。
+
+    prepare で入力のデコードとプロンプト組み立てを行い、返された関数（モデル呼び出し）を
+    ワーカーで開始する。その間に Generation 行を INSERT・コミットしておくため、
+    モデル呼び出し中に DB トランザクションを握り続けない。
+    """
+
+    timer = StageTimer()
+    started_at = datetime.utcnow()
+    fields = {
+        "user_id": user_id,
+        "mode": mode,
+        "aspect_ratio": aspect_ratio,
+        "resolution": resolution,
+        "edit_mode": edit_mode,
+        "started_at": started_at,
+    }
+    with metrics.track_generation(mode):
+        try:
+            invoke = prepare(timer)
+        except Exception as exc:  # noqa: BLE001
+            generation = _start_generation(**fields)
+            _finish_generation_failure(generation, timer, exc)
+            db.session.commit()
+            raise
+
+        model_call = submit_model_call(invoke)
+        generation: Optional[Generation] = None
+        try:
+            with timer.stage("db_insert"):
+                inserted = _start_generation(**fields)
+                db.session.commit()
+            generation = inserted
+            generated = model_call.result()
+            outcome = _complete_generation(generation, timer, generated)
+        except Exception as exc:  # noqa: BLE001
+            db.session.rollback()
+            if generation is None:
+                # INSERT に失敗した場合、モデル呼び出しの結果は記録先が無いので捨て、失敗だけを記録し直す
+                discard_model_call(model_call, f"generation insert failed ({mode})")
+                _record_insert_failure(fields, timer, exc)
+            else:
+                _finish_generation_failure(generation, timer, exc)
+                db.session.commit()
+            raise
+
+    # コミット後の処理は失敗の経路に入れない（成功として記録済みの生成を failed にしない）
+    _schedule_asset_followups(outcome)
+    return outcome
+
+
+def _record_insert_failure(fields: dict[str, Any], timer: StageTimer, exc: Exception) -> None:
+    try:
+        generation = _start_generation(**fields)
+        _finish_generation_failure(generation, timer, exc)
+        db.session.commit()
+    except Exception as record_exc:  # noqa: BLE001
+        # DB 自体に届かない場合は記録できない（元の例外を優先して送出する）
+        db.session.rollback()
+        current_app.logger.error("Failed to record failed generation (%s): %s", fields["mode"], record_exc)
+
+
 def run_generation_rough(
     *,
     user_id: int,
@@ -401,37 +985,30 @@ def run_generation_rough(
 ) -> GenerationOutcome:
     """ラフ＋指示モードの生成を実行する。"""
 
-    started = time.time()
-    generation = _start_generation(
-        user_id=user_id,
-        mode="rough_with_instructions",
-        aspect_ratio=normalize_optional(aspect_ratio_label),
-        resolution=normalize_optional(resolution_label),
-        edit_mode=None,
-    )
+    mode = "rough_with_instructions"
+    aspect_ratio = normalize_optional(aspect_ratio_label)
+    resolution = normalize_optional(resolution_label)
 
-    try:
-        image = decode_uploaded_image(file, label="ラフ絵")
-        prompt = build_prompt(color_instruction, pose_instruction)
-        generated = generate_image(
+    def prepare(timer: StageTimer) -> Callable[[], GeneratedImage]:
+        image = decode_uploaded_image(file, label="ラフ絵", timer=timer)
+        with metrics.timed(metrics.PROMPT_BUILD_LATENCY, mode=mode), timer.stage("prompt_build"):
+            prompt = build_prompt(color_instruction, pose_instruction)
+        return lambda: generate_image(
             prompt=prompt,
             image=image,
-            aspect_ratio=generation.aspect_ratio,
-            resolution=generation.resolution,
+            aspect_ratio=aspect_ratio,
+            resolution=resolution,
+            timer=timer,
         )
-        asset = _persist_asset(
-            generation=generation,
-            raw_bytes=generated.raw_bytes,
-            mime_type=generated.mime_type,
-            image=generated.image,
-        )
-        _finish_generation_success(generation, started)
-        db.session.commit()
-        return GenerationOutcome(generation=generation, assets=[asset])
-    except Exception as exc:  # noqa: BLE001
-        _finish_generation_failure(generation, started, exc)
-        db.session.commit()
-        raise
+
+    return _run_generation(
+        user_id=user_id,
+        mode=mode,
+        aspect_ratio=aspect_ratio,
+        resolution=resolution,
+        edit_mode=None,
+        prepare=prepare,
+    )
 
 
 def run_generation_reference(
@@ -445,19 +1022,15 @@ def run_generation_reference(
 ) -> GenerationOutcome:
     """参照画像＋ラフモードの生成を実行する。"""
 
-    started = time.time()
-    generation = _start_generation(
-        user_id=user_id,
-        mode="reference_style_colorize",
-        aspect_ratio=normalize_optional(aspect_ratio_label),
-        resolution=normalize_optional(resolution_label),
-        edit_mode=None,
-    )
+    mode = "reference_style_colorize"
+    aspect_ratio = normalize_optional(aspect_ratio_label)
+    resolution = normalize_optional(resolution_label)
 
-    try:
-        reference_image = decode_uploaded_image(reference_file, label="参考（完成）画像")
-        rough_image = decode_uploaded_image(rough_file, label="ラフスケッチ")
-        prompt = build_reference_style_colorize_prompt(reference_instruction)
+    def prepare(timer: StageTimer) -> Callable[[], GeneratedImage]:
+        reference_image = decode_uploaded_image(reference_file, label="参考（完成）画像", timer=timer)
+        rough_image = decode_uploaded_image(rough_file, label="ラフスケッチ", timer=timer)
+        with metrics.timed(metrics.PROMPT_BUILD_LATENCY, mode=mode), timer.stage("prompt_build"):
+            prompt = build_reference_style_colorize_prompt(reference_instruction)
         contents = [
             "これから2枚の画像を渡します。1枚目は編集対象のラフスケッチです。",
             rough_image,
@@ -465,25 +1038,22 @@ def run_generation_reference(
             reference_image,
             prompt,
         ]
-        generated = generate_image_with_contents(
+        return lambda: generate_image_with_contents(
             contents=contents,
             prompt_for_record=prompt,
-            aspect_ratio=generation.aspect_ratio,
-            resolution=generation.resolution,
-        )
-        asset = _persist_asset(
-            generation=generation,
-            raw_bytes=generated.raw_bytes,
-            mime_type=generated.mime_type,
-            image=generated.image,
+            aspect_ratio=aspect_ratio,
+            resolution=resolution,
+            timer=timer,
         )
-        _finish_generation_success(generation, started)
-        db.session.commit()
-        return GenerationOutcome(generation=generation, assets=[asset])
-    except Exception as exc:  # noqa: BLE001
-        _finish_generation_failure(generation, started, exc)
-        db.session.commit()
-        raise
+
+    return _run_generation(
+        user_id=user_id,
+        mode=mode,
+        aspect_ratio=aspect_ratio,
+        resolution=resolution,
+        edit_mode=None,
+        prepare=prepare,
+    )
 
 
 def run_generation_edit(
@@ -498,53 +1068,44 @@ def run_generation_edit(
 ) -> GenerationOutcome:
     """インペイント/アウトペイントモードの生成を実行する。"""
 
+    mode = "inpaint_outpaint"
     normalized_mode = "outpaint" if edit_mode == "outpaint" else "inpaint"
-    started = time.time()
-    generation = _start_generation(
-        user_id=user_id,
-        mode="inpaint_outpaint",
-        aspect_ratio=None,
-        resolution=None,
-        edit_mode=normalized_mode,
-    )
 
-    try:
+    def prepare(timer: StageTimer) -> Callable[[], GeneratedImage]:
         if base_data:
-            base_image = decode_data_url_image(base_data, label="編集元画像")
+            base_image = decode_data_url_image(base_data, label="編集元画像", timer=timer)
         else:
-            base_image = decode_uploaded_image_raw(base_file, label="編集元画像")
+            base_image = decode_uploaded_image_raw(base_file, label="編集元画像", timer=timer)
 
         if mask_data:
-            mask_image = decode_data_url_image(mask_data, label="マスク画像")
+            mask_image = decode_data_url_image(mask_data, label="マスク画像", timer=timer)
         elif mask_file:
-            mask_image = decode_uploaded_image_raw(mask_file, label="マスク画像")
+            mask_image = decode_uploaded_image_raw(mask_file, label="マスク画像", timer=timer)
         else:
             raise GenerationError("マスク画像を用意してください。")
 
-        base_image = ensure_rgb(base_image)
-        mask_image = normalize_mask_image(mask_image)
+        with timer.stage("decode"):
+            base_image = ensure_rgb(base_image)
+            mask_image = normalize_mask_image(mask_image)
 
         if base_image.size != mask_image.size:
             raise GenerationError("マスク画像のサイズがベース画像と一致しません。")
 
-        prompt = build_edit_prompt(edit_instruction, normalized_mode)
-        generated = edit_image_with_mask(
+        with metrics.timed(metrics.PROMPT_BUILD_LATENCY, mode=mode), timer.stage("prompt_build"):
+            prompt = build_edit_prompt(edit_instruction, normalized_mode)
+        return lambda: edit_image_with_mask(
             prompt=prompt,
             base_image=base_image,
             mask_image=mask_image,
             edit_mode=normalized_mode,
+            timer=timer,
         )
 
-        asset = _persist_asset(
-            generation=generation,
-            raw_bytes=generated.raw_bytes,
-            mime_type=generated.mime_type,
-            image=generated.image,
-        )
-        _finish_generation_success(generation, started)
-        db.session.commit()
-        return GenerationOutcome(generation=generation, assets=[asset])
-    except Exception as exc:  # noqa: BLE001
-        _finish_generation_failure(generation, started, exc)
-        db.session.commit()
-        raise
+    return _run_generation(
+        user_id=user_id,
+        mode=mode,
+        aspect_ratio=None,
+        resolution=None,
+        edit_mode=normalized_mode,
+        prepare=prepare,
+    )
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# 生成画像を保存するときのコーデック方針。
+# - original: モデルが返したバイト列をそのまま保存する
+# - png_optimized: PNG のまま圧縮パラメータを最適化する（可逆）
+# - webp_lossless: 可逆 WebP
+# - webp / avif: 高画質の非可逆圧縮（品質は GENERATION_IMAGE_CODEC_QUALITY）
+CODEC_POLICIES = ("original", "png_optimized", "webp_lossless", "webp", "avif")
+
+_POLICY_MIME_TYPES = {
+    "png_optimized": "image/png",
+    "webp_lossless": "image/webp",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+_POLICY_FEATURES = {
+    "webp_lossless": "webp",
+    "webp": "webp",
+    "avif": "avif",
+}
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """再エンコード後のバイト列と MIME タイプ。"""
+
+    raw_bytes: bytes
+    mime_type: str
+
+
+def normalize_policy(value: Optional[str]) -> str:
+    """設定値を方針名へ正規化する。未知の値は original とみなす。"""
+
+    normalized = (value or "original").strip().lower()
+    if normalized not in CODEC_POLICIES:
+        logger.warning("Unknown image codec policy: %s (fallback to original)", value)
+        return "original"
+    return normalized
+
+
+def is_supported(policy: str) -> bool:
+    """実行環境の Pillow が方針のエンコーダーを備えているか。"""
+
+    feature = _POLICY_FEATURES.get(policy)
+    return feature is None or bool(features.check(feature))
+
+
+def encode(raw_bytes: bytes, policy: str, *, quality: int = 90) -> Optional[EncodedImage]:
+    """
+    方針に従って画像を再エンコードする。
+
+    original・非対応の方針、または元より小さくならなかった場合は None を返す
+    （呼び出し側は元のバイト列を保持し続ける）。
+    """
+
+    if policy == "original":
+        return None
+    if not is_supported(policy):
+        logger.warning("Image codec %s is not supported by this Pillow build", policy)
+        return None
+
+    with Image.open(BytesIO(raw_bytes)) as source:
+        source.load()
+        image = source
+        if image.mode not in {"RGB", "RGBA", "L", "LA"}:
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        buffer = BytesIO()
+        if policy == "png_optimized":
+            image.save(buffer, format="PNG", optimize=True)
+        elif policy == "webp_lossless":
+            image.save(buffer, format="WEBP", lossless=True, quality=100, method=4)
+        elif policy == "webp":
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(buffer, format="AVIF", quality=quality)
+
+    encoded = buffer.getvalue()
+    if len(encoded) >= len(raw_bytes):
+        return None
+    return EncodedImage(raw_bytes=encoded, mime_type=_POLICY_MIME_TYPES[policy])
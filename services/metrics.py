@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+# Prometheus 形式のメトリクス定義。
+# gunicorn の複数ワーカーで集計する場合は、起動前に PROMETHEUS_MULTIPROC_DIR を設定する
+# （各ワーカーが同ディレクトリへ書き出し、/metrics で合算する）。
+
+_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if _MULTIPROC_DIR:
+    # ラベルなしメトリクスは定義時にファイルを作るため、先にディレクトリを用意する
+    os.makedirs(_MULTIPROC_DIR, exist_ok=True)
+
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0)
+
+REQUEST_LATENCY = Histogram(
+    "app_http_request_duration_seconds",
+    "HTTPリクエストの処理時間（ルート別）",
+    ["method", "route", "status"],
+    buckets=_SLOW_BUCKETS,
+)
+IMAGE_DECODE_LATENCY = Histogram(
+    "app_image_decode_duration_seconds",
+    "アップロード画像のデコード・検証時間",
+    buckets=_FAST_BUCKETS,
+)
+PROMPT_BUILD_LATENCY = Histogram(
+    "app_prompt_build_duration_seconds",
+    "プロンプト組み立て時間（モード別）",
+    ["mode"],
+    buckets=_FAST_BUCKETS,
+)
+MODEL_CALL_LATENCY = Histogram(
+    "app_gemini_request_duration_seconds",
+    "Gemini API 呼び出し時間（モデル別）",
+    ["model", "operation"],
+    buckets=_SLOW_BUCKETS,
+)
+STORAGE_LATENCY = Histogram(
+    "app_storage_operation_duration_seconds",
+    "ストレージ読み書き時間（バックエンド別）",
+    ["backend", "operation"],
+    buckets=_SLOW_BUCKETS,
+)
+DB_COMMIT_LATENCY = Histogram(
+    "app_db_commit_duration_seconds",
+    "DBコミット時間",
+    buckets=_FAST_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "app_http_requests_in_flight",
+    "処理中のHTTPリクエスト数（/metrics を除く。ワーカーの埋まり具合）",
+    multiprocess_mode="livesum",
+)
+GENERATIONS_IN_FLIGHT = Gauge(
+    "app_generations_in_flight",
+    "実行中の生成リクエスト数",
+    ["mode"],
+    multiprocess_mode="livesum",
+)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels: str) -> Iterator[None]:
+    """ブロックの経過時間をヒストグラムへ記録する。例外時も記録する。"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        target = histogram.labels(**labels) if labels else histogram
+        target.observe(time.perf_counter() - started)
+
+
+@contextmanager
+def track_generation(mode: str) -> Iterator[None]:
+    """実行中の生成数ゲージを増減する。"""
+
+    gauge = GENERATIONS_IN_FLIGHT.labels(mode=mode)
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+def is_multiprocess() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def render_latest() -> tuple[bytes, str]:
+    """現在のメトリクスを Prometheus テキスト形式で返す。"""
+
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """終了したワーカーの livesum ゲージを集計対象から外す（gunicorn の child_exit 用）。"""
+
+    if is_multiprocess():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, Optional, TypeVar
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+
+# 本番トラフィックの1リクエストを対象にしたサンプリングプロファイラー。
+# 管理者が X-Profile: 1 ヘッダー（または ?profile=1）を付けたリクエストと、PROFILING_SAMPLE_RATE で
+# 抽選されたリクエストについて、処理中のスレッドのスタックを一定間隔で採取し、
+# speedscope 形式（https://www.speedscope.app で開ける）で request_id をファイル名にして保存する。
+# モデル呼び出しは別スレッドで実行されるため、submit_model_call 経由の処理もそのスレッドごと採取する。
+
+_T = TypeVar("_T")
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+_SUFFIX = ".speedscope.json"
+_TRUE_VALUES = {"1", "true", "yes", "on"}
+# 上限を超えたら、この割合まで古いものを削除する（書き込みのたびに走査し直さないようにする）
+_PRUNE_TARGET_RATIO = 0.9
+
+# 保存先ごとのファイル数（プロセス内の推定値）。初回と削除時だけディレクトリを数え、以降は書き込みで数える。
+# 他のワーカーが書いた分は数えないため一時的に上限を超えることがあるが、次の削除でまとめて整理される。
+_file_counts: dict[Path, int] = {}
+_file_counts_lock = threading.Lock()
+
+
+class SamplingProfiler:
+    """登録したスレッドのスタックを interval 秒ごとに採取する。"""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = max(interval, 0.001)
+        self._lock = threading.Lock()
+        self._threads: dict[int, str] = {}
+        self._samples: dict[str, list[tuple[list[int], float]]] = {}
+        self._frame_index: dict[tuple[str, str, int], int] = {}
+        self.frames: list[dict[str, Any]] = []
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self.started_at = 0.0
+        self.elapsed = 0.0
+
+    def add_thread(self, ident: int, name: str) -> None:
+        with self._lock:
+            self._threads[ident] = name
+            self._samples.setdefault(name, [])
+
+    def remove_thread(self, ident: int) -> None:
+        with self._lock:
+            self._threads.pop(ident, None)
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        self._sampler = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.elapsed = time.perf_counter() - self.started_at
+
+    @property
+    def sample_count(self) -> int:
+        return sum(len(samples) for samples in self._samples.values())
+
+    def _run(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            weight_ms = (now - last) * 1000
+            last = now
+            current = sys._current_frames()
+            with self._lock:
+                for ident, name in self._threads.items():
+                    frame = current.get(ident)
+                    if frame is not None:
+                        self._samples[name].append((self._stack(frame), weight_ms))
+
+    def _stack(self, frame: Optional[FrameType]) -> list[int]:
+        stack: list[int] = []
+        while frame is not None:
+            code = frame.f_code
+            key = (getattr(code, "co_qualname", code.co_name), code.co_filename, code.co_firstlineno)
+            index = self._frame_index.get(key)
+            if index is None:
+                index = len(self.frames)
+                self._frame_index[key] = index
+                self.frames.append({"name": key[0], "file": key[1], "line": key[2]})
+            stack.append(index)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def to_speedscope(self, name: str) -> dict[str, Any]:
+        profiles = []
+        for thread_name, samples in self._samples.items():
+            if not samples:
+                continue
+            weights = [round(weight, 3) for _, weight in samples]
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": round(sum(weights), 3),
+                    "samples": [stack for stack, _ in samples],
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "rough_to_illustration request profiler",
+            "activeProfileIndex": 0,
+            "shared": {"frames": self.frames},
+            "profiles": profiles,
+        }
+
+
+@dataclass
+class ProfileSession:
+    request_id: str
+    reason: str
+    profiler: SamplingProfiler
+    status: Optional[int] = None
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+def _base_dir() -> Path:
+    configured = current_app.config.get("PROFILING_DIR") or "profiles"
+    base = Path(configured)
+    if not base.is_absolute():
+        base = Path(current_app.instance_path) / base
+    base.mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def profile_path(request_id: str) -> Optional[Path]:
+    """request_id に対応するプロファイルのパス。不正な ID や未保存なら None。"""
+
+    if not _REQUEST_ID.match(request_id or ""):
+        return None
+    path = _base_dir() / f"{request_id}{_SUFFIX}"
+    return path if path.is_file() else None
+
+
+def _reason() -> Optional[str]:
+    config = current_app.config
+    if not config.get("PROFILING_ENABLED"):
+        return None
+    flag = request.headers.get("X-Profile") or request.args.get("profile")
+    if flag and flag.strip().lower() in _TRUE_VALUES and current_user.is_authenticated and current_user.is_admin:
+        return "requested"
+    rate = float(config.get("PROFILING_SAMPLE_RATE") or 0)
+    prefixes = tuple(config.get("PROFILING_PATH_PREFIXES") or ("/api/",))
+    if rate > 0 and request.path.startswith(prefixes) and random.random() < rate:
+        return "sampled"
+    return None
+
+
+def start_request() -> None:
+    """プロファイル対象のリクエストなら採取を始める（before_request から呼ぶ）。"""
+
+    reason = _reason()
+    if reason is None:
+        return
+    request_id = g.get("request_id") or ""
+    if not _REQUEST_ID.match(request_id):
+        # 外部から渡された X-Request-Id はファイル名に使える文字だけに絞る
+        request_id = re.sub(r"[^A-Za-z0-9_-]", "", request_id)[:128] or f"profile-{time.time_ns()}"
+    profiler = SamplingProfiler(float(current_app.config.get("PROFILING_INTERVAL_MS", 5)) / 1000)
+    profiler.add_thread(threading.get_ident(), "request")
+    profiler.start()
+    g.profile_session = ProfileSession(request_id=request_id, reason=reason, profiler=profiler)
+
+
+def mark_response(response: Any) -> Any:
+    """レスポンスにプロファイルの ID を付ける（after_request から呼ぶ）。"""
+
+    session: Optional[ProfileSession] = g.get("profile_session")
+    if session is not None:
+        session.status = response.status_code
+        response.headers["X-Profile-Id"] = session.request_id
+    return response
+
+
+def finish_request() -> Optional[Path]:
+    """採取を止めて保存する（teardown_request から呼ぶ）。例外時もここで保存する。"""
+
+    session: Optional[ProfileSession] = g.pop("profile_session", None)
+    if session is None:
+        return None
+    session.profiler.stop()
+    try:
+        return _write(session)
+    except OSError as exc:
+        current_app.logger.warning("Failed to write profile %s: %s", session.request_id, exc)
+        return None
+
+
+def _write(session: ProfileSession) -> Path:
+    profiler = session.profiler
+    metadata = {
+        "request_id": session.request_id,
+        "method": request.method,
+        "path": request.path,
+        "status": session.status if session.status is not None else 500,
+        "reason": session.reason,
+        "user_id": current_user.id if current_user.is_authenticated else None,
+        "duration_ms": int(profiler.elapsed * 1000),
+        "samples": profiler.sample_count,
+        "interval_ms": round(profiler.interval * 1000, 3),
+        "created_at": session.created_at.isoformat(),
+    }
+    document = profiler.to_speedscope(f"{request.method} {request.path} ({session.request_id})")
+    document["metadata"] = metadata
+    base = _base_dir()
+    path = base / f"{session.request_id}{_SUFFIX}"
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(json.dumps(document, ensure_ascii=False), encoding="utf-8")
+    tmp_path.replace(path)
+    current_app.logger.info(
+        json.dumps({"type": "profile", **metadata, "file": path.name}, ensure_ascii=False)
+    )
+    _count_written(base, int(current_app.config.get("PROFILING_MAX_FILES", 100)))
+    return path
+
+
+def _count_written(base: Path, max_files: int) -> None:
+    if max_files <= 0:
+        return
+    with _file_counts_lock:
+        count = _file_counts.get(base)
+        count = len(list(base.glob(f"*{_SUFFIX}"))) if count is None else count + 1
+        if count > max_files:
+            count = _prune(base, max(int(max_files * _PRUNE_TARGET_RATIO), 1))
+        _file_counts[base] = count
+
+
+def _prune(base: Path, keep: int) -> int:
+    """新しい順に keep 件を残して削除し、残った件数を返す。"""
+
+    files = []
+    for item in base.glob(f"*{_SUFFIX}"):
+        try:
+            files.append((item.stat().st_mtime, item))
+        except FileNotFoundError:
+            continue
+    files.sort(reverse=True)
+    for _, stale in files[keep:]:
+        stale.unlink(missing_ok=True)
+    return min(len(files), keep)
+
+
+def list_profiles(limit: int = 50) -> list[dict[str, Any]]:
+    """保存済みプロファイルのメタデータ（新しい順）。"""
+
+    files = sorted(_base_dir().glob(f"*{_SUFFIX}"), key=lambda item: item.stat().st_mtime, reverse=True)
+    items = []
+    for path in files[:limit]:
+        try:
+            metadata = json.loads(path.read_text(encoding="utf-8")).get("metadata") or {}
+        except (OSError, ValueError):
+            continue
+        items.append({**metadata, "bytes": path.stat().st_size})
+    return items
+
+
+def wrap_for_current_request(fn: Callable[..., _T]) -> Callable[..., _T]:
+    """
+    プロファイル中のリクエストから別スレッドへ渡す処理を、そのスレッドも採取対象にする形で包む。
+
+    プロファイル対象でなければ fn をそのまま返す。
+    """
+
+    if not has_request_context():
+        return fn
+    session: Optional[ProfileSession] = g.get("profile_session")
+    if session is None:
+        return fn
+    profiler = session.profiler
+
+    def profiled(*args: Any, **kwargs: Any) -> _T:
+        ident = threading.get_ident()
+        profiler.add_thread(ident, threading.current_thread().name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.remove_thread(ident)
+
+    return profiled
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# リクエストごとの SQL 実行回数・合計時間の集計と、遅いクエリのログ出力。
+# カーソル実行のイベントで数えるため、ORM・Core・text() のどれから発行したクエリも対象になる。
+# 集計先は contextvars で持つので、gthread の同時リクエストやテストの capture() と混ざらない。
+
+logger = logging.getLogger(__name__)
+
+_STATEMENT_MAX_CHARS = 1000
+
+
+@dataclass
+class QueryStats:
+    """1リクエスト（または capture() の範囲）で実行したクエリの集計。"""
+
+    count: int = 0
+    total_seconds: float = 0.0
+    statements: list[str] = field(default_factory=list)
+    keep_statements: bool = False
+
+    @property
+    def total_ms(self) -> float:
+        return round(self.total_seconds * 1000, 2)
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        if self.keep_statements:
+            self.statements.append(statement)
+
+
+_request_stats: ContextVar[Optional[QueryStats]] = ContextVar("request_query_stats", default=None)
+_captures: ContextVar[tuple[QueryStats, ...]] = ContextVar("query_captures", default=())
+_slow_query_seconds: Optional[float] = None
+
+
+def install(engine: Engine, *, slow_query_ms: Optional[float]) -> None:
+    """エンジンへ計測用のリスナーを登録する（同じエンジンへは一度だけ）。"""
+
+    global _slow_query_seconds
+    _slow_query_seconds = slow_query_ms / 1000 if slow_query_ms and slow_query_ms > 0 else None
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def begin_request() -> None:
+    _request_stats.set(QueryStats())
+
+
+def end_request() -> Optional[QueryStats]:
+    stats = _request_stats.get()
+    _request_stats.set(None)
+    return stats
+
+
+def current() -> Optional[QueryStats]:
+    return _request_stats.get()
+
+
+@contextmanager
+def capture() -> Iterator[QueryStats]:
+    """範囲内で（このスレッドから）実行したクエリを数える。テストの上限チェック用。"""
+
+    stats = QueryStats(keep_statements=True)
+    token = _captures.set((*_captures.get(), stats))
+    try:
+        yield stats
+    finally:
+        _captures.reset(token)
+
+
+def parameters_shape(parameters: Any) -> Any:
+    """パラメーターの値を型名に置き換えた形（ログに値そのものを出さない）。"""
+
+    if isinstance(parameters, dict):
+        return {str(key): type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and all(isinstance(item, (dict, list, tuple)) for item in parameters):
+            # executemany: 行数と1行目の形
+            return {"rows": len(parameters), "row": parameters_shape(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    if parameters is None:
+        return None
+    return type(parameters).__name__
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started_stack = conn.info.get("query_started_at")
+    if not started_stack:
+        return
+    elapsed = time.perf_counter() - started_stack.pop()
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.record(statement, elapsed)
+    for captured in _captures.get():
+        captured.record(statement, elapsed)
+
+    if _slow_query_seconds is not None and elapsed >= _slow_query_seconds:
+        from flask import g, has_request_context
+
+        logger.warning(
+            json.dumps(
+                {
+                    "type": "slow_query",
+                    "request_id": g.get("request_id") if has_request_context() else None,
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "statement": " ".join(statement.split())[:_STATEMENT_MAX_CHARS],
+                    "parameters": parameters_shape(parameters),
+                    "executemany": bool(executemany),
+                },
+                ensure_ascii=False,
+            )
+        )
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, Optional
+
+
+class StageTimer:
+    """
+    生成処理の各段階の所要時間（ミリ秒）を単調時計で記録する。
+
+    モデル呼び出しのワーカーとリクエストスレッドが同時に記録するため、読み書きはロックで直列化する。
+    """
+
+    def __init__(self) -> None:
+        self._started = time.perf_counter()
+        self._stages: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ブロックの所要時間を name に加算する。例外時も記録する。"""
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._stages[name] = self._stages.get(name, 0.0) + elapsed
+
+    def total_ms(self) -> int:
+        return int((time.perf_counter() - self._started) * 1000)
+
+    def as_dict(self) -> dict[str, int]:
+        """記録順を保ったまま、ミリ秒の整数に丸めて返す。"""
+
+        with self._lock:
+            return {name: int(seconds * 1000) for name, seconds in self._stages.items()}
+
+
+def stage(timer: Optional[StageTimer], name: str) -> ContextManager[None]:
+    """timer が None の場合は何もしないコンテキストを返す。"""
+
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+
+def percentile(values: list[int], ratio: float) -> Optional[int]:
+    """最近傍順位法でパーセンタイルを求める。"""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(max(math.ceil(ratio * len(ordered)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
@@ -1,13 +1,25 @@
 ﻿from __future__ import annotations
 
 import hashlib
+from contextlib import contextmanager
 from dataclasses import dataclass
-from pathlib import Path
+from io import BytesIO
+from typing import Any, BinaryIO, Iterable, Iterator, Optional
 from uuid import uuid4
 
 from flask import current_app
-from google.api_core.exceptions import NotFound
-from google.cloud import storage
+
+from services import metrics, storage_cache, tracing
+from services.storage_backends import (
+    BackendLocation,
+    ObjectStat,
+    StorageBackend,
+    get_backend,
+    is_remote_backend,
+)
+
+# save_stream が1回に読み書きするサイズ
+STREAM_CHUNK_SIZE = 1024 * 1024
 
 
 @dataclass(frozen=True)
@@ -21,38 +33,95 @@ class StoredObject:
     sha256: str
 
 
+@contextmanager
+def _observe(backend: StorageBackend, operation: str, object_name: str) -> Iterator[Any]:
+    """ストレージ操作の所要時間をメトリクスへ記録し、トレースのスパンにする。"""
+
+    with tracing.span(
+        f"storage {operation}",
+        **{
+            "app.storage.backend": backend.name,
+            "app.storage.bucket": backend.bucket,
+            "app.storage.operation": operation,
+            "app.storage.object_name": object_name,
+        },
+    ) as span, metrics.timed(metrics.STORAGE_LATENCY, backend=backend.name, operation=operation):
+        yield span
+
+
 def _normalize_backend(value: str | None) -> str:
     if not value:
         return "local"
     return value.strip().lower()
 
 
-def _local_base_dir(config_key: str, default_dir: str) -> Path:
-    configured = current_app.config.get(config_key) or default_dir
-    base = Path(configured)
-    if base.is_absolute():
-        base.mkdir(parents=True, exist_ok=True)
-        return base
-    base = Path(current_app.instance_path) / base
-    base.mkdir(parents=True, exist_ok=True)
-    return base
+def resolve_backend(
+    storage_backend: str | None,
+    *,
+    bucket_name: str | None,
+    local_dir_key: str,
+    default_local_dir: str,
+) -> StorageBackend:
+    """storage_backend の名前から登録済みのバックエンドを生成する。"""
+
+    return get_backend(
+        _normalize_backend(storage_backend),
+        BackendLocation(
+            bucket_name=bucket_name,
+            local_dir_key=local_dir_key,
+            default_local_dir=default_local_dir,
+        ),
+    )
+
+
+def _resolve_for_read(
+    storage_backend: str | None,
+    *,
+    bucket_name: str | None,
+    local_dir_key: str,
+    default_local_dir: str,
+) -> StorageBackend | None:
+    """
+    読み出し用にバックエンドを解決する。解決できない行（未登録の名前・バケット未設定）は None。
+
+    書き込みは設定の誤りとして ValueError を送出するが、読み出しは「見つからない」として扱い、
+    配信側が 404 を返せるようにする。
+    """
+
+    try:
+        return resolve_backend(
+            storage_backend,
+            bucket_name=bucket_name,
+            local_dir_key=local_dir_key,
+            default_local_dir=default_local_dir,
+        )
+    except ValueError as exc:
+        current_app.logger.warning("Cannot resolve storage backend %r for reading: %s", storage_backend, exc)
+        return None
+
 
+def is_remote(storage_backend: str | None) -> bool:
+    """ネットワーク越しのバックエンド（GCS / S3 など）か。"""
 
-def _gcs_bucket(bucket_name: str) -> storage.Bucket:
-    client = storage.Client()
-    return client.bucket(bucket_name)
+    return is_remote_backend(_normalize_backend(storage_backend))
 
 
-def _hash_bytes(raw_bytes: bytes) -> str:
+def hash_bytes(raw_bytes: bytes) -> str:
     return hashlib.sha256(raw_bytes).hexdigest()
 
 
-def _build_object_name(prefix: str, extension: str) -> str:
+def build_object_name(prefix: str, extension: str, *, shard_depth: int = 0) -> str:
+    """
+    保存先のオブジェクト名（<prefix>/<uuid><extension>）を採番する。
+
+    shard_depth を指定すると UUID 先頭の2文字ずつを中間ディレクトリにする
+    （ローカル保存で1ディレクトリにファイルが集中しないようにする）。
+    """
+
     safe_prefix = prefix.strip("/")
-    image_id = f"{uuid4().hex}{extension}"
-    if safe_prefix:
-        return f"{safe_prefix}/{image_id}"
-    return image_id
+    image_hex = uuid4().hex
+    shards = [image_hex[index * 2 : index * 2 + 2] for index in range(shard_depth)]
+    return "/".join([*filter(None, [safe_prefix]), *shards, f"{image_hex}{extension}"])
 
 
 def save_bytes(
@@ -65,39 +134,93 @@ def save_bytes(
     default_local_dir: str,
     object_prefix: str,
     content_type: str | None = None,
+    object_name: str | None = None,
 ) -> StoredObject:
-    """バイト列をストレージへ保存して情報を返す。"""
-
-    backend = _normalize_backend(storage_backend)
-    object_name = _build_object_name(object_prefix, extension)
-    sha256 = _hash_bytes(raw_bytes)
-
-    if backend == "gcs":
-        if not bucket_name:
-            raise ValueError("GCSバケット名が未設定です。")
-        bucket = _gcs_bucket(bucket_name)
-        blob = bucket.blob(object_name)
-        if content_type:
-            blob.upload_from_string(raw_bytes, content_type=content_type)
-        else:
-            blob.upload_from_string(raw_bytes)
-        return StoredObject(
-            storage_backend=backend,
-            bucket=bucket_name,
+    """バイト列をストレージへ保存して情報を返す。
+
+    object_name を指定した場合は採番せずその名前で保存する（後追いアップロード用）。
+    """
+
+    backend = resolve_backend(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    object_name = object_name or build_object_name(object_prefix, extension, shard_depth=backend.shard_depth)
+    with _observe(backend, "upload", object_name) as span:
+        tracing.set_attributes(span, **{"app.storage.bytes": len(raw_bytes)})
+        backend.save(object_name, raw_bytes, content_type=content_type)
+    stored = StoredObject(
+        storage_backend=backend.name,
+        bucket=backend.bucket,
+        object_name=object_name,
+        byte_size=len(raw_bytes),
+        sha256=hash_bytes(raw_bytes),
+    )
+    if backend.remote and storage_cache.is_enabled():
+        # 直後に閲覧されることが多いので、アップロードした内容をそのままキャッシュしておく
+        storage_cache.put(
+            backend=backend.name,
+            bucket_name=backend.bucket,
             object_name=object_name,
-            byte_size=len(raw_bytes),
-            sha256=sha256,
+            raw_bytes=raw_bytes,
+            expected_sha256=stored.sha256,
         )
+    return stored
+
+
+def _iter_chunks(source: BinaryIO | Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)  # type: ignore[union-attr]
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def save_stream(
+    *,
+    stream: BinaryIO | Iterable[bytes],
+    extension: str,
+    storage_backend: str,
+    bucket_name: str | None,
+    local_dir_key: str,
+    default_local_dir: str,
+    object_prefix: str,
+    content_type: str | None = None,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> StoredObject:
+    """
+    ファイルオブジェクト（またはバイト列のイテレーター）をチャンク単位で保存する。
+
+    書き込みと並行して sha256 を計算するため、ペイロード全体をメモリへ載せない。
+    GCS はレジューマブルアップロード、ローカルは一時ファイルへ書いてからリネームする。
+    """
 
-    base_dir = _local_base_dir(local_dir_key, default_local_dir)
-    path = base_dir / object_name
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(raw_bytes)
+    backend = resolve_backend(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    object_name = build_object_name(object_prefix, extension, shard_depth=backend.shard_depth)
+    with _observe(backend, "upload", object_name) as span:
+        byte_size, sha256 = backend.save_stream(
+            object_name,
+            _iter_chunks(stream, chunk_size),
+            content_type=content_type,
+        )
+        tracing.set_attributes(span, **{"app.storage.bytes": byte_size})
     return StoredObject(
-        storage_backend=backend,
-        bucket=None,
+        storage_backend=backend.name,
+        bucket=backend.bucket,
         object_name=object_name,
-        byte_size=len(raw_bytes),
+        byte_size=byte_size,
         sha256=sha256,
     )
 
@@ -109,22 +232,125 @@ def load_bytes(
     object_name: str,
     local_dir_key: str,
     default_local_dir: str,
+    expected_sha256: str | None = None,
 ) -> bytes | None:
-    """保存済みオブジェクトのバイト列を取得する。"""
-
-    backend = _normalize_backend(storage_backend)
-    if backend == "gcs":
-        if not bucket_name:
-            return None
-        bucket = _gcs_bucket(bucket_name)
-        blob = bucket.blob(object_name)
-        try:
-            return blob.download_as_bytes()
-        except NotFound:
-            return None
-
-    base_dir = _local_base_dir(local_dir_key, default_local_dir)
-    path = base_dir / object_name
-    if not path.exists():
+    """保存済みオブジェクトのバイト列を取得する。
+
+    リモートのバックエンドはローカルディスクキャッシュを先に参照し、未登録なら取得して書き込む。
+    expected_sha256 を渡すと、ハッシュが一致するものだけをキャッシュから返す・書き込む。
+    """
+
+    backend = _resolve_for_read(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    if backend is None:
+        return None
+    use_cache = backend.remote and storage_cache.is_enabled()
+    if use_cache:
+        with _observe(backend, "cache_read", object_name) as span:
+            cached = storage_cache.get(
+                backend=backend.name,
+                bucket_name=backend.bucket,
+                object_name=object_name,
+                expected_sha256=expected_sha256,
+            )
+            tracing.set_attributes(span, **{"app.storage.cache_hit": cached is not None})
+        if cached is not None:
+            return cached
+
+    with _observe(backend, "download", object_name) as span:
+        raw_bytes = backend.read(object_name)
+        tracing.set_attributes(span, **{"app.storage.bytes": len(raw_bytes) if raw_bytes is not None else None})
+    if use_cache and raw_bytes is not None:
+        storage_cache.put(
+            backend=backend.name,
+            bucket_name=backend.bucket,
+            object_name=object_name,
+            raw_bytes=raw_bytes,
+            expected_sha256=expected_sha256,
+        )
+    return raw_bytes
+
+
+def open_object(
+    *,
+    storage_backend: str,
+    bucket_name: str | None,
+    object_name: str,
+    local_dir_key: str,
+    default_local_dir: str,
+    expected_sha256: str | None = None,
+) -> Optional[BinaryIO]:
+    """
+    配信用に保存済みオブジェクトを開く。存在しなければ None。
+
+    ローカルは実ファイルを返すので、send_file へ渡すと sendfile で配信される。
+    リモートは load_bytes（ディスクキャッシュ付き）で取得した内容を返す。
+    """
+
+    backend = _resolve_for_read(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    if backend is None:
+        return None
+    if backend.remote:
+        raw_bytes = load_bytes(
+            storage_backend=backend.name,
+            bucket_name=bucket_name,
+            object_name=object_name,
+            local_dir_key=local_dir_key,
+            default_local_dir=default_local_dir,
+            expected_sha256=expected_sha256,
+        )
+        return BytesIO(raw_bytes) if raw_bytes is not None else None
+    with _observe(backend, "open", object_name):
+        return backend.open(object_name)
+
+
+def stat_object(
+    *,
+    storage_backend: str,
+    bucket_name: str | None,
+    object_name: str,
+    local_dir_key: str,
+    default_local_dir: str,
+) -> ObjectStat | None:
+    """保存済みオブジェクトのサイズなどを返す。存在しなければ None。"""
+
+    backend = _resolve_for_read(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    if backend is None:
         return None
-    return path.read_bytes()
+    return backend.stat(object_name)
+
+
+def delete_bytes(
+    *,
+    storage_backend: str,
+    bucket_name: str | None,
+    object_name: str,
+    local_dir_key: str,
+    default_local_dir: str,
+) -> bool:
+    """保存済みオブジェクトを削除する。存在しなかった場合は False を返す。"""
+
+    backend = resolve_backend(
+        storage_backend,
+        bucket_name=bucket_name,
+        local_dir_key=local_dir_key,
+        default_local_dir=default_local_dir,
+    )
+    if backend.remote and storage_cache.is_enabled():
+        storage_cache.discard(backend=backend.name, bucket_name=backend.bucket, object_name=object_name)
+    with _observe(backend, "delete", object_name):
+        return backend.delete(object_name)
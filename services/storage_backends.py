@@ -0,0 +1,643 @@
+from __future__ import annotations
+
+import hashlib
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Iterable, Optional, Protocol
+from uuid import uuid4
+
+from flask import current_app
+
+if TYPE_CHECKING:
+    from google.cloud import storage
+
+# ストレージバックエンドの実装と登録。
+# services.storage はここで登録されたバックエンドを名前（DB の storage_backend）で引いて使う。
+
+# GCS のレジューマブルアップロードはチャンクサイズが 256KiB の倍数である必要がある
+_GCS_CHUNK_ALIGNMENT = 256 * 1024
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ObjectStat:
+    """保存済みオブジェクトのメタデータ。"""
+
+    byte_size: int
+    content_type: str | None = None
+
+
+@dataclass(frozen=True)
+class BackendLocation:
+    """バックエンドを生成するときの保存先指定。"""
+
+    bucket_name: str | None
+    local_dir_key: str
+    default_local_dir: str
+
+
+class StorageBackend(Protocol):
+    """ストレージバックエンドが実装するインターフェース。"""
+
+    # DB の storage_backend に記録する名前
+    name: str
+    # ネットワーク越しのストレージか（ローカルディスクキャッシュ・後追いアップロードの対象）
+    remote: bool
+    # 採番時にオブジェクト名へ挟む中間ディレクトリの階層数
+    shard_depth: int
+    # DB の bucket に記録する値
+    bucket: str | None
+
+    def save(self, object_name: str, raw_bytes: bytes, *, content_type: str | None) -> None: ...
+
+    def save_stream(
+        self,
+        object_name: str,
+        chunks: Iterable[bytes],
+        *,
+        content_type: str | None,
+    ) -> tuple[int, str]:
+        """チャンクを順に書き込み、バイト数と sha256 を返す。"""
+        ...
+
+    def open(self, object_name: str) -> Optional[BinaryIO]:
+        """読み出し用のファイルオブジェクトを返す。存在しなければ None。"""
+        ...
+
+    def read(self, object_name: str) -> bytes | None: ...
+
+    def stat(self, object_name: str) -> ObjectStat | None: ...
+
+    def delete(self, object_name: str) -> bool: ...
+
+    def sign(self, object_name: str, *, expires_in: int) -> str | None:
+        """署名付き URL を返す。対応しないバックエンドは None。"""
+        ...
+
+
+BackendFactory = Callable[[BackendLocation], StorageBackend]
+
+_registry: dict[str, tuple[BackendFactory, bool]] = {}
+
+
+def register_backend(name: str, factory: BackendFactory, *, remote: bool = False) -> None:
+    """バックエンドを名前で登録する（同名は上書き）。remote はネットワーク越しのストレージか。"""
+
+    _registry[name.strip().lower()] = (factory, remote)
+
+
+def registered_backends() -> tuple[str, ...]:
+    return tuple(sorted(_registry))
+
+
+def is_remote_backend(name: str) -> bool:
+    entry = _registry.get(name)
+    return bool(entry and entry[1])
+
+
+def get_backend(name: str, location: BackendLocation) -> StorageBackend:
+    """登録済みのバックエンドを生成する。未登録の名前は ValueError。"""
+
+    entry = _registry.get(name)
+    if entry is None:
+        raise ValueError(f"未対応のストレージバックエンドです: {name}")
+    return entry[0](location)
+
+
+def _hash_chunks(chunks: Iterable[bytes], write: Callable[[bytes], Any]) -> tuple[int, str]:
+    digest = hashlib.sha256()
+    byte_size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        write(chunk)
+        byte_size += len(chunk)
+    return byte_size, digest.hexdigest()
+
+
+# --- local ---------------------------------------------------------------
+
+# 解決済みの基準ディレクトリと作成済みディレクトリ（プロセス内で使い回す）
+_local_dirs_lock = threading.Lock()
+_base_dir_cache: dict[tuple[str, str], Path] = {}
+_known_dirs: set[Path] = set()
+
+
+def _local_base_dir(config_key: str, default_dir: str) -> Path:
+    """ローカル保存先の基準ディレクトリを解決する。作成・検証は初回だけ行う。"""
+
+    configured = current_app.config.get(config_key) or default_dir
+    cache_key = (current_app.instance_path, str(configured))
+    base = _base_dir_cache.get(cache_key)
+    if base is not None:
+        return base
+
+    base = Path(configured)
+    if not base.is_absolute():
+        base = Path(current_app.instance_path) / base
+    base.mkdir(parents=True, exist_ok=True)
+    base = base.resolve()
+    if not os.access(base, os.W_OK):
+        raise PermissionError(f"ローカル保存先に書き込めません: {base}")
+    with _local_dirs_lock:
+        _base_dir_cache[cache_key] = base
+        _known_dirs.add(base)
+    return base
+
+
+def _ensure_local_dir(directory: Path) -> None:
+    if directory in _known_dirs:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    with _local_dirs_lock:
+        _known_dirs.add(directory)
+
+
+class LocalBackend:
+    """
+    ローカルディスクへ保存するバックエンド。
+
+    書き込みは一時ファイル経由の rename で原子的に行い、STORAGE_LOCAL_FSYNC が file なら
+    ファイルを、dir ならディレクトリエントリも fsync する。open() は実ファイルを返すので、
+    send_file 経由で WSGI サーバーの sendfile による配信になる。
+    """
+
+    name = "local"
+    remote = False
+    shard_depth = 2
+    bucket = None
+
+    def __init__(self, base_dir: Path) -> None:
+        self.base_dir = base_dir
+
+    def _path(self, object_name: str) -> Path:
+        # 基準ディレクトリ配下から外れるオブジェクト名は拒否する
+        parts = [part for part in object_name.split("/") if part]
+        if not parts or any(part in {".", ".."} for part in parts):
+            raise ValueError(f"不正なオブジェクト名です: {object_name}")
+        return self.base_dir.joinpath(*parts)
+
+    def save(self, object_name: str, raw_bytes: bytes, *, content_type: str | None) -> None:
+        self.save_stream(object_name, [raw_bytes], content_type=content_type)
+
+    def save_stream(
+        self,
+        object_name: str,
+        chunks: Iterable[bytes],
+        *,
+        content_type: str | None,
+    ) -> tuple[int, str]:
+        path = self._path(object_name)
+        _ensure_local_dir(path.parent)
+        policy = (current_app.config.get("STORAGE_LOCAL_FSYNC") or "file").strip().lower()
+        tmp_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        try:
+            handle = tmp_path.open("wb")
+        except FileNotFoundError:
+            # 作成済みとして記録したディレクトリが外部で消された場合は作り直す
+            with _local_dirs_lock:
+                _known_dirs.discard(path.parent)
+            _ensure_local_dir(path.parent)
+            handle = tmp_path.open("wb")
+        try:
+            with handle:
+                result = _hash_chunks(chunks, handle.write)
+                if policy in {"file", "dir"}:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                tmp_path.unlink()
+            except FileNotFoundError:
+                pass
+            raise
+        if policy == "dir":
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        return result
+
+    def open(self, object_name: str) -> Optional[BinaryIO]:
+        try:
+            return self._path(object_name).open("rb")
+        except FileNotFoundError:
+            return None
+
+    def read(self, object_name: str) -> bytes | None:
+        try:
+            return self._path(object_name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def stat(self, object_name: str) -> ObjectStat | None:
+        try:
+            return ObjectStat(byte_size=self._path(object_name).stat().st_size)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, object_name: str) -> bool:
+        try:
+            self._path(object_name).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def sign(self, object_name: str, *, expires_in: int) -> str | None:
+        return None
+
+
+# --- gcs -----------------------------------------------------------------
+
+
+_gcs_local = threading.local()
+
+
+@lru_cache(maxsize=1)
+def _gcs_credentials() -> tuple[Any, str | None]:
+    # 認証情報の探索（メタデータサーバーへの問い合わせなど）はプロセスで1回だけ行う
+    import google.auth
+    from google.cloud import storage
+
+    return google.auth.default(scopes=storage.Client.SCOPE)
+
+
+def warm_gcs_credentials() -> None:
+    """プロセスで共有する GCS の認証情報を読み込み、アクセストークンを取得しておく（ウォームアップ用）。"""
+
+    credentials, _ = _gcs_credentials()
+    if not credentials.valid:
+        from google.auth.transport.requests import Request
+
+        credentials.refresh(Request())
+
+
+def _gcs_client() -> storage.Client:
+    """
+    スレッドごとの GCS クライアントを返す。
+
+    google-cloud-storage は import が重いので、GCS を実際に使うまで読み込まない。
+    クライアントが内部で使う requests.Session はスレッドセーフでないため、
+    gthread ワーカーではスレッドごとに作り、認証情報だけを共有する。
+    """
+
+    client = getattr(_gcs_local, "client", None)
+    if client is None:
+        from google.cloud import storage
+
+        credentials, project = _gcs_credentials()
+        client = storage.Client(project=project, credentials=credentials)
+        _gcs_local.client = client
+    return client
+
+
+def _gcs_bucket(bucket_name: str) -> storage.Bucket:
+    return _gcs_client().bucket(bucket_name)
+
+
+def _gcs_not_found() -> type[Exception]:
+    from google.api_core.exceptions import NotFound
+
+    return NotFound
+
+
+class GCSBackend:
+    """Cloud Storage へ保存するバックエンド。"""
+
+    name = "gcs"
+    remote = True
+    shard_depth = 0
+
+    def __init__(self, bucket_name: str) -> None:
+        self.bucket = bucket_name
+        self._bucket = _gcs_bucket(bucket_name)
+
+    def save(self, object_name: str, raw_bytes: bytes, *, content_type: str | None) -> None:
+        blob = self._bucket.blob(object_name)
+        if content_type:
+            blob.upload_from_string(raw_bytes, content_type=content_type)
+        else:
+            blob.upload_from_string(raw_bytes)
+
+    def save_stream(
+        self,
+        object_name: str,
+        chunks: Iterable[bytes],
+        *,
+        content_type: str | None,
+    ) -> tuple[int, str]:
+        # 再開可能アップロードはセッション作成のリクエストが1回余分にかかるため、
+        # 1チャンクに収まる小さな添付は1回の upload_from_string で送る
+        iterator = iter(chunks)
+        head: list[bytes] = []
+        head_size = 0
+        for chunk in iterator:
+            head.append(chunk)
+            head_size += len(chunk)
+            if head_size > _UPLOAD_CHUNK_SIZE:
+                break
+        else:
+            raw_bytes = b"".join(head)
+            self.save(object_name, raw_bytes, content_type=content_type)
+            return len(raw_bytes), hashlib.sha256(raw_bytes).hexdigest()
+
+        blob = self._bucket.blob(object_name)
+        chunk_size = max(_UPLOAD_CHUNK_SIZE // _GCS_CHUNK_ALIGNMENT, 1) * _GCS_CHUNK_ALIGNMENT
+        with blob.open("wb", content_type=content_type, chunk_size=chunk_size) as writer:
+            return _hash_chunks(itertools.chain(head, iterator), writer.write)
+
+    def open(self, object_name: str) -> Optional[BinaryIO]:
+        raw_bytes = self.read(object_name)
+        return BytesIO(raw_bytes) if raw_bytes is not None else None
+
+    def read(self, object_name: str) -> bytes | None:
+        try:
+            return self._bucket.blob(object_name).download_as_bytes()
+        except _gcs_not_found():
+            return None
+
+    def stat(self, object_name: str) -> ObjectStat | None:
+        blob = self._bucket.get_blob(object_name)
+        if blob is None:
+            return None
+        return ObjectStat(byte_size=int(blob.size or 0), content_type=blob.content_type)
+
+    def delete(self, object_name: str) -> bool:
+        try:
+            self._bucket.blob(object_name).delete()
+        except _gcs_not_found():
+            return False
+        return True
+
+    def sign(self, object_name: str, *, expires_in: int) -> str | None:
+        return self._bucket.blob(object_name).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=expires_in),
+            method="GET",
+        )
+
+
+# --- memory --------------------------------------------------------------
+
+
+class _MemoryStore:
+    """名前空間ごとのバイト列を保持する LRU（合計サイズで上限を設ける）。"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._objects: "OrderedDict[tuple[str, str], tuple[bytes, str | None]]" = OrderedDict()
+        self._total = 0
+
+    def put(self, key: tuple[str, str], raw_bytes: bytes, content_type: str | None, max_bytes: int) -> None:
+        with self._lock:
+            previous = self._objects.pop(key, None)
+            if previous is not None:
+                self._total -= len(previous[0])
+            self._objects[key] = (raw_bytes, content_type)
+            self._total += len(raw_bytes)
+            while max_bytes > 0 and self._total > max_bytes and len(self._objects) > 1:
+                _, (evicted, _) = self._objects.popitem(last=False)
+                self._total -= len(evicted)
+
+    def get(self, key: tuple[str, str]) -> tuple[bytes, str | None] | None:
+        with self._lock:
+            entry = self._objects.get(key)
+            if entry is not None:
+                self._objects.move_to_end(key)
+            return entry
+
+    def pop(self, key: tuple[str, str]) -> bool:
+        with self._lock:
+            entry = self._objects.pop(key, None)
+            if entry is None:
+                return False
+            self._total -= len(entry[0])
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._objects.clear()
+            self._total = 0
+
+
+_memory_store = _MemoryStore()
+
+
+def reset_memory_backend() -> None:
+    """メモリバックエンドの内容を全て破棄する（テスト・ベンチマーク用）。"""
+
+    _memory_store.clear()
+
+
+class MemoryBackend:
+    """プロセス内メモリに保持するバックエンド（テスト・ベンチマーク用。再起動で消える）。"""
+
+    name = "memory"
+    remote = False
+    shard_depth = 0
+
+    def __init__(self, namespace: str, bucket_name: str | None, max_bytes: int) -> None:
+        self.bucket = bucket_name
+        self._namespace = namespace
+        self._max_bytes = max_bytes
+
+    def save(self, object_name: str, raw_bytes: bytes, *, content_type: str | None) -> None:
+        _memory_store.put((self._namespace, object_name), bytes(raw_bytes), content_type, self._max_bytes)
+
+    def save_stream(
+        self,
+        object_name: str,
+        chunks: Iterable[bytes],
+        *,
+        content_type: str | None,
+    ) -> tuple[int, str]:
+        buffer = BytesIO()
+        result = _hash_chunks(chunks, buffer.write)
+        self.save(object_name, buffer.getvalue(), content_type=content_type)
+        return result
+
+    def open(self, object_name: str) -> Optional[BinaryIO]:
+        raw_bytes = self.read(object_name)
+        return BytesIO(raw_bytes) if raw_bytes is not None else None
+
+    def read(self, object_name: str) -> bytes | None:
+        entry = _memory_store.get((self._namespace, object_name))
+        return entry[0] if entry is not None else None
+
+    def stat(self, object_name: str) -> ObjectStat | None:
+        entry = _memory_store.get((self._namespace, object_name))
+        if entry is None:
+            return None
+        return ObjectStat(byte_size=len(entry[0]), content_type=entry[1])
+
+    def delete(self, object_name: str) -> bool:
+        return _memory_store.pop((self._namespace, object_name))
+
+    def sign(self, object_name: str, *, expires_in: int) -> str | None:
+        return None
+
+
+# --- s3 ------------------------------------------------------------------
+
+
+_s3_lock = threading.Lock()
+
+
+@lru_cache(maxsize=8)
+def _s3_client(endpoint_url: str | None, region_name: str | None) -> Any:
+    try:
+        import boto3
+    except ImportError as exc:  # pragma: no cover - 依存がない環境向け
+        raise RuntimeError("s3 バックエンドを使うには boto3 をインストールしてください。") from exc
+    # boto3 のデフォルトセッションはスレッドセーフでないので専用セッションから作る
+    # （生成したクライアント自体はスレッド間で共有できる）
+    with _s3_lock:
+        return boto3.session.Session().client("s3", endpoint_url=endpoint_url, region_name=region_name)
+
+
+class _HashingReader:
+    """チャンクのイテレーターを、読み出しながら sha256 を計算するファイルオブジェクトに見せる。"""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._digest = hashlib.sha256()
+        self.byte_size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._digest.update(chunk)
+            self.byte_size += len(chunk)
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+class S3Backend:
+    """S3 互換ストレージ（AWS S3 / MinIO など）へ保存するバックエンド。"""
+
+    name = "s3"
+    remote = True
+    shard_depth = 0
+
+    def __init__(self, bucket_name: str, client: Any) -> None:
+        self.bucket = bucket_name
+        self._client = client
+
+    def _is_missing(self, exc: Exception) -> bool:
+        response = getattr(exc, "response", None) or {}
+        code = str(response.get("Error", {}).get("Code", ""))
+        return code in {"404", "NoSuchKey", "NotFound"}
+
+    def save(self, object_name: str, raw_bytes: bytes, *, content_type: str | None) -> None:
+        extra = {"ContentType": content_type} if content_type else {}
+        self._client.put_object(Bucket=self.bucket, Key=object_name, Body=raw_bytes, **extra)
+
+    def save_stream(
+        self,
+        object_name: str,
+        chunks: Iterable[bytes],
+        *,
+        content_type: str | None,
+    ) -> tuple[int, str]:
+        reader = _HashingReader(chunks)
+        extra = {"ExtraArgs": {"ContentType": content_type}} if content_type else {}
+        # upload_fileobj は大きいペイロードをマルチパートで分割して送る
+        self._client.upload_fileobj(reader, self.bucket, object_name, **extra)
+        return reader.byte_size, reader.hexdigest()
+
+    def open(self, object_name: str) -> Optional[BinaryIO]:
+        try:
+            return self._client.get_object(Bucket=self.bucket, Key=object_name)["Body"]
+        except Exception as exc:  # noqa: BLE001
+            if self._is_missing(exc):
+                return None
+            raise
+
+    def read(self, object_name: str) -> bytes | None:
+        body = self.open(object_name)
+        return body.read() if body is not None else None
+
+    def stat(self, object_name: str) -> ObjectStat | None:
+        try:
+            head = self._client.head_object(Bucket=self.bucket, Key=object_name)
+        except Exception as exc:  # noqa: BLE001
+            if self._is_missing(exc):
+                return None
+            raise
+        return ObjectStat(byte_size=int(head.get("ContentLength", 0)), content_type=head.get("ContentType"))
+
+    def delete(self, object_name: str) -> bool:
+        if self.stat(object_name) is None:
+            return False
+        self._client.delete_object(Bucket=self.bucket, Key=object_name)
+        return True
+
+    def sign(self, object_name: str, *, expires_in: int) -> str | None:
+        return self._client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": object_name},
+            ExpiresIn=expires_in,
+        )
+
+
+def reset_clients() -> None:
+    """キャッシュ済みの SDK クライアントを捨てる（fork 直後などに使う）。"""
+
+    _gcs_credentials.cache_clear()
+    _gcs_local.__dict__.clear()
+    _s3_client.cache_clear()
+
+
+# --- registration --------------------------------------------------------
+
+
+def _require_bucket(location: BackendLocation, label: str) -> str:
+    if not location.bucket_name:
+        raise ValueError(f"{label}バケット名が未設定です。")
+    return location.bucket_name
+
+
+def _create_local(location: BackendLocation) -> StorageBackend:
+    return LocalBackend(_local_base_dir(location.local_dir_key, location.default_local_dir))
+
+
+def _create_gcs(location: BackendLocation) -> StorageBackend:
+    return GCSBackend(_require_bucket(location, "GCS"))
+
+
+def _create_memory(location: BackendLocation) -> StorageBackend:
+    namespace = location.bucket_name or location.local_dir_key
+    max_bytes = int(current_app.config.get("STORAGE_MEMORY_MAX_BYTES", 0))
+    return MemoryBackend(namespace, location.bucket_name, max_bytes)
+
+
+def _create_s3(location: BackendLocation) -> StorageBackend:
+    client = _s3_client(
+        current_app.config.get("STORAGE_S3_ENDPOINT_URL") or None,
+        current_app.config.get("STORAGE_S3_REGION") or None,
+    )
+    return S3Backend(_require_bucket(location, "S3"), client)
+
+
+register_backend("local", _create_local)
+register_backend("gcs", _create_gcs, remote=True)
+register_backend("memory", _create_memory)
+register_backend("s3", _create_s3, remote=True)
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+from uuid import uuid4
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# GCS から読んだオブジェクトのローカルディスクキャッシュ（read-through）。
+# ファイルシステム上に置くので、同じコンテナ内の gunicorn ワーカー間で共有される。
+# 容量は STORAGE_CACHE_MAX_BYTES で制限し、超えたら最終アクセス（mtime）の古い順に削除する。
+# 合計サイズはアップロードスプールと同じく .usage ファイルに持ち（.lock への flock で直列化）、
+# ディレクトリの走査は上限を超えて追い出すときだけにする。
+# 各エントリの先頭には書き込み時に確認した内容の sha256（32バイト）を置き、読み出し時は
+# 期待値と見比べるだけで再計算しない（STORAGE_CACHE_VERIFY_ON_READ で再計算も行う）。
+
+_LOCK_FILE = ".lock"
+_USAGE_FILE = ".usage"
+_DIGEST_SIZE = hashlib.sha256().digest_size
+# 追い出すときは上限のこの割合まで減らし、次の書き込みですぐ走査し直さないようにする
+_EVICT_TARGET_RATIO = 0.9
+
+_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return int(current_app.config.get("STORAGE_CACHE_MAX_BYTES", 0)) > 0
+
+
+def _base_dir() -> Path:
+    configured = current_app.config.get("STORAGE_CACHE_DIR") or "storage_cache"
+    base = Path(configured)
+    if not base.is_absolute():
+        base = Path(current_app.instance_path) / base
+    base.mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def _path_for(backend: str, bucket_name: str | None, object_name: str) -> Path:
+    # 先頭に sha256 を置く形式へ変えたので、以前の形式のエントリとはキーを分ける（古いものは追い出しで消える）
+    key = hashlib.sha256(f"v2:{backend}:{bucket_name or ''}:{object_name}".encode("utf-8")).hexdigest()
+    return _base_dir() / key[:2] / key
+
+
+@contextmanager
+def _locked(base: Path) -> Iterator[None]:
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        with (base / _LOCK_FILE).open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _scan_entries(base: Path) -> list[tuple[float, int, str]]:
+    entries: list[tuple[float, int, str]] = []
+    with os.scandir(base) as shards:
+        for shard in shards:
+            # .lock / .usage はシャードのディレクトリではないので数えない
+            if shard.name.startswith(".") or not shard.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(shard.path) as shard_entries:
+                for entry in shard_entries:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def _store_used_bytes(base: Path, used: int) -> None:
+    tmp_path = base / f"{_USAGE_FILE}.{uuid4().hex}.tmp"
+    tmp_path.write_text(str(max(used, 0)), encoding="ascii")
+    os.replace(tmp_path, base / _USAGE_FILE)
+
+
+def _used_bytes(base: Path) -> int:
+    try:
+        return int((base / _USAGE_FILE).read_text(encoding="ascii"))
+    except (FileNotFoundError, ValueError):
+        used = sum(size for _, size, _ in _scan_entries(base))
+        _store_used_bytes(base, used)
+        return used
+
+
+def _read_entry(path: Path) -> tuple[bytes, bytes] | None:
+    try:
+        with path.open("rb") as entry_file:
+            digest = entry_file.read(_DIGEST_SIZE)
+            raw_bytes = entry_file.read()
+    except FileNotFoundError:
+        return None
+    if len(digest) != _DIGEST_SIZE:
+        return None
+    return digest, raw_bytes
+
+
+def get(
+    *,
+    backend: str,
+    bucket_name: str | None,
+    object_name: str,
+    expected_sha256: str | None = None,
+) -> bytes | None:
+    """キャッシュ済みのバイト列を返す。未登録・ハッシュ不一致なら None。"""
+
+    path = _path_for(backend, bucket_name, object_name)
+    entry = _read_entry(path)
+    if entry is None:
+        return None
+    digest, raw_bytes = entry
+    stale = bool(expected_sha256) and digest.hex() != expected_sha256
+    verify = bool(current_app.config.get("STORAGE_CACHE_VERIFY_ON_READ"))
+    if stale or (verify and hashlib.sha256(raw_bytes).digest() != digest):
+        # 壊れた・古いエントリは捨てて取り直させる
+        _remove(path)
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return raw_bytes
+
+
+def put(
+    *,
+    backend: str,
+    bucket_name: str | None,
+    object_name: str,
+    raw_bytes: bytes,
+    expected_sha256: str | None = None,
+) -> bool:
+    """バイト列をキャッシュへ書き込む。ハッシュ不一致や容量超過の場合は書かない。"""
+
+    max_bytes = int(current_app.config.get("STORAGE_CACHE_MAX_BYTES", 0))
+    entry_size = _DIGEST_SIZE + len(raw_bytes)
+    if max_bytes <= 0 or entry_size > max_bytes:
+        return False
+    digest = hashlib.sha256(raw_bytes).digest()
+    if expected_sha256 and digest.hex() != expected_sha256:
+        return False
+
+    path = _path_for(backend, bucket_name, object_name)
+    base = path.parent.parent
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+    try:
+        tmp_path.write_bytes(digest + raw_bytes)
+        with _locked(base):
+            used = _used_bytes(base) - _entry_size(path) + entry_size
+            os.replace(tmp_path, path)
+            if used > max_bytes:
+                used = _evict(base, int(max_bytes * _EVICT_TARGET_RATIO))
+            _store_used_bytes(base, used)
+    finally:
+        _unlink(tmp_path)
+    return True
+
+
+def discard(*, backend: str, bucket_name: str | None, object_name: str) -> None:
+    """オブジェクト削除・差し替え時にエントリを捨てる。"""
+
+    _remove(_path_for(backend, bucket_name, object_name))
+
+
+def _entry_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _remove(path: Path) -> None:
+    base = path.parent.parent
+    with _locked(base):
+        size = _entry_size(path)
+        if not size:
+            return
+        _unlink(path)
+        _store_used_bytes(base, _used_bytes(base) - size)
+
+
+def _unlink(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _evict(base: Path, target_bytes: int) -> int:
+    """ロックを持った状態で呼ぶ。mtime の古い順に target_bytes 以下まで削除し、残りの合計を返す。"""
+
+    entries = _scan_entries(base)
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= target_bytes:
+            break
+        _unlink(Path(entry_path))
+        total -= size
+    return total
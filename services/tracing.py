@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+from flask import Flask, g, request
+from sqlalchemy import event
+
+from extensions import db
+
+# OpenTelemetry によるトレース（TRACING_ENABLED=true のときのみ）。
+# Flask のリクエスト・SQL・モデル呼び出し（illust）・ストレージ操作をスパンにし、
+# TRACING_EXPORTER（otlp / console / file）へ出力する。無効時は opentelemetry を import せず、
+# span() は何もしない（SDK の import は起動時間に効くため）。
+
+_T = TypeVar("_T")
+EXPORTERS = ("otlp", "console", "file")
+_STATEMENT_MAX_CHARS = 2000
+
+_lock = threading.Lock()
+_provider: Any = None
+_tracer: Any = None
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def _build_exporter(app: Flask) -> Any:
+    exporter = (app.config.get("TRACING_EXPORTER") or "otlp").strip().lower()
+    if exporter not in EXPORTERS:
+        raise RuntimeError(f"TRACING_EXPORTER は {', '.join(EXPORTERS)} のいずれかを指定してください: {exporter}")
+    if exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as exc:
+            raise RuntimeError(
+                "TRACING_EXPORTER=otlp には opentelemetry-exporter-otlp-proto-http が必要です。"
+            ) from exc
+        # 送信先は OTEL_EXPORTER_OTLP_ENDPOINT / OTEL_EXPORTER_OTLP_HEADERS など標準の環境変数で指定する
+        return OTLPSpanExporter()
+
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    if exporter == "console":
+        return ConsoleSpanExporter()
+    path = Path(app.config.get("TRACING_FILE_PATH") or "traces.jsonl")
+    if not path.is_absolute():
+        path = Path(app.instance_path) / path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 1スパン1行の JSON Lines（複数ワーカーから追記する）
+    return ConsoleSpanExporter(
+        out=path.open("a", encoding="utf-8", buffering=1),
+        formatter=lambda span: span.to_json(indent=None) + "\n",
+    )
+
+
+def _build_provider(app: Flask) -> Any:
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    except ImportError as exc:
+        raise RuntimeError("TRACING_ENABLED=true には opentelemetry-sdk が必要です。") from exc
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": app.config.get("TRACING_SERVICE_NAME") or "rough-to-illustration"}),
+        # 上流（Cloud Run のロードバランサーなど）がサンプリング済みならその判断に従う
+        sampler=ParentBased(TraceIdRatioBased(float(app.config.get("TRACING_SAMPLE_RATIO", 1.0)))),
+    )
+    provider.add_span_processor(BatchSpanProcessor(_build_exporter(app)))
+    return provider
+
+
+def configure(app: Flask) -> None:
+    """トレースを有効にし、Flask と SQLAlchemy のフックを登録する（create_app から呼ぶ）。"""
+
+    if not app.config.get("TRACING_ENABLED"):
+        return
+
+    global _provider, _tracer
+    with _lock:
+        previous = _provider
+        _provider = _build_provider(app)
+        _tracer = _provider.get_tracer("rough_to_illustration")
+    if previous is not None:
+        previous.shutdown()
+
+    _register_request_hooks(app)
+    with app.app_context():
+        engine = db.engine
+    # エンジンはアプリごとに作られるので、同じエンジンへ二重に登録しない
+    if not event.contains(engine, "before_cursor_execute", _start_query_span):
+        event.listen(engine, "before_cursor_execute", _start_query_span)
+        event.listen(engine, "after_cursor_execute", _end_query_span)
+        event.listen(engine, "handle_error", _fail_query_span)
+
+
+def shutdown() -> None:
+    """未送信のスパンを出力して終了する（gunicorn の worker_exit などから呼ぶ）。"""
+
+    global _provider, _tracer
+    with _lock:
+        provider, _provider, _tracer = _provider, None, None
+    if provider is not None:
+        provider.shutdown()
+
+
+def flush() -> None:
+    if _provider is not None:
+        _provider.force_flush()
+
+
+def _clean(attributes: dict[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in attributes.items() if value is not None}
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """
+    現在のスパンの子スパンを作る。トレース無効時は None を渡して何もしない。
+
+    例外はスパンに記録して送出し直す。属性は yield されたスパンへ後から追加できる（set_attributes）。
+    """
+
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=_clean(attributes)) as current:
+        yield current
+
+
+def set_attributes(current: Any, **attributes: Any) -> None:
+    if current is not None:
+        current.set_attributes(_clean(attributes))
+
+
+def current_trace_id() -> Optional[str]:
+    """現在のトレース ID（32桁の16進）。トレース無効・スパン外なら None。"""
+
+    if _tracer is None:
+        return None
+    from opentelemetry import trace
+
+    context = trace.get_current_span().get_span_context()
+    return format(context.trace_id, "032x") if context.is_valid else None
+
+
+def wrap_with_context(fn: Callable[..., _T]) -> Callable[..., _T]:
+    """
+    別スレッドで実行する処理に、呼び出し元のトレースコンテキストを引き継ぐ。
+
+    ThreadPoolExecutor は contextvars を引き継がないため、そのままだとモデル呼び出しのスパンが
+    リクエストのトレースから切り離される。
+    """
+
+    if _tracer is None:
+        return fn
+    context = contextvars.copy_context()
+
+    def traced(*args: Any, **kwargs: Any) -> _T:
+        return context.run(fn, *args, **kwargs)
+
+    return traced
+
+
+# --- Flask -----------------------------------------------------------------------
+
+
+def _register_request_hooks(app: Flask) -> None:
+    @app.before_request
+    def start_request_span():
+        if _tracer is None:
+            return
+        from opentelemetry import context, propagate, trace
+
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        current = _tracer.start_span(
+            f"{request.method} {route}",
+            # traceparent ヘッダーがあれば呼び出し元のトレースにつなげる
+            context=propagate.extract(request.headers),
+            kind=trace.SpanKind.SERVER,
+            attributes=_clean(
+                {
+                    "http.request.method": request.method,
+                    "http.route": route,
+                    "url.path": request.path,
+                    "app.request_id": g.get("request_id"),
+                }
+            ),
+        )
+        g.trace_span = current
+        g.trace_token = context.attach(trace.set_span_in_context(current))
+
+    @app.after_request
+    def record_response_status(response):
+        current = g.get("trace_span")
+        if current is not None:
+            current.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                from opentelemetry.trace import Status, StatusCode
+
+                current.set_status(Status(StatusCode.ERROR))
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        current = g.pop("trace_span", None)
+        token = g.pop("trace_token", None)
+        if current is None:
+            return
+        from opentelemetry import context
+
+        if exc is not None:
+            current.record_exception(exc)
+        current.end()
+        if token is not None:
+            context.detach(token)
+
+
+# --- SQLAlchemy ------------------------------------------------------------------
+
+
+def _start_query_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    if _tracer is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+    current = _tracer.start_span(
+        f"db {operation}",
+        attributes={
+            "db.system": conn.dialect.name,
+            "db.operation.name": operation,
+            "db.query.text": statement[:_STATEMENT_MAX_CHARS],
+            "db.executemany": bool(executemany),
+        },
+    )
+    context._trace_span = current
+
+
+def _end_query_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    current = getattr(context, "_trace_span", None)
+    if current is None:
+        return
+    rowcount = getattr(cursor, "rowcount", -1)
+    if isinstance(rowcount, int) and rowcount >= 0:
+        current.set_attribute("db.response.returned_rows", rowcount)
+    current.end()
+    context._trace_span = None
+
+
+def _fail_query_span(exception_context) -> None:
+    context = exception_context.execution_context
+    current = getattr(context, "_trace_span", None) if context is not None else None
+    if current is None:
+        return
+    from opentelemetry.trace import Status, StatusCode
+
+    current.record_exception(exception_context.original_exception)
+    current.set_status(Status(StatusCode.ERROR))
+    current.end()
+    context._trace_span = None
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+from uuid import uuid4
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# GCS への後追いアップロード（write-behind）待ちのバイト列を置くローカルスプール。
+# 合計サイズは GENERATION_SPOOL_MAX_BYTES で制限し、超える場合は呼び出し側が同期アップロードに切り替える。
+# 合計は .usage ファイルに持ち、.lock への flock で同じディレクトリを使う gunicorn ワーカー間でも直列化する
+# （書き込みごとにディレクトリを走査しない）。fcntl の無い環境ではプロセス内のロックだけになり、
+# 複数プロセスで共有すると上限はおおよその値になる。
+
+_LOCK_FILE = ".lock"
+_USAGE_FILE = ".usage"
+
+_lock = threading.Lock()
+
+
+def _base_dir() -> Path:
+    configured = current_app.config.get("GENERATION_SPOOL_DIR") or "upload_spool"
+    base = Path(configured)
+    if not base.is_absolute():
+        base = Path(current_app.instance_path) / base
+    base.mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def _path_for(object_name: str) -> Path:
+    # オブジェクト名の階層はファイル名に畳み込む（スプールは1階層で管理する）
+    return _base_dir() / object_name.strip("/").replace("/", "__")
+
+
+@contextmanager
+def _locked(base: Path) -> Iterator[None]:
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        with (base / _LOCK_FILE).open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _scan_used_bytes(base: Path) -> int:
+    total = 0
+    with os.scandir(base) as entries:
+        for entry in entries:
+            # .lock / .usage / 書きかけの一時ファイルは数えない
+            if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def _store_used_bytes(base: Path, used: int) -> None:
+    tmp_path = base / f"{_USAGE_FILE}.{uuid4().hex}.tmp"
+    tmp_path.write_text(str(max(used, 0)), encoding="ascii")
+    os.replace(tmp_path, base / _USAGE_FILE)
+
+
+def _used_bytes(base: Path) -> int:
+    try:
+        return int((base / _USAGE_FILE).read_text(encoding="ascii"))
+    except (FileNotFoundError, ValueError):
+        used = _scan_used_bytes(base)
+        _store_used_bytes(base, used)
+        return used
+
+
+def recalculate() -> int:
+    """スプールを走査して合計サイズを数え直す（起動時の再投入から呼ぶ）。合計バイト数を返す。"""
+
+    base = _base_dir()
+    with _locked(base):
+        used = _scan_used_bytes(base)
+        _store_used_bytes(base, used)
+    return used
+
+
+def write(object_name: str, raw_bytes: bytes) -> bool:
+    """スプールへ書き込む。容量上限を超える場合は書かずに False を返す。"""
+
+    max_bytes = int(current_app.config.get("GENERATION_SPOOL_MAX_BYTES", 0))
+    path = _path_for(object_name)
+    base = path.parent
+    with _locked(base):
+        used = _used_bytes(base)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        if max_bytes > 0 and used - replaced + len(raw_bytes) > max_bytes:
+            return False
+        tmp_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        tmp_path.write_bytes(raw_bytes)
+        os.replace(tmp_path, path)
+        _store_used_bytes(base, used - replaced + len(raw_bytes))
+    return True
+
+
+def read(object_name: str) -> bytes | None:
+    """スプール上のバイト列を返す。アップロード済みで削除されていれば None。"""
+
+    try:
+        return _path_for(object_name).read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def exists(object_name: str) -> bool:
+    return _path_for(object_name).is_file()
+
+
+def remove(object_name: str) -> None:
+    """アップロード完了後にスプールから削除する。"""
+
+    path = _path_for(object_name)
+    base = path.parent
+    with _locked(base):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        _store_used_bytes(base, _used_bytes(base) - size)
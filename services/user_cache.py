@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+# 認証済みリクエストごとの users テーブル参照を省くためのプロセス内キャッシュ。
+# ワーカー間では共有しないため、他ワーカーでの変更は TTL 経過後に反映される。
+
+_MAX_ENTRIES = 1024
+
+_lock = threading.Lock()
+_entries: "OrderedDict[int, tuple[float, UserSnapshot]]" = OrderedDict()
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Flask-Login の current_user として使う不変のユーザー情報。"""
+
+    id: int
+    username: str
+    email: str
+    role: str
+    is_active: bool
+    is_initial_user: bool
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def is_anonymous(self) -> bool:
+        return False
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == "admin"
+
+    def get_id(self) -> str:
+        return str(self.id)
+
+
+def get(user_id: int, ttl_seconds: float) -> Optional[UserSnapshot]:
+    """TTL 内のスナップショットを返す。期限切れ・未登録なら None。"""
+
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None:
+            return None
+        stored_at, snapshot = entry
+        if now - stored_at > ttl_seconds:
+            del _entries[user_id]
+            return None
+        _entries.move_to_end(user_id)
+        return snapshot
+
+
+def put(snapshot: UserSnapshot) -> UserSnapshot:
+    """スナップショットを登録する。上限を超えたら古いものから捨てる。"""
+
+    with _lock:
+        _entries[snapshot.id] = (time.monotonic(), snapshot)
+        _entries.move_to_end(snapshot.id)
+        while len(_entries) > _MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return snapshot
+
+
+def invalidate(user_id: int) -> None:
+    """権限・有効状態・パスワード変更時に該当ユーザーを破棄する。"""
+
+    with _lock:
+        _entries.pop(user_id, None)
+
+
+def clear() -> None:
+    """キャッシュを全て破棄する。"""
+
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Callable, Optional
+
+from flask import Flask, current_app
+from PIL import Image
+from sqlalchemy import text
+
+from extensions import db
+from services import storage, storage_backends
+
+# gunicorn ワーカーが最初のリクエストを受ける前に行う初期化。
+# SDK の import・クライアント生成・DB 接続・PIL プラグイン登録は初回利用時まで遅延しているため、
+# そのままだと各ワーカーの最初のリクエストがその時間を払うことになる。
+
+
+def preload_image_plugins() -> None:
+    """PNG/JPEG など主要な PIL プラグインを登録しておく（初回の Image.open で行われる処理）。"""
+
+    Image.preinit()
+
+
+def reset_after_fork(app: Optional[Flask] = None) -> None:
+    """
+    fork 直後に、親プロセスから引き継いだクライアントと DB 接続を子プロセスで作り直させる。
+
+    preload_app でマスターがアプリを読み込んでいる場合に、ソケットを複数プロセスで共有しないようにする。
+    """
+
+    from illust import _client
+
+    _client.cache_clear()
+    storage_backends.reset_clients()
+    if app is not None:
+        with app.app_context():
+            # close=False: 親の接続は閉じずに手放すだけにする（親側の接続を壊さない）
+            db.engine.dispose(close=False)
+
+
+def _warm_pil() -> str:
+    preload_image_plugins()
+    return f"{len(Image.OPEN)} formats"
+
+
+def _warm_db() -> str:
+    engine = db.engine
+    pool_size = getattr(engine.pool, "size", lambda: 1)()
+    count = max(min(int(current_app.config.get("WARMUP_DB_CONNECTIONS", 1)), pool_size), 1)
+    connections = [engine.connect() for _ in range(count)]
+    try:
+        for connection in connections:
+            connection.execute(text("SELECT 1"))
+    finally:
+        # 閉じるとプールへ戻り、次のリクエストがそのまま使える
+        for connection in connections:
+            connection.close()
+    return f"{count} connection(s)"
+
+
+def _warm_genai() -> str:
+    from illust import _client, model_backend
+
+    backend = model_backend()
+    if backend == "genai" and not (os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")):
+        return "skipped (no api key)"
+    _client()
+    return "ready" if backend == "genai" else f"ready ({backend})"
+
+
+def _warm_storage() -> str:
+    """
+    リモートストレージのうちプロセスで共有されるものを準備する。
+
+    GCS のクライアントはスレッドごとに作られる（gthread のリクエストスレッドやアップロード用の
+    スレッドプールでは別のクライアントになる）ため、ここでは共有の認証情報とトークンだけを用意する。
+    S3 のクライアントはスレッド間で共有されるので、バックエンドの生成でクライアントまで作る。
+    """
+
+    warmed: list[str] = []
+    for storage_key, bucket_key, dir_key, default_dir in (
+        ("CHAT_IMAGE_STORAGE", "CHAT_IMAGE_BUCKET", "CHAT_IMAGE_DIR", "chat_images"),
+        ("GENERATION_IMAGE_STORAGE", "GENERATION_IMAGE_BUCKET", "GENERATION_IMAGE_DIR", "generated_images"),
+    ):
+        backend_name = current_app.config.get(storage_key)
+        if not storage.is_remote(backend_name):
+            continue
+        if backend_name.strip().lower() == "gcs":
+            storage_backends.warm_gcs_credentials()
+            warmed.append("gcs:credentials")
+            continue
+        backend = storage.resolve_backend(
+            backend_name,
+            bucket_name=current_app.config.get(bucket_key),
+            local_dir_key=dir_key,
+            default_local_dir=default_dir,
+        )
+        warmed.append(f"{backend.name}:{backend.bucket}")
+    return ", ".join(dict.fromkeys(warmed)) or "skipped (local)"
+
+
+def _probe(app: Flask) -> str:
+    path = app.config.get("WARMUP_PROBE_PATH")
+    if not path:
+        return "skipped"
+    # ルーティング・JSON 応答などリクエスト処理経路の初回コストを払っておく
+    response = app.test_client().get(path)
+    return str(response.status_code)
+
+
+def run(app: Flask) -> dict[str, dict[str, object]]:
+    """
+    ワーカーの初期化をまとめて行い、段階ごとの結果と所要時間（ミリ秒）を返す。
+
+    各段階の失敗はログに残すだけで送出しない（ウォームアップ失敗でワーカーを落とさない）。
+    """
+
+    steps: list[tuple[str, Callable[[], str]]] = [
+        ("pil", _warm_pil),
+        ("db", _warm_db),
+        ("genai", _warm_genai),
+        ("storage", _warm_storage),
+    ]
+    results: dict[str, dict[str, object]] = {}
+    with app.app_context():
+        for name, step in steps:
+            results[name] = _run_step(app, name, step)
+    results["probe"] = _run_step(app, "probe", lambda: _probe(app))
+    app.logger.info(
+        "Warmup finished: %s",
+        ", ".join(f"{name}={result['status']} ({result['ms']}ms)" for name, result in results.items()),
+    )
+    return results
+
+
+def _run_step(app: Flask, name: str, step: Callable[[], str]) -> dict[str, object]:
+    started = time.perf_counter()
+    try:
+        status = step()
+    except Exception as exc:  # noqa: BLE001
+        app.logger.warning("Warmup step %s failed: %s", name, exc)
+        status = f"failed ({exc.__class__.__name__})"
+    return {"status": status, "ms": int((time.perf_counter() - started) * 1000)}
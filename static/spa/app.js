@@ -5,7 +5,10 @@
   options: { aspect_ratio_options: [], resolution_options: [] },
   presets: [],
   sessions: [],
+  sessionsNextBeforeId: null,
   currentSessionId: null,
+  chatMessages: [],
+  chatNextBeforeId: null,
   currentView: 'generate',
   lastResult: null,
   csrfToken: null,
@@ -636,10 +639,20 @@ const renderChatSessions = () => {
     `;
     elements.chatSessionList.appendChild(item);
   });
+  if (state.sessionsNextBeforeId) {
+    const more = document.createElement('button');
+    more.type = 'button';
+    more.className = 'list-group-item list-group-item-action text-center small';
+    more.dataset.action = 'load-more-sessions';
+    more.textContent = 'さらに表示';
+    elements.chatSessionList.appendChild(more);
+  }
 };
 
-const renderChatMessages = (messages) => {
+const renderChatMessages = (messages, { preserveScroll = false } = {}) => {
   if (!elements.chatMessages) return;
+  const previousHeight = elements.chatMessages.scrollHeight;
+  const previousTop = elements.chatMessages.scrollTop;
   elements.chatMessages.innerHTML = '';
   if (!messages || messages.length === 0) {
     const empty = document.createElement('div');
@@ -648,6 +661,14 @@ const renderChatMessages = (messages) => {
     elements.chatMessages.appendChild(empty);
     return;
   }
+  if (state.chatNextBeforeId) {
+    const older = document.createElement('button');
+    older.type = 'button';
+    older.className = 'btn btn-sm btn-outline-light w-100 mb-2';
+    older.dataset.action = 'load-older-messages';
+    older.textContent = '以前のメッセージを読み込む';
+    elements.chatMessages.appendChild(older);
+  }
   messages.forEach((message) => {
     const wrapper = document.createElement('div');
     wrapper.className = `chat-message ${message.role === 'user' ? 'is-user' : 'is-assistant'}`;
@@ -697,6 +718,10 @@ const renderChatMessages = (messages) => {
     wrapper.appendChild(bubble);
     elements.chatMessages.appendChild(wrapper);
   });
+  if (preserveScroll) {
+    elements.chatMessages.scrollTop = elements.chatMessages.scrollHeight - previousHeight + previousTop;
+    return;
+  }
   elements.chatMessages.scrollTop = elements.chatMessages.scrollHeight;
 };
 
@@ -764,12 +789,25 @@ const loadPresets = async (modeId) => {
 const loadSessions = async () => {
   const payload = await apiFetch('/api/chat/sessions');
   state.sessions = payload.sessions || [];
+  state.sessionsNextBeforeId = payload.next_before_id || null;
   if (!state.currentSessionId && state.sessions.length > 0) {
     state.currentSessionId = state.sessions[0].id;
   }
   renderChatSessions();
 };
 
+const loadMoreSessions = async () => {
+  if (!state.sessionsNextBeforeId) return;
+  const payload = await apiFetch(
+    `/api/chat/sessions?before_id=${encodeURIComponent(state.sessionsNextBeforeId)}`,
+  );
+  const knownIds = new Set(state.sessions.map((session) => session.id));
+  const nextSessions = (payload.sessions || []).filter((session) => !knownIds.has(session.id));
+  state.sessions = [...state.sessions, ...nextSessions];
+  state.sessionsNextBeforeId = payload.next_before_id || null;
+  renderChatSessions();
+};
+
 const loadSessionMessages = async (sessionId) => {
   const payload = await apiFetch(`/api/chat/sessions/${sessionId}`);
   const session = payload.session;
@@ -777,13 +815,31 @@ const loadSessionMessages = async (sessionId) => {
   state.currentSessionId = session.id;
   if (elements.chatSessionId) elements.chatSessionId.value = session.id;
   if (elements.currentSessionBadge) elements.currentSessionBadge.textContent = `セッションID: ${session.id}`;
-  renderChatMessages(session.messages || []);
+  state.chatMessages = session.messages || [];
+  state.chatNextBeforeId = session.next_before_id || null;
+  renderChatMessages(state.chatMessages);
   renderChatSessions();
 };
 
+const loadOlderMessages = async () => {
+  if (!state.currentSessionId || !state.chatNextBeforeId) return;
+  const sessionId = state.currentSessionId;
+  const payload = await apiFetch(
+    `/api/chat/sessions/${sessionId}/messages?before_id=${encodeURIComponent(state.chatNextBeforeId)}`,
+  );
+  if (state.currentSessionId !== sessionId) return;
+  state.chatMessages = [...(payload.messages || []), ...state.chatMessages];
+  state.chatNextBeforeId = payload.next_before_id || null;
+  renderChatMessages(state.chatMessages, { preserveScroll: true });
+};
+
 const ensureChatReady = async () => {
   if (!state.user) return;
   await loadSessions();
+  if (state.sessions.length === 0) {
+    await handleNewSession();
+    return;
+  }
   if (state.currentSessionId) {
     await loadSessionMessages(state.currentSessionId);
   }
@@ -1048,6 +1104,17 @@ const bindEvents = () => {
 
   if (elements.chatSessionList) {
     elements.chatSessionList.addEventListener('click', async (event) => {
+      const moreButton = event.target.closest('[data-action="load-more-sessions"]');
+      if (moreButton) {
+        moreButton.disabled = true;
+        try {
+          await loadMoreSessions();
+        } catch (error) {
+          moreButton.disabled = false;
+          showStatus(error.message || 'セッション一覧の取得に失敗しました。', 'danger');
+        }
+        return;
+      }
       const target = event.target.closest('[data-session-id]');
       if (!target) return;
       const sessionId = Number(target.dataset.sessionId);
@@ -1056,6 +1123,20 @@ const bindEvents = () => {
     });
   }
 
+  if (elements.chatMessages) {
+    elements.chatMessages.addEventListener('click', async (event) => {
+      const target = event.target.closest('[data-action="load-older-messages"]');
+      if (!target) return;
+      target.disabled = true;
+      try {
+        await loadOlderMessages();
+      } catch (error) {
+        target.disabled = false;
+        showStatus(error.message || 'メッセージの取得に失敗しました。', 'danger');
+      }
+    });
+  }
+
   if (elements.chatModeSelect) {
     elements.chatModeSelect.addEventListener('change', () => {
       toggleChatExtras(elements.chatModeSelect.value);
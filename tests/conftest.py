@@ -1,8 +1,33 @@
 from __future__ import annotations
 
 import sys
+from contextlib import contextmanager
 from pathlib import Path
 
+import pytest
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))
+
+
+@pytest.fixture
+def assert_max_queries():
+    """
+    範囲内で実行した SQL が上限以下であることを確かめる（N+1 の再発防止用）。
+
+        with assert_max_queries(5):
+            client.get("/api/generations")
+    """
+
+    from services import query_stats
+
+    @contextmanager
+    def check(limit: int):
+        with query_stats.capture() as stats:
+            yield stats
+        assert stats.count <= limit, (
+            f"{stats.count} queries executed (limit {limit}):\n" + "\n".join(stats.statements)
+        )
+
+    return check
@@ -210,3 +210,187 @@ def test_non_admin_cannot_promote_user(client, app):
         headers={"X-CSRFToken": get_csrf_token(client)},
     )
     assert response.status_code == 403
+
+
+def test_authenticated_requests_reuse_cached_user(client, app):
+    from sqlalchemy import event
+
+    login_admin(client)
+    client.get("/api/me")
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.get("/api/me")
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert response.status_code == 200
+    assert json.loads(response.data)["user"]["username"] == "admin"
+    assert not [statement for statement in statements if "FROM users" in statement]
+
+
+def test_deactivated_user_is_rejected_on_next_request(app):
+    with app.app_context():
+        user = User(username="member", email="member@example.com")
+        user.set_password("member-password")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    member_client = app.test_client()
+    login_user(member_client, "member", "member-password")
+    assert member_client.get("/api/me").status_code == 200
+
+    admin_client = app.test_client()
+    login_admin(admin_client)
+    response = admin_client.patch(
+        f"/api/admin/users/{user_id}/status",
+        json={"is_active": False},
+        headers={"X-CSRFToken": get_csrf_token(admin_client)},
+    )
+    assert response.status_code == 200
+
+    assert member_client.get("/api/presets").status_code == 403
+
+
+def test_admin_generations_expose_stage_timings(client, monkeypatch):
+    from io import BytesIO
+
+    from PIL import Image
+
+    from illust import GeneratedImage
+
+    image = Image.new("RGB", (4, 4), (0, 0, 255))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+
+    def fake_generate_image(*args, timer=None, **kwargs):
+        with timer.stage("model_call"):
+            pass
+        return GeneratedImage(image=image, raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+
+    login_admin(client)
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "blue",
+            "pose_instruction": "pose",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+
+    response = client.get("/api/admin/generations")
+    assert response.status_code == 200
+    payload = json.loads(response.data)
+    timings = payload["generations"][0]["stage_timings"]
+    for stage_name in ("upload_read", "decode", "prompt_build", "model_call", "storage_write", "db_flush"):
+        assert stage_name in timings
+    assert payload["stage_stats"]["model_call"]["count"] == 1
+
+
+def test_admin_can_profile_a_single_request(client, app, monkeypatch, tmp_path):
+    import time
+    from io import BytesIO
+
+    from PIL import Image
+
+    from illust import GeneratedImage
+
+    app.config.update(PROFILING_ENABLED=True, PROFILING_DIR=str(tmp_path / "profiles"))
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (0, 0, 255)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+
+    def fake_generate_image(*args, **kwargs):
+        time.sleep(0.05)
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+
+    with app.app_context():
+        user = User(username="member", email="member@example.com")
+        user.set_password("password123")
+        db.session.add(user)
+        db.session.commit()
+
+    # 管理者以外の指定は無視される
+    login_user(client, "member", "password123")
+    response = client.get("/api/me", headers={"X-Profile": "1"})
+    assert "X-Profile-Id" not in response.headers
+    client.post("/api/auth/logout", headers={"X-CSRFToken": get_csrf_token(client)})
+
+    login_admin(client)
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "blue",
+            "pose_instruction": "pose",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client), "X-Profile": "1", "X-Request-Id": "slow-generation-1"},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert response.headers["X-Profile-Id"] == "slow-generation-1"
+
+    listing = json.loads(client.get("/api/admin/profiles").data)["profiles"]
+    assert [item["request_id"] for item in listing] == ["slow-generation-1"]
+    assert listing[0]["path"] == "/api/generations"
+    assert listing[0]["reason"] == "requested"
+
+    profile = json.loads(client.get(listing[0]["url"]).data)
+    thread_names = [item["name"] for item in profile["profiles"]]
+    # モデル呼び出しのワーカースレッドもリクエストと一緒に採取される
+    assert "request" in thread_names
+    assert any(name.startswith("model-call") for name in thread_names)
+    frame_names = {frame["name"] for frame in profile["shared"]["frames"]}
+    assert any("fake_generate_image" in name for name in frame_names)
+
+    assert client.get("/api/admin/profiles/..%2Fsecret").status_code == 404
+
+
+def test_profile_files_are_pruned_only_when_the_limit_is_exceeded(monkeypatch, tmp_path):
+    import os
+
+    from services import profiling
+
+    base = tmp_path / "profiles"
+    base.mkdir()
+    prunes: list[int] = []
+    original_prune = profiling._prune
+
+    def counting_prune(directory, keep):
+        prunes.append(keep)
+        return original_prune(directory, keep)
+
+    monkeypatch.setattr(profiling, "_prune", counting_prune)
+    monkeypatch.setattr(profiling, "_file_counts", {})
+
+    for index in range(11):
+        path = base / f"req-{index:02d}.speedscope.json"
+        path.write_text("{}")
+        os.utime(path, (index, index))
+        profiling._count_written(base, 10)
+    # 上限（10件）を超えた11件目で初めて削除し、9件まで減らす
+    assert prunes == [9]
+    remaining = sorted(path.name for path in base.glob("*.speedscope.json"))
+    assert remaining == [f"req-{index:02d}.speedscope.json" for index in range(2, 11)]
+
+    (base / "req-11.speedscope.json").write_text("{}")
+    profiling._count_written(base, 10)
+    assert prunes == [9]
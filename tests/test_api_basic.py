@@ -2,10 +2,11 @@
 
 import json
 from io import BytesIO
+from pathlib import Path
 
 import pytest
 from google.genai.errors import ServerError
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
 from app import create_app
 from extensions import db
@@ -61,6 +62,113 @@ def test_health_check(client):
     assert payload["status"] == "ok"
 
 
+def test_app_import_defers_cloud_sdks():
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, app; "
+        "print(','.join(sorted(m for m in ('google.genai', 'google.cloud.storage', 'google.api_core') if m in sys.modules)))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).resolve().parents[1],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert completed.stdout.strip() == ""
+
+
+def test_warmup_initializes_worker_resources(app):
+    from services import warmup
+
+    app.config["WARMUP_PROBE_PATH"] = "/api/health"
+    results = warmup.run(app)
+
+    assert list(results) == ["pil", "db", "genai", "storage", "probe"]
+    assert results["db"]["status"] == "1 connection(s)"
+    assert results["storage"]["status"] == "skipped (local)"
+    assert results["probe"]["status"] == "200"
+    assert not any(str(result["status"]).startswith("failed") for result in results.values())
+
+
+def test_warmup_prepares_shared_gcs_credentials_only(app, monkeypatch):
+    from services import storage_backends, warmup
+
+    class FakeCredentials:
+        valid = False
+        refreshed = 0
+
+        def refresh(self, request):
+            self.refreshed += 1
+            self.valid = True
+
+    credentials = FakeCredentials()
+    monkeypatch.setattr(storage_backends, "_gcs_credentials", lambda: (credentials, "project"))
+    monkeypatch.setattr(
+        storage_backends, "_gcs_client", lambda: pytest.fail("per-thread client must not be created in warmup")
+    )
+    app.config.update(GENERATION_IMAGE_STORAGE="gcs", GENERATION_IMAGE_BUCKET="test-bucket")
+
+    with app.app_context():
+        assert warmup._warm_storage() == "gcs:credentials"
+        # トークン取得済みなら取り直さない
+        warmup._warm_storage()
+    assert credentials.refreshed == 1
+
+
+def test_image_decode_leaves_pil_pixel_limit_alone(app):
+    from services import generation_service
+
+    assert Image.MAX_IMAGE_PIXELS == app.config["MAX_IMAGE_PIXELS"]
+    buffer = BytesIO()
+    Image.new("RGB", (3, 2)).save(buffer, format="PNG")
+
+    original = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = 123456789
+    try:
+        with app.test_request_context():
+            generation_service.decode_image_bytes(buffer.getvalue(), filename="a.png", mime_type="image/png")
+        # スレッドワーカーで競合しないよう、デコード時にプロセス全体の設定を書き換えない
+        assert Image.MAX_IMAGE_PIXELS == 123456789
+    finally:
+        Image.MAX_IMAGE_PIXELS = original
+
+
+@pytest.mark.filterwarnings("ignore::PIL.Image.DecompressionBombWarning")
+def test_image_limits_are_built_once_and_checked_from_header(tmp_path, monkeypatch):
+    from services import generation_service
+
+    # create_app が書き換えるプロセス全体の値をテスト後に戻す
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'limits.db'}",
+            "SECRET_KEY": "test-secret",
+            "MAX_IMAGE_WIDTH": 16,
+            "MAX_IMAGE_HEIGHT": 0,
+            "MAX_IMAGE_PIXELS": 200,
+        }
+    )
+    limits = app.extensions["image_limits"]
+    assert limits == generation_service.ImageLimits(max_width=16, max_height=None, max_pixels=200)
+
+    def png(width, height):
+        buffer = BytesIO()
+        Image.new("RGB", (width, height)).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    with app.test_request_context():
+        assert generation_service.image_limits() is limits
+        generation_service.decode_image_bytes(png(10, 20), filename="ok.png")
+        with pytest.raises(generation_service.GenerationError, match="最大幅16px"):
+            generation_service.decode_image_bytes(png(17, 1), filename="wide.png")
+        with pytest.raises(generation_service.GenerationError, match="200ピクセル"):
+            generation_service.decode_image_bytes(png(15, 15), filename="many.png")
+
+
 def test_generation_flow_creates_asset(client, monkeypatch):
     login(client)
 
@@ -95,6 +203,142 @@ def test_generation_flow_creates_asset(client, monkeypatch):
     assert payload["assets"][0]["url"]
 
 
+def test_generation_row_is_committed_while_model_call_runs(client, app, monkeypatch):
+    import time
+
+    from models import Generation
+
+    login(client)
+
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (0, 0, 255)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+    observed: list[str] = []
+
+    def fake_generate_image(*args, **kwargs):
+        # モデル呼び出しはワーカースレッドで走るので、その間に INSERT がコミットされるはず
+        deadline = time.monotonic() + 5
+        with app.app_context():
+            while time.monotonic() < deadline:
+                generation = Generation.query.first()
+                if generation is not None:
+                    observed.append(generation.status)
+                    break
+                db.session.remove()
+                time.sleep(0.01)
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "blue",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert observed == ["running"]
+    with app.app_context():
+        generation = Generation.query.one()
+        assert generation.status == "succeeded"
+        assert "db_insert" in generation.stage_timings
+
+
+def test_generation_insert_failure_discards_model_call_and_records_failure(client, app, monkeypatch):
+    import time
+
+    from models import Generation
+    from services import generation_service
+
+    login(client)
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (0, 0, 255)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+    calls: list[str] = []
+
+    def slow_generate_image(*args, **kwargs):
+        calls.append("started")
+        time.sleep(0.2)
+        calls.append("finished")
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    start_generation = generation_service._start_generation
+    attempts: list[int] = []
+
+    def flaky_start_generation(**kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("database is unavailable")
+        return start_generation(**kwargs)
+
+    monkeypatch.setattr("services.generation_service.generate_image", slow_generate_image)
+    monkeypatch.setattr(generation_service, "_start_generation", flaky_start_generation)
+
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "blue",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 500
+    # モデル呼び出しは取り消されたか、終わるまで待って捨てられている
+    assert calls in ([], ["started", "finished"])
+    with app.app_context():
+        generation = Generation.query.one()
+        assert generation.status == "failed"
+
+
+def test_generation_stays_succeeded_when_follow_up_scheduling_fails(client, app, monkeypatch):
+    from models import Generation
+    from services import generation_service
+
+    login(client)
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (0, 255, 0)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+
+    def fake_generate_image(*args, **kwargs):
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    def shut_down_executor(asset):
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+    monkeypatch.setattr(generation_service, "schedule_asset_reencode", shut_down_executor)
+
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "green",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert json.loads(response.data)["generation"]["status"] == "succeeded"
+    with app.app_context():
+        assert Generation.query.one().status == "succeeded"
+
+
 def test_generation_returns_503_when_gemini_is_overloaded(client, monkeypatch):
     login(client)
 
@@ -140,6 +384,130 @@ def test_generation_returns_503_when_gemini_is_overloaded(client, monkeypatch):
     assert payload["error_code"] == "gemini_overloaded"
 
 
+def _post_rough_generation(client, *, aspect_ratio="auto", resolution="auto"):
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(buffer, format="PNG")
+    return client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "red",
+            "pose_instruction": "pose",
+            "aspect_ratio": aspect_ratio,
+            "resolution": resolution,
+            "rough_image": (BytesIO(buffer.getvalue()), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+
+
+def test_fake_model_backend_generates_configured_image_size(client, monkeypatch):
+    from illust import _client
+
+    monkeypatch.setenv("MODEL_BACKEND", "fake")
+    monkeypatch.setenv("FAKE_MODEL_IMAGE_SIZE", "96x64")
+    _client.cache_clear()
+    login(client)
+    try:
+        response = _post_rough_generation(client)
+        assert response.status_code == 200
+        asset = json.loads(response.data)["assets"][0]
+        assert (asset["width"], asset["height"]) == (96, 64)
+
+        # 解像度・アスペクト比の指定はモデルと同じく出力サイズに反映される
+        response = _post_rough_generation(client, aspect_ratio="16:9", resolution="1K")
+        asset = json.loads(response.data)["assets"][0]
+        assert (asset["width"], asset["height"]) == (1024, 576)
+
+        # 注入した 503 は本物の過負荷エラーと同じ応答になる
+        monkeypatch.setenv("FAKE_MODEL_ERRORS", "503:1")
+        _client.cache_clear()
+        response = _post_rough_generation(client)
+        assert response.status_code == 503
+        assert json.loads(response.data)["error_code"] == "gemini_overloaded"
+    finally:
+        _client.cache_clear()
+
+
+def test_http_model_backend_speaks_generate_content_rest_shape(monkeypatch):
+    import threading
+
+    import illust
+    from services import fake_model
+
+    server = fake_model.make_server(behavior=fake_model.FakeModelBehavior(image_size=(40, 30)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("MODEL_BACKEND", "http")
+    monkeypatch.setenv("MODEL_HTTP_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    illust._client.cache_clear()
+    try:
+        # 実際の SDK がリクエストを組み立て、偽サーバーの応答を解釈する
+        assert illust.generate_text("hello") == fake_model.FAKE_TEXT_REPLY
+        generated = illust.generate_image("draw", Image.new("RGB", (8, 8)))
+        assert generated.size == (40, 30)
+        assert generated.mime_type == "image/png"
+    finally:
+        illust._client.cache_clear()
+        server.shutdown()
+        server.server_close()
+
+
+def test_tracing_breaks_a_generation_down_into_spans(tmp_path, monkeypatch):
+    pytest.importorskip("opentelemetry.sdk")
+    from illust import _client
+    from services import tracing
+
+    trace_file = tmp_path / "traces.jsonl"
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'tracing.db'}",
+            "SECRET_KEY": "test-secret",
+            "GENERATION_IMAGE_DIR": str(tmp_path / "generated_images"),
+            "TRACING_ENABLED": True,
+            "TRACING_EXPORTER": "file",
+            "TRACING_FILE_PATH": str(trace_file),
+        }
+    )
+    monkeypatch.setenv("MODEL_BACKEND", "fake")
+    monkeypatch.setenv("FAKE_MODEL_IMAGE_SIZE", "32x32")
+    _client.cache_clear()
+    try:
+        with app.app_context():
+            db.create_all()
+            user = User(username="tester", email="tester@example.com")
+            user.set_password("password123")
+            db.session.add(user)
+            db.session.commit()
+        client = app.test_client()
+        login(client)
+        response = _post_rough_generation(client)
+        assert response.status_code == 200
+        tracing.flush()
+    finally:
+        tracing.shutdown()
+        _client.cache_clear()
+
+    spans = [json.loads(line) for line in trace_file.read_text(encoding="utf-8").splitlines() if line.strip()]
+    request_span = next(span for span in spans if span["name"] == "POST /api/generations")
+    trace_id = request_span["context"]["trace_id"]
+    in_trace = [span for span in spans if span["context"]["trace_id"] == trace_id]
+    names = {span["name"] for span in in_trace}
+    # モデル呼び出しは別スレッドで走るが、同じトレースにつながる
+    assert "gemini generate_image" in names
+    assert "storage upload" in names
+    assert any(name.startswith("db ") for name in names)
+
+    model_span = next(span for span in in_trace if span["name"] == "gemini generate_image")
+    assert model_span["attributes"]["app.input_images"] == 1
+    assert model_span["attributes"]["app.input_bytes"] > 0
+    assert model_span["attributes"]["app.output_bytes"] > 0
+    assert request_span["attributes"]["app.request_id"] == response.headers["X-Request-Id"]
+    assert request_span["attributes"]["http.response.status_code"] == 200
+
+
 def test_generation_returns_500_with_contact_message_for_unexpected_error(client, monkeypatch):
     login(client)
 
@@ -171,3 +539,650 @@ def test_generation_returns_500_with_contact_message_for_unexpected_error(client
     payload = json.loads(response.data)
     assert payload["error"] == "システムエラーが発生しました。管理者にお問い合わせください。"
     assert payload["error_code"] == "internal_server_error_contact_admin"
+
+
+def test_metrics_endpoint_exposes_request_and_stage_histograms(client, app):
+    assert client.get("/metrics").status_code == 404
+    app.config["METRICS_ENABLED"] = True
+    client.get("/api/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'app_http_request_duration_seconds_count{method="GET",route="/api/health",status="200"}' in body
+    assert "app_db_commit_duration_seconds_count" in body
+    # 完了したリクエストは処理中数に残らない（/metrics 自身は数えない）
+    assert "app_http_requests_in_flight 0.0" in body
+
+
+def _seed_generations(app, count: int, assets_per_generation: int = 2) -> None:
+    from models import Generation, GenerationAsset
+
+    with app.app_context():
+        user_id = User.query.filter_by(username="tester").first().id
+        for index in range(count):
+            generation = Generation(user_id=user_id, mode="rough_with_instructions", status="succeeded")
+            db.session.add(generation)
+            db.session.flush()
+            for asset_index in range(assets_per_generation):
+                db.session.add(
+                    GenerationAsset(
+                        generation_id=generation.id,
+                        storage_backend="memory",
+                        object_name=f"generations/{generation.id}/{asset_index}.png",
+                    )
+                )
+        db.session.commit()
+
+
+def test_generation_list_query_count_does_not_grow_with_history(client, app, assert_max_queries, caplog):
+    login(client)
+    _seed_generations(app, 2)
+    with assert_max_queries(3) as few:
+        response = client.get("/api/generations")
+    assert response.status_code == 200
+    assert len(json.loads(response.data)["items"]) == 2
+
+    _seed_generations(app, 15)
+    caplog.set_level("INFO", logger=app.logger.name)
+    with assert_max_queries(3) as many:
+        response = client.get("/api/generations")
+    items = json.loads(response.data)["items"]
+    assert len(items) == 17
+    assert all(len(item["assets"]) == 2 for item in items)
+    # 1回目はユーザーの読み込みが入るので、2回目以降は増えないことだけを見る
+    assert many.count <= few.count
+
+    request_log = [
+        json.loads(record.getMessage())
+        for record in caplog.records
+        if record.getMessage().startswith('{"type": "request"') and '"/api/generations"' in record.getMessage()
+    ][-1]
+    assert request_log["db_queries"] == many.count
+    assert request_log["db_time_ms"] >= 0
+
+
+def test_slow_queries_are_logged_with_parameter_shape_only(client, app, caplog):
+    from services import query_stats
+
+    login(client)
+    _seed_generations(app, 1)
+    with app.app_context():
+        query_stats.install(db.engine, slow_query_ms=0.000001)
+    try:
+        caplog.set_level("WARNING", logger="services.query_stats")
+        response = client.get("/api/generations", headers={"X-Request-Id": "slow-query-test"})
+        assert response.status_code == 200
+    finally:
+        with app.app_context():
+            query_stats.install(db.engine, slow_query_ms=app.config["DB_SLOW_QUERY_MS"])
+
+    slow = [json.loads(record.getMessage()) for record in caplog.records if record.name == "services.query_stats"]
+    assert slow and all(entry["type"] == "slow_query" for entry in slow)
+    listing = next(entry for entry in slow if "FROM generations" in entry["statement"])
+    assert listing["request_id"] == "slow-query-test"
+    assert listing["duration_ms"] >= 0
+    # パラメーターは型だけを出し、値（ユーザー ID など）は出さない
+    assert set(map(str, listing["parameters"])) <= {"int", "str"}
+
+
+def test_metrics_endpoint_requires_token_when_configured(client, app):
+    app.config["METRICS_ENABLED"] = True
+    app.config.update(TESTING=False, DEBUG=False)
+    # トークン未設定のままでは DEBUG / TESTING 以外で匿名に公開しない
+    assert client.get("/metrics").status_code == 401
+
+    app.config["METRICS_TOKEN"] = "scrape-token"
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-token"})
+    assert response.status_code == 200
+
+
+def test_generated_image_probes_size_without_decoding_pixels():
+    buffer = BytesIO()
+    Image.new("RGB", (12, 7), color=(0, 128, 255)).save(buffer, format="PNG")
+
+    generated = GeneratedImage.probe(raw_bytes=buffer.getvalue(), mime_type="image/png", prompt="test")
+    assert (generated.width, generated.height) == (12, 7)
+    assert generated._image is None
+
+    assert generated.image.getpixel((0, 0)) == (0, 128, 255)
+
+
+def test_generated_image_probe_rejects_non_image_bytes():
+    with pytest.raises(UnidentifiedImageError):
+        GeneratedImage.probe(raw_bytes=b"not an image", mime_type="image/png", prompt="test")
+
+
+def test_reencode_asset_replaces_stored_png_with_configured_codec(client, app, monkeypatch):
+    from models import GenerationAsset
+    from services import generation_service
+
+    app.config["GENERATION_IMAGE_CODEC"] = "webp_lossless"
+    login(client)
+
+    image = Image.linear_gradient("L").convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=0)
+    raw_bytes = buffer.getvalue()
+
+    def fake_generate_image(*args, **kwargs):
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    scheduled: list[int] = []
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+    monkeypatch.setattr(generation_service, "schedule_asset_reencode", lambda asset: scheduled.append(asset.id))
+
+    csrf_token = get_csrf_token(client)
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "red",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": csrf_token},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    asset_payload = json.loads(response.data)["assets"][0]
+    assert scheduled == [asset_payload["id"]]
+
+    with app.app_context():
+        original_object = db.session.get(GenerationAsset, asset_payload["id"]).object_name
+        assert generation_service.reencode_asset(asset_payload["id"]) is True
+        asset_row = db.session.get(GenerationAsset, asset_payload["id"])
+        assert asset_row.mime_type == "image/webp"
+        assert asset_row.object_name.endswith(".webp")
+        assert asset_row.byte_size < len(raw_bytes)
+        # コミット後も猶予の間は旧オブジェクトを残し、古い行を読んだリクエストに配信できる
+        original_path = Path(app.instance_path) / "generated_images" / original_object
+        assert original_path.read_bytes() == raw_bytes
+
+    served = client.get(asset_payload["url"])
+    assert served.status_code == 200
+    assert served.mimetype == "image/webp"
+    assert Image.open(BytesIO(served.data)).size == (256, 256)
+
+    assert generation_service.run_deferred_deletes() == 1
+    assert not original_path.exists()
+    assert client.get(asset_payload["url"]).status_code == 200
+
+
+class _FakeBlob:
+    def __init__(self, objects, name):
+        self._objects = objects
+        self._name = name
+
+    def upload_from_string(self, data, content_type=None):
+        self._objects[self._name] = bytes(data)
+
+    def download_as_bytes(self):
+        return self._objects[self._name]
+
+
+class _FakeBucket:
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+
+    def blob(self, name):
+        return _FakeBlob(self.objects, name)
+
+
+def test_write_behind_serves_from_spool_until_upload_completes(client, app, tmp_path, monkeypatch):
+    from models import GenerationAsset
+    from services import generation_service, upload_spool
+
+    app.config.update(
+        GENERATION_IMAGE_STORAGE="gcs",
+        GENERATION_IMAGE_BUCKET="test-bucket",
+        GENERATION_UPLOAD_MODE="write_behind",
+        GENERATION_SPOOL_DIR=str(tmp_path / "spool"),
+    )
+    bucket = _FakeBucket()
+    monkeypatch.setattr("services.storage_backends._gcs_bucket", lambda name: bucket)
+    login(client)
+
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), (0, 255, 0)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+
+    def fake_generate_image(*args, **kwargs):
+        return GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test")
+
+    scheduled: list[int] = []
+    monkeypatch.setattr("services.generation_service.generate_image", fake_generate_image)
+    monkeypatch.setattr(generation_service, "schedule_asset_upload", lambda asset: scheduled.append(asset.id))
+
+    csrf_token = get_csrf_token(client)
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "green",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": csrf_token},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    asset_payload = json.loads(response.data)["assets"][0]
+    assert scheduled == [asset_payload["id"]]
+    assert bucket.objects == {}
+
+    served = client.get(asset_payload["url"])
+    assert served.status_code == 200
+    assert served.data == raw_bytes
+
+    with app.app_context():
+        assert generation_service.upload_pending_asset(asset_payload["id"]) is True
+        asset_row = db.session.get(GenerationAsset, asset_payload["id"])
+        assert asset_row.storage_state == "stored"
+        assert bucket.objects[asset_row.object_name] == raw_bytes
+        assert not upload_spool.exists(asset_row.object_name)
+
+    served = client.get(asset_payload["url"])
+    assert served.status_code == 200
+    assert served.data == raw_bytes
+
+
+def test_write_behind_marks_asset_failed_after_retries_run_out(client, app, tmp_path, monkeypatch):
+    from models import GenerationAsset
+    from services import generation_service, upload_spool
+
+    app.config.update(
+        GENERATION_IMAGE_STORAGE="gcs",
+        GENERATION_IMAGE_BUCKET="test-bucket",
+        GENERATION_UPLOAD_MODE="write_behind",
+        GENERATION_SPOOL_DIR=str(tmp_path / "spool"),
+        GENERATION_UPLOAD_MAX_RETRIES=1,
+        GENERATION_UPLOAD_RETRY_BACKOFF_SECONDS=0,
+    )
+    bucket = _FakeBucket()
+
+    def broken_blob(name):
+        blob = _FakeBlob(bucket.objects, name)
+        blob.upload_from_string = lambda data, content_type=None: (_ for _ in ()).throw(OSError("gcs is down"))
+        return blob
+
+    bucket.blob = broken_blob
+    monkeypatch.setattr("services.storage_backends._gcs_bucket", lambda name: bucket)
+    scheduled: list[int] = []
+    monkeypatch.setattr(generation_service, "schedule_asset_upload", lambda asset: scheduled.append(asset.id))
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4)).save(buffer, format="PNG")
+    monkeypatch.setattr(
+        "services.generation_service.generate_image",
+        lambda *args, **kwargs: GeneratedImage(raw_bytes=buffer.getvalue(), mime_type="image/png", prompt="test"),
+    )
+    login(client)
+
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "green",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(buffer.getvalue()), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    asset_id = scheduled[0]
+
+    generation_service._run_asset_upload(app, asset_id)
+    with app.app_context():
+        asset_row = db.session.get(GenerationAsset, asset_id)
+        assert asset_row.storage_state == "failed"
+        # 諦めた分のスプールは解放する
+        assert not upload_spool.exists(asset_row.object_name)
+        assert upload_spool.recalculate() == 0
+    assert client.get(f"/api/assets/{asset_id}").status_code == 404
+
+
+def test_gcs_save_stream_uses_a_single_upload_for_small_payloads(app, monkeypatch):
+    import hashlib
+
+    from services import storage, storage_backends
+
+    bucket = _FakeBucket()
+    calls: list[str] = []
+
+    class _RecordingBlob(_FakeBlob):
+        def upload_from_string(self, data, content_type=None):
+            calls.append("single")
+            super().upload_from_string(data, content_type=content_type)
+
+        def open(self, mode, content_type=None, chunk_size=None):
+            calls.append("resumable")
+            objects, name, parts = self._objects, self._name, []
+
+            class _Writer:
+                def __enter__(self):
+                    return self
+
+                def __exit__(self, *exc):
+                    objects[name] = b"".join(parts)
+
+                def write(self, data):
+                    parts.append(bytes(data))
+
+            return _Writer()
+
+    bucket.blob = lambda name: _RecordingBlob(bucket.objects, name)
+    monkeypatch.setattr("services.storage_backends._gcs_bucket", lambda name: bucket)
+    location = dict(
+        storage_backend="gcs",
+        bucket_name="test-bucket",
+        local_dir_key="CHAT_IMAGE_DIR",
+        default_local_dir="chat_images",
+        object_prefix="chat_images",
+        extension=".bin",
+    )
+    small = b"s" * 1000
+    large = b"l" * (storage_backends._UPLOAD_CHUNK_SIZE + 1)
+
+    with app.app_context():
+        stored = storage.save_stream(stream=BytesIO(small), chunk_size=256, **location)
+        assert calls == ["single"]
+        assert bucket.objects[stored.object_name] == small
+        assert stored.sha256 == hashlib.sha256(small).hexdigest()
+
+        stored = storage.save_stream(stream=BytesIO(large), chunk_size=64 * 1024, **location)
+        assert calls == ["single", "resumable"]
+        assert bucket.objects[stored.object_name] == large
+        assert stored.byte_size == len(large)
+        assert stored.sha256 == hashlib.sha256(large).hexdigest()
+
+
+def test_upload_spool_tracks_usage_without_rescanning(app, tmp_path):
+    from services import upload_spool
+
+    app.config.update(GENERATION_SPOOL_DIR=str(tmp_path / "spool"), GENERATION_SPOOL_MAX_BYTES=10)
+    with app.app_context():
+        assert upload_spool.write("generated_images/a.png", b"12345") is True
+        assert upload_spool.write("generated_images/b.png", b"123456") is False
+        assert (tmp_path / "spool" / ".usage").read_text() == "5"
+        # 使用量は .usage から読む（走査しない）
+        assert upload_spool.write("generated_images/a.png", b"1234567890") is True
+        upload_spool.remove("generated_images/a.png")
+        assert upload_spool.write("generated_images/b.png", b"123456") is True
+        assert upload_spool.recalculate() == 6
+
+
+def test_resume_fails_stale_pending_assets_whose_spool_is_lost(client, app, tmp_path, monkeypatch):
+    from datetime import datetime, timedelta
+
+    from models import Generation, GenerationAsset
+    from services import generation_service, upload_spool
+
+    app.config.update(GENERATION_SPOOL_DIR=str(tmp_path / "spool"), GENERATION_UPLOAD_STALE_SECONDS=600)
+    scheduled: list[int] = []
+    monkeypatch.setattr(generation_service, "schedule_asset_upload", lambda asset: scheduled.append(asset.id))
+    login(client)
+
+    now = datetime.utcnow()
+    with app.app_context():
+        user_id = User.query.filter_by(username="tester").first().id
+        ids = {}
+        for name, started_at, spooled in (
+            ("lost", now - timedelta(hours=2), False),
+            ("recent", now, False),
+            ("spooled", now - timedelta(hours=2), True),
+        ):
+            generation = Generation(
+                user_id=user_id, mode="rough_with_instructions", status="succeeded", started_at=started_at
+            )
+            db.session.add(generation)
+            db.session.flush()
+            object_name = f"generated_images/{name}.png"
+            if spooled:
+                upload_spool.write(object_name, b"png")
+            asset = GenerationAsset(
+                generation_id=generation.id,
+                storage_backend="gcs",
+                bucket="test-bucket",
+                object_name=object_name,
+                storage_state="pending",
+            )
+            db.session.add(asset)
+            db.session.flush()
+            ids[name] = asset.id
+        db.session.commit()
+
+        assert generation_service.resume_pending_uploads() == 1
+        assert scheduled == [ids["spooled"]]
+        assert db.session.get(GenerationAsset, ids["lost"]).storage_state == "failed"
+        # 新しい行は別インスタンスがアップロード中の可能性があるので残す
+        assert db.session.get(GenerationAsset, ids["recent"]).storage_state == "pending"
+
+        assert generation_service.upload_pending_asset(ids["recent"]) is False
+        assert db.session.get(GenerationAsset, ids["recent"]).storage_state == "failed"
+
+    assert client.get(f"/api/assets/{ids['lost']}").status_code == 404
+
+
+def test_storage_cache_reads_through_and_verifies_sha256(app, tmp_path, monkeypatch):
+    import hashlib
+
+    from services import storage, storage_cache
+
+    # キャッシュを repo の instance/ に置くと前回の実行分が残り、ダウンロード回数が変わる
+    # エントリは sha256（32バイト）＋内容なので、40バイトの画像は1件（72バイト）だけ入る
+    app.config.update(STORAGE_CACHE_MAX_BYTES=100, STORAGE_CACHE_DIR=str(tmp_path / "cache"))
+    bucket = _FakeBucket()
+    downloads: list[str] = []
+    original_blob = bucket.blob
+
+    def counting_blob(name):
+        blob = original_blob(name)
+        download = blob.download_as_bytes
+        blob.download_as_bytes = lambda: (downloads.append(name), download())[1]
+        return blob
+
+    bucket.blob = counting_blob
+    monkeypatch.setattr("services.storage_backends._gcs_bucket", lambda name: bucket)
+    bucket.objects["a.png"] = b"a" * 40
+    bucket.objects["b.png"] = b"b" * 40
+    sha_a = hashlib.sha256(bucket.objects["a.png"]).hexdigest()
+    load_kwargs = dict(
+        storage_backend="gcs",
+        bucket_name="test-bucket",
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+    )
+
+    with app.app_context():
+        assert storage.load_bytes(object_name="a.png", expected_sha256=sha_a, **load_kwargs) == b"a" * 40
+        assert storage.load_bytes(object_name="a.png", expected_sha256=sha_a, **load_kwargs) == b"a" * 40
+        assert downloads == ["a.png"]
+
+        # DB の sha256 と一致しないエントリは使わずに取り直す
+        assert storage.load_bytes(object_name="a.png", expected_sha256="0" * 64, **load_kwargs) == b"a" * 40
+        assert downloads == ["a.png", "a.png"]
+
+        # 容量上限を超えると古いエントリから追い出される
+        storage.load_bytes(object_name="a.png", expected_sha256=sha_a, **load_kwargs)
+        assert storage_cache.get(backend="gcs", bucket_name="test-bucket", object_name="a.png") == b"a" * 40
+        storage.load_bytes(object_name="b.png", **load_kwargs)
+        assert storage_cache.get(backend="gcs", bucket_name="test-bucket", object_name="a.png") is None
+        assert storage_cache.get(backend="gcs", bucket_name="test-bucket", object_name="b.png") == b"b" * 40
+        # 合計サイズは走査せず .usage で追跡している
+        assert (tmp_path / "cache" / ".usage").read_text() == "72"
+
+        # 読み出し時の再計算は既定で行わず、STORAGE_CACHE_VERIFY_ON_READ で破損も検出する
+        entry_path = storage_cache._path_for("gcs", "test-bucket", "b.png")
+        entry_path.write_bytes(entry_path.read_bytes()[:-1] + b"x")
+        assert storage_cache.get(backend="gcs", bucket_name="test-bucket", object_name="b.png") == b"b" * 39 + b"x"
+        app.config["STORAGE_CACHE_VERIFY_ON_READ"] = True
+        assert storage_cache.get(backend="gcs", bucket_name="test-bucket", object_name="b.png") is None
+        assert not entry_path.exists()
+        assert (tmp_path / "cache" / ".usage").read_text() == "0"
+
+
+def test_local_storage_writes_sharded_paths_and_rejects_traversal(app):
+    from services import storage
+
+    save_kwargs = dict(
+        extension=".png",
+        storage_backend="local",
+        bucket_name=None,
+        local_dir_key="GENERATION_IMAGE_DIR",
+        default_local_dir="generated_images",
+        object_prefix="generated_images",
+    )
+    with app.app_context():
+        stored = storage.save_bytes(raw_bytes=b"payload", **save_kwargs)
+        prefix, first, second, filename = stored.object_name.split("/")
+        assert prefix == "generated_images"
+        assert filename.startswith(first + second)
+
+        base_dir = Path(app.instance_path) / "generated_images"
+        stored_path = base_dir / stored.object_name
+        assert stored_path.read_bytes() == b"payload"
+        assert not [path for path in stored_path.parent.iterdir() if path.name.endswith(".tmp")]
+
+        with pytest.raises(ValueError):
+            storage.load_bytes(
+                storage_backend="local",
+                bucket_name=None,
+                object_name="../../secret",
+                local_dir_key="GENERATION_IMAGE_DIR",
+                default_local_dir="generated_images",
+            )
+
+
+def test_memory_backend_stores_and_serves_generated_assets(client, app, monkeypatch):
+    from services import storage_backends
+
+    storage_backends.reset_memory_backend()
+    app.config["GENERATION_IMAGE_STORAGE"] = "memory"
+    login(client)
+
+    buffer = BytesIO()
+    Image.new("RGB", (3, 3), (1, 2, 3)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+    monkeypatch.setattr(
+        "services.generation_service.generate_image",
+        lambda *args, **kwargs: GeneratedImage(raw_bytes=raw_bytes, mime_type="image/png", prompt="test"),
+    )
+
+    response = client.post(
+        "/api/generations",
+        data={
+            "mode": "rough_with_instructions",
+            "color_instruction": "red",
+            "pose_instruction": "pose",
+            "aspect_ratio": "auto",
+            "resolution": "auto",
+            "rough_image": (BytesIO(raw_bytes), "rough.png"),
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    served = client.get(json.loads(response.data)["assets"][0]["url"])
+    assert served.status_code == 200
+    assert served.data == raw_bytes
+
+
+class _FakeS3Error(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class _FakeS3Client:
+    def __init__(self):
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        chunks = []
+        while chunk := fileobj.read(7):
+            chunks.append(chunk)
+        self.objects[(bucket, key)] = b"".join(chunks)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise _FakeS3Error("NoSuchKey")
+        return {"Body": BytesIO(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise _FakeS3Error("404")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+def test_s3_backend_round_trips_through_storage_facade(app, monkeypatch):
+    import hashlib
+
+    from services import storage
+
+    fake_client = _FakeS3Client()
+    monkeypatch.setattr("services.storage_backends._s3_client", lambda endpoint, region: fake_client)
+    location = dict(
+        storage_backend="s3",
+        bucket_name="minio-bucket",
+        local_dir_key="CHAT_IMAGE_DIR",
+        default_local_dir="chat_images",
+    )
+
+    with app.app_context():
+        stored = storage.save_stream(
+            stream=BytesIO(b"streamed payload"),
+            extension=".bin",
+            object_prefix="chat_images",
+            chunk_size=4,
+            **location,
+        )
+        assert stored.storage_backend == "s3"
+        assert stored.bucket == "minio-bucket"
+        assert stored.sha256 == hashlib.sha256(b"streamed payload").hexdigest()
+        assert storage.load_bytes(object_name=stored.object_name, **location) == b"streamed payload"
+        assert storage.stat_object(object_name=stored.object_name, **location).byte_size == 16
+        assert storage.delete_bytes(object_name=stored.object_name, **location) is True
+        assert storage.load_bytes(object_name=stored.object_name, **location) is None
+        assert storage.delete_bytes(object_name=stored.object_name, **location) is False
+
+        # 書き込みは設定の誤りとして送出し、読み出しは「見つからない」として扱う
+        with pytest.raises(ValueError):
+            storage.save_bytes(
+                raw_bytes=b"x", extension=".bin", object_prefix="chat_images", **{**location, "storage_backend": "ftp"}
+            )
+        assert storage.load_bytes(object_name="x", **{**location, "storage_backend": "ftp"}) is None
+        assert storage.open_object(object_name="x", **{**location, "storage_backend": "gcs", "bucket_name": None}) is None
+        assert storage.stat_object(object_name="x", **{**location, "bucket_name": None}) is None
+
+
+def test_asset_with_unresolvable_storage_backend_returns_404(client, app):
+    from models import Generation, GenerationAsset
+
+    login(client)
+    with app.app_context():
+        generation = Generation(
+            user_id=User.query.filter_by(username="tester").first().id,
+            mode="rough_with_instructions",
+            status="succeeded",
+        )
+        db.session.add(generation)
+        db.session.flush()
+        asset = GenerationAsset(generation_id=generation.id, storage_backend="ftp", object_name="legacy/a.png")
+        db.session.add(asset)
+        db.session.commit()
+        asset_id = asset.id
+
+    assert client.get(f"/api/assets/{asset_id}").status_code == 404
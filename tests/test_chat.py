@@ -51,15 +51,39 @@ def get_csrf_token(client):
     return payload["csrf_token"]
 
 
-def test_chat_page_creates_session(client, app):
+def test_chat_session_list_does_not_create_session(client, app):
     login(client)
     response = client.get("/api/chat/sessions")
     assert response.status_code == 200
+    payload = json.loads(response.data)
+    assert payload["sessions"] == []
+    assert payload["has_more"] is False
 
     with app.app_context():
-        sessions = ChatSession.query.all()
-        assert len(sessions) == 1
-        assert sessions[0].title
+        assert ChatSession.query.count() == 0
+
+
+def test_chat_session_list_pages_by_updated_at(client, app):
+    login(client)
+    with app.app_context():
+        user_id = User.query.first().id
+        for index in range(45):
+            db.session.add(ChatSession(user_id=user_id, title=f"session {index}"))
+        db.session.commit()
+
+    response = client.get("/api/chat/sessions?limit=20")
+    payload = json.loads(response.data)
+    assert len(payload["sessions"]) == 20
+    assert set(payload["sessions"][0]) == {"id", "title", "updated_at"}
+
+    seen = [session["id"] for session in payload["sessions"]]
+    while payload["next_before_id"]:
+        response = client.get(f"/api/chat/sessions?limit=20&before_id={payload['next_before_id']}")
+        payload = json.loads(response.data)
+        seen.extend(session["id"] for session in payload["sessions"])
+
+    assert len(seen) == 45
+    assert len(set(seen)) == 45
 
 
 def test_index_page_loads_for_logged_in_user(client):
@@ -82,7 +106,7 @@ def test_text_chat_persists_messages(client, app, monkeypatch):
         db.session.commit()
         session_id = session.id
 
-    monkeypatch.setattr("services.chat_service.generate_multimodal_reply", lambda *_: "test reply")
+    monkeypatch.setattr("services.chat_service.generate_text", lambda *_: "test reply")
 
     response = client.post(
         f"/api/chat/sessions/{session_id}/messages",
@@ -104,6 +128,77 @@ def test_text_chat_persists_messages(client, app, monkeypatch):
         assert roles == ["user", "assistant"]
 
 
+def test_chat_turn_that_fails_to_record_discards_the_model_call(client, app, monkeypatch):
+    import time
+
+    from services import chat_service
+
+    login(client)
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="新しいチャット")
+        db.session.add(session)
+        db.session.commit()
+        session_id = session.id
+
+    calls: list[str] = []
+
+    def slow_generate_text(prompt):
+        calls.append("started")
+        time.sleep(0.2)
+        calls.append("finished")
+        return "unused reply"
+
+    futures = []
+    start_reply = chat_service.start_multimodal_reply
+
+    def recording_start_reply(*args, **kwargs):
+        future = start_reply(*args, **kwargs)
+        futures.append(future)
+        return future
+
+    def failing_store(uploads):
+        raise OSError("storage unavailable")
+
+    monkeypatch.setattr("services.chat_service.generate_text", slow_generate_text)
+    monkeypatch.setattr(chat_service, "start_multimodal_reply", recording_start_reply)
+    monkeypatch.setattr(chat_service, "store_decoded_images", failing_store)
+
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={"mode_id": "text_chat", "message": "こんにちは"},
+        headers={"X-CSRFToken": get_csrf_token(client)},
+    )
+    assert response.status_code == 500
+    # 呼び出しは取り消されたか、終わるまで待って捨てられている（ワーカーに残っていない）
+    assert futures and futures[0].done()
+    assert calls in ([], ["started", "finished"])
+    with app.app_context():
+        assert ChatMessage.query.filter_by(session_id=session_id).count() == 0
+
+
+def test_text_chat_keeps_an_earlier_identical_user_message_in_history(client, app, monkeypatch):
+    login(client)
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="新しいチャット")
+        db.session.add(session)
+        db.session.flush()
+        db.session.add(ChatMessage(session_id=session.id, role="user", text="もう一度お願いします"))
+        db.session.commit()
+        session_id = session.id
+
+    prompts: list[str] = []
+    monkeypatch.setattr("services.chat_service.generate_text", lambda prompt: prompts.append(prompt) or "reply")
+
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={"mode_id": "text_chat", "message": "もう一度お願いします"},
+        headers={"X-CSRFToken": get_csrf_token(client)},
+    )
+    assert response.status_code == 200
+    # 前のターン（失敗して返信が無いもの）の同じ文も履歴として残す
+    assert prompts[0].count("User: もう一度お願いします") == 2
+
+
 def test_text_chat_accepts_json_payload(client, app, monkeypatch):
     login(client)
 
@@ -113,7 +208,7 @@ def test_text_chat_accepts_json_payload(client, app, monkeypatch):
         db.session.commit()
         session_id = session.id
 
-    monkeypatch.setattr("services.chat_service.generate_multimodal_reply", lambda *_: "json reply")
+    monkeypatch.setattr("services.chat_service.generate_text", lambda *_: "json reply")
 
     response = client.post(
         f"/api/chat/sessions/{session_id}/messages",
@@ -149,7 +244,7 @@ def test_text_chat_returns_503_when_gemini_is_overloaded(client, app, monkeypatc
     def fake_generate_reply(*args, **kwargs):
         raise overloaded_error
 
-    monkeypatch.setattr("services.chat_service.generate_multimodal_reply", fake_generate_reply)
+    monkeypatch.setattr("services.chat_service.generate_text", fake_generate_reply)
 
     response = client.post(
         f"/api/chat/sessions/{session_id}/messages",
@@ -174,7 +269,7 @@ def test_text_chat_returns_500_with_contact_message_for_unexpected_error(client,
     def fake_generate_reply(*args, **kwargs):
         raise RuntimeError("unexpected failure")
 
-    monkeypatch.setattr("services.chat_service.generate_multimodal_reply", fake_generate_reply)
+    monkeypatch.setattr("services.chat_service.generate_text", fake_generate_reply)
 
     response = client.post(
         f"/api/chat/sessions/{session_id}/messages",
@@ -185,3 +280,330 @@ def test_text_chat_returns_500_with_contact_message_for_unexpected_error(client,
     payload = json.loads(response.data)
     assert payload["error"] == "システムエラーが発生しました。管理者にお問い合わせください。"
     assert payload["error_code"] == "internal_server_error_contact_admin"
+
+
+def _seed_history(app, count: int) -> int:
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="長い会話")
+        db.session.add(session)
+        db.session.flush()
+        for index in range(count):
+            role = "user" if index % 2 == 0 else "assistant"
+            db.session.add(ChatMessage(session_id=session.id, role=role, text=f"message {index:03d} " + "x" * 36))
+        db.session.commit()
+        return session.id
+
+
+def test_history_window_is_bounded_by_token_budget(app, assert_max_queries):
+    from services import chat_service
+
+    session_id = _seed_history(app, 200)
+    app.config["CHAT_HISTORY_TOKEN_BUDGET"] = 120
+
+    with app.app_context():
+        session = db.session.get(ChatSession, session_id)
+        # 予算に収まる分だけを読み、古いメッセージまでは走査しない
+        with assert_max_queries(1):
+            history = chat_service.fetch_history_window(session)
+        assert 0 < len(history) < 200
+        assert sum(chat_service.estimate_tokens(message.text) for message in history) <= 120
+        assert history[-1].text.startswith("message 199")
+
+        prompt = chat_service.build_text_prompt(history, "next", summary="earlier summary")
+        assert "earlier summary" in prompt
+        assert "message 000" not in prompt
+
+
+def test_update_session_summary_folds_old_messages(app, monkeypatch):
+    from services import chat_service
+
+    session_id = _seed_history(app, 40)
+    app.config["CHAT_HISTORY_TOKEN_BUDGET"] = 100
+    prompts = []
+
+    def fake_generate_text(prompt):
+        prompts.append(prompt)
+        return "folded summary"
+
+    monkeypatch.setattr("services.chat_service.generate_text", fake_generate_text)
+
+    with app.app_context():
+        assert chat_service.update_session_summary(session_id) is True
+        session = db.session.get(ChatSession, session_id)
+        assert session.summary == "folded summary"
+        assert session.summary_message_id is not None
+        assert "message 000" in prompts[0]
+
+        window = chat_service.fetch_history_window(session)
+        assert all(message.id > session.summary_message_id for message in window)
+        assert chat_service.update_session_summary(session_id) is False
+
+
+def test_update_session_summary_folds_long_backlog_in_bounded_steps(app, monkeypatch, assert_max_queries):
+    from services import chat_service
+
+    session_id = _seed_history(app, 300)
+    app.config["CHAT_HISTORY_TOKEN_BUDGET"] = 100
+    monkeypatch.setattr("services.chat_service.generate_text", lambda prompt: "folded summary")
+
+    with app.app_context():
+        with assert_max_queries(5):
+            assert chat_service.update_session_summary(session_id) is True
+        first = db.session.get(ChatSession, session_id).summary_message_id
+        assert ChatMessage.query.filter(ChatMessage.session_id == session_id, ChatMessage.id <= first).count() == 200
+
+        assert chat_service.update_session_summary(session_id) is True
+        window = chat_service.fetch_history_window(db.session.get(ChatSession, session_id))
+        assert window[-1].text.startswith("message 299")
+        assert chat_service.update_session_summary(session_id) is False
+
+
+def test_update_session_summary_never_folds_the_latest_exchange(app, monkeypatch):
+    from services import chat_service
+
+    session_id = _seed_history(app, 10)
+    with app.app_context():
+        for role, text in (("user", "latest question " + "q" * 400), ("assistant", "latest answer " + "a" * 400)):
+            db.session.add(ChatMessage(session_id=session_id, role=role, text=text))
+        db.session.commit()
+        latest_question_id = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id.desc())[1].id
+    app.config["CHAT_HISTORY_TOKEN_BUDGET"] = 100
+    prompts = []
+    monkeypatch.setattr(
+        "services.chat_service.generate_text", lambda prompt: (prompts.append(prompt), "folded summary")[1]
+    )
+
+    with app.app_context():
+        # 最新のやり取りだけで予算半分を超えていても、畳み込むのはそれより古い側だけ
+        assert chat_service.update_session_summary(session_id) is True
+        session = db.session.get(ChatSession, session_id)
+        assert session.summary_message_id < latest_question_id
+        assert "message 009" in prompts[0]
+        assert "latest question" not in prompts[0]
+
+        # 残りが最新のやり取りだけなら、予算を超えていてもそれ以上畳み込まない
+        assert chat_service.update_session_summary(session_id) is False
+
+
+def test_session_detail_returns_newest_page_and_pages_older_messages(client, app):
+    login(client)
+    session_id = _seed_history(app, 75)
+
+    response = client.get(f"/api/chat/sessions/{session_id}")
+    assert response.status_code == 200
+    session_payload = json.loads(response.data)["session"]
+    assert len(session_payload["messages"]) == 30
+    assert session_payload["messages"][-1]["text"].startswith("message 074")
+    assert session_payload["has_more_messages"] is True
+
+    seen = [message["id"] for message in session_payload["messages"]]
+    before_id = session_payload["next_before_id"]
+    while before_id:
+        response = client.get(f"/api/chat/sessions/{session_id}/messages?before_id={before_id}&limit=20")
+        assert response.status_code == 200
+        page = json.loads(response.data)
+        assert len(page["messages"]) <= 20
+        seen = [message["id"] for message in page["messages"]] + seen
+        before_id = page["next_before_id"]
+
+    assert len(seen) == 75
+    assert seen == sorted(seen)
+
+
+def test_session_detail_query_count_does_not_grow_with_attachments(client, app, assert_max_queries):
+    from models import ChatAttachment
+
+    login(client)
+    session_id = _seed_history(app, 40)
+    with app.app_context():
+        for message in ChatMessage.query.filter_by(session_id=session_id, role="user").all():
+            db.session.add(
+                ChatAttachment(message_id=message.id, storage_backend="memory", object_name=f"chat/{message.id}.png")
+            )
+        db.session.commit()
+    client.get(f"/api/chat/sessions/{session_id}")
+
+    with assert_max_queries(3):
+        response = client.get(f"/api/chat/sessions/{session_id}")
+    assert response.status_code == 200
+    messages = json.loads(response.data)["session"]["messages"]
+    assert len(messages) == 30
+    assert any(message["attachments"] for message in messages)
+
+
+def test_chat_image_attachment_is_streamed_to_storage(client, app, monkeypatch):
+    import hashlib
+    from io import BytesIO
+    from pathlib import Path
+
+    from PIL import Image
+
+    from models import ChatAttachment
+
+    login(client)
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="新しいチャット")
+        db.session.add(session)
+        db.session.commit()
+        session_id = session.id
+
+    buffer = BytesIO()
+    Image.new("RGB", (9, 5), (10, 20, 30)).save(buffer, format="PNG")
+    raw_bytes = buffer.getvalue()
+    received: list[tuple[int, int]] = []
+
+    def fake_reply(prompt, images):
+        received.extend(image.size for image in images)
+        return "looks good"
+
+    monkeypatch.setattr("services.chat_service.generate_multimodal_text", fake_reply)
+
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={"message": "見て", "images": (BytesIO(raw_bytes), "photo.png")},
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert received == [(9, 5)]
+
+    with app.app_context():
+        attachment = ChatAttachment.query.one()
+        assert attachment.sha256 == hashlib.sha256(raw_bytes).hexdigest()
+        assert attachment.byte_size == len(raw_bytes)
+        assert (attachment.width, attachment.height) == (9, 5)
+        stored_path = Path(app.instance_path) / "chat_images" / attachment.object_name
+        assert stored_path.read_bytes() == raw_bytes
+
+
+def test_chat_attachments_are_stored_while_reply_is_generated(client, app, monkeypatch):
+    import time
+    from io import BytesIO
+
+    from PIL import Image
+
+    from models import ChatAttachment
+
+    login(client)
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="新しいチャット")
+        db.session.add(session)
+        db.session.commit()
+        session_id = session.id
+
+    buffer = BytesIO()
+    Image.new("RGB", (3, 3), (1, 2, 3)).save(buffer, format="PNG")
+    observed: list[int] = []
+
+    def fake_reply(prompt, images):
+        # 返信の生成中に、添付画像付きのユーザーメッセージが記録されるはず
+        deadline = time.monotonic() + 5
+        with app.app_context():
+            while time.monotonic() < deadline:
+                count = ChatAttachment.query.count()
+                if count:
+                    observed.append(count)
+                    break
+                db.session.remove()
+                time.sleep(0.01)
+        return "done"
+
+    monkeypatch.setattr("services.chat_service.generate_multimodal_text", fake_reply)
+
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={"message": "同時に", "images": (BytesIO(buffer.getvalue()), "photo.png")},
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert observed == [1]
+    with app.app_context():
+        roles = [message.role for message in ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id)]
+        assert roles == ["user", "assistant"]
+
+
+def test_save_stream_hashes_chunked_iterables(app):
+    import hashlib
+
+    from services import storage
+
+    chunks = [b"abc" * 1000, b"", b"def" * 1000]
+    with app.app_context():
+        stored = storage.save_stream(
+            stream=iter(chunks),
+            extension=".bin",
+            storage_backend="local",
+            bucket_name=None,
+            local_dir_key="CHAT_IMAGE_DIR",
+            default_local_dir="chat_images",
+            object_prefix="chat_images",
+            chunk_size=1024,
+        )
+        assert stored.byte_size == 6000
+        assert stored.sha256 == hashlib.sha256(b"".join(chunks)).hexdigest()
+        assert storage.load_bytes(
+            storage_backend="local",
+            bucket_name=None,
+            object_name=stored.object_name,
+            local_dir_key="CHAT_IMAGE_DIR",
+            default_local_dir="chat_images",
+        ) == b"".join(chunks)
+
+
+def test_chat_attachments_are_ingested_in_order_and_report_per_file_errors(client, app, monkeypatch):
+    from io import BytesIO
+    from pathlib import Path
+
+    from PIL import Image
+
+    from models import ChatAttachment
+
+    login(client)
+    with app.app_context():
+        session = ChatSession(user_id=User.query.first().id, title="新しいチャット")
+        db.session.add(session)
+        db.session.commit()
+        session_id = session.id
+
+    def png(width):
+        buffer = BytesIO()
+        Image.new("RGB", (width, 2), (0, 0, 0)).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    received: list[tuple[int, int]] = []
+
+    def fake_reply(prompt, images):
+        received.extend(image.size for image in images)
+        return "ok"
+
+    monkeypatch.setattr("services.chat_service.generate_multimodal_text", fake_reply)
+
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={"message": "並び順", "images": [(BytesIO(png(width)), f"{width}.png") for width in (5, 1, 4, 2, 3, 6)]},
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    assert received == [(5, 2), (1, 2), (4, 2), (2, 2), (3, 2), (6, 2)]
+    with app.app_context():
+        assert [attachment.width for attachment in ChatAttachment.query.order_by(ChatAttachment.id)] == [5, 1, 4, 2, 3, 6]
+
+    chat_dir = Path(app.instance_path) / "chat_images"
+    stored_before = {path for path in chat_dir.rglob("*") if path.is_file()}
+    response = client.post(
+        f"/api/chat/sessions/{session_id}/messages",
+        data={
+            "message": "壊れた画像",
+            "images": [(BytesIO(png(7)), "ok.png"), (BytesIO(b"not an image"), "broken.png")],
+        },
+        headers={"X-CSRFToken": get_csrf_token(client)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 400
+    payload = json.loads(response.data)
+    assert [(error["index"], error["filename"]) for error in payload["errors"]] == [(1, "broken.png")]
+    assert payload["error"].startswith("添付画像2")
+    # 失敗したメッセージで保存済みになった画像は残さない
+    assert {path for path in chat_dir.rglob("*") if path.is_file()} == stored_before
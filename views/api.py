@@ -1,20 +1,22 @@
 ﻿from __future__ import annotations
 
+import sys
 from datetime import datetime
 from io import BytesIO
 from typing import Any
 
-from google.genai.errors import APIError
 from flask import Blueprint, abort, current_app, jsonify, request, send_file, url_for
 from flask_login import current_user, login_required, login_user, logout_user
 from flask_wtf.csrf import generate_csrf
 from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 from extensions import db
 from illust import MissingApiKeyError
 from models import ChatAttachment, ChatMessage, ChatSession, Generation, GenerationAsset, Preset, User
-from services import chat_service, generation_service, modes, storage
+from services import chat_service, generation_service, modes, profiling, storage, upload_spool, user_cache
+from services.stage_timer import percentile
 
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
@@ -22,6 +24,13 @@ api_bp = Blueprint("api", __name__, url_prefix="/api")
 ASPECT_RATIO_OPTIONS = ["auto", "1:1", "4:5", "16:9"]
 RESOLUTION_OPTIONS = ["auto", "1K", "2K", "4K"]
 
+ADMIN_GENERATION_PAGE_SIZE = 50
+ADMIN_GENERATION_PAGE_MAX = 200
+CHAT_SESSION_PAGE_SIZE = 30
+CHAT_SESSION_PAGE_MAX = 100
+CHAT_MESSAGE_PAGE_SIZE = 30
+CHAT_MESSAGE_PAGE_MAX = 100
+
 
 def _json(payload: dict[str, Any], status: int = 200):
     return jsonify(payload), status
@@ -34,8 +43,15 @@ def _error(message: str, status: int = 400, *, error_code: str | None = None):
     return _json(payload, status)
 
 
+def _gemini_api_error() -> type[Exception] | None:
+    # SDK が未読み込みなら APIError が送出されることはないので、ここで import はしない
+    errors = sys.modules.get("google.genai.errors")
+    return getattr(errors, "APIError", None)
+
+
 def _is_gemini_overloaded_error(exc: Exception) -> bool:
-    if not isinstance(exc, APIError):
+    api_error = _gemini_api_error()
+    if api_error is None or not isinstance(exc, api_error):
         return False
 
     code = getattr(exc, "code", None)
@@ -58,7 +74,7 @@ def _handle_unexpected_runtime_error(exc: Exception):
     )
 
 
-def _serialize_user(user: User) -> dict[str, Any]:
+def _serialize_user(user: User | user_cache.UserSnapshot) -> dict[str, Any]:
     return {
         "id": user.id,
         "username": user.username,
@@ -107,6 +123,36 @@ def _serialize_generation(generation: Generation) -> dict[str, Any]:
     }
 
 
+def _serialize_admin_generation(generation: Generation) -> dict[str, Any]:
+    payload = _serialize_generation(generation)
+    payload.update(
+        {
+            "user_id": generation.user_id,
+            "model_image": generation.model_image,
+            "duration_ms": generation.duration_ms,
+            "stage_timings": generation.stage_timings or {},
+            "error_code": generation.error_code,
+        }
+    )
+    return payload
+
+
+def _stage_stats(generations: list[Generation]) -> dict[str, dict[str, Any]]:
+    samples: dict[str, list[int]] = {}
+    for generation in generations:
+        for stage_name, value in (generation.stage_timings or {}).items():
+            if isinstance(value, (int, float)):
+                samples.setdefault(stage_name, []).append(int(value))
+    return {
+        stage_name: {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+        }
+        for stage_name, values in samples.items()
+    }
+
+
 def _serialize_asset(asset: GenerationAsset) -> dict[str, Any]:
     return {
         "id": asset.id,
@@ -148,15 +194,38 @@ def _serialize_chat_message(message: ChatMessage) -> dict[str, Any]:
     }
 
 
-def _serialize_chat_session(session: ChatSession, *, include_messages: bool = False) -> dict[str, Any]:
+def _serialize_chat_session_row(row: Any) -> dict[str, Any]:
+    return {
+        "id": row.id,
+        "title": row.title,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else "",
+    }
+
+
+def _serialize_chat_message_page(messages: list[ChatMessage], has_more: bool) -> dict[str, Any]:
+    return {
+        "messages": [_serialize_chat_message(message) for message in messages],
+        "has_more": has_more,
+        "next_before_id": messages[0].id if has_more and messages else None,
+    }
+
+
+def _serialize_chat_session(
+    session: ChatSession,
+    *,
+    message_page: tuple[list[ChatMessage], bool] | None = None,
+) -> dict[str, Any]:
     payload = {
         "id": session.id,
         "title": session.title,
         "created_at": session.created_at.isoformat() if session.created_at else "",
         "updated_at": session.updated_at.isoformat() if session.updated_at else "",
     }
-    if include_messages:
-        payload["messages"] = [_serialize_chat_message(message) for message in session.messages]
+    if message_page is not None:
+        page = _serialize_chat_message_page(*message_page)
+        payload["messages"] = page["messages"]
+        payload["has_more_messages"] = page["has_more"]
+        payload["next_before_id"] = page["next_before_id"]
     return payload
 
 
@@ -194,6 +263,23 @@ def _parse_bool(value: Any) -> bool | None:
     return None
 
 
+def _parse_int_arg(name: str) -> int | None:
+    raw_value = request.args.get(name)
+    if raw_value is None or raw_value == "":
+        return None
+    try:
+        return int(raw_value)
+    except ValueError:
+        return None
+
+
+def _page_limit(default: int, maximum: int) -> int:
+    limit = _parse_int_arg("limit")
+    if limit is None or limit <= 0:
+        return default
+    return min(limit, maximum)
+
+
 def _ensure_chat_enabled():
     if not current_app.config.get("CHAT_ENABLED", True):
         abort(404)
@@ -274,6 +360,7 @@ def login():
     if not user.is_active:
         return _error("このアカウントは無効化されています。", 403)
 
+    user_cache.invalidate(user.id)
     login_user(user)
     user.last_login_at = datetime.utcnow()
     db.session.add(user)
@@ -299,14 +386,18 @@ def update_my_password():
     new_password = data.get("new_password") or ""
     if not current_password or not new_password:
         return _error("現在のパスワードと新しいパスワードを入力してください。", 400)
-    if not current_user.check_password(current_password):
+    user = db.session.get(User, current_user.id)
+    if user is None:
+        return _error("認証が必要です。", 401)
+    if not user.check_password(current_password):
         return _error("現在のパスワードが正しくありません。", 400)
     if current_password == new_password:
         return _error("新しいパスワードは現在のパスワードと異なる内容を指定してください。", 400)
 
-    current_user.set_password(new_password)
-    db.session.add(current_user)
+    user.set_password(new_password)
+    db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return _json({"ok": True})
 
 
@@ -349,6 +440,60 @@ def admin_users():
     return _json({"users": [_serialize_admin_user(user) for user in users]})
 
 
+@api_bp.get("/admin/generations")
+@login_required
+def admin_generations():
+    error = _require_admin()
+    if error:
+        return error
+
+    limit = _page_limit(ADMIN_GENERATION_PAGE_SIZE, ADMIN_GENERATION_PAGE_MAX)
+    query = Generation.query
+    mode_id = request.args.get("mode")
+    if mode_id:
+        query = query.filter(Generation.mode == mode_id)
+    generations = query.order_by(Generation.created_at.desc(), Generation.id.desc()).limit(limit).all()
+    return _json(
+        {
+            "generations": [_serialize_admin_generation(generation) for generation in generations],
+            "stage_stats": _stage_stats(generations),
+        }
+    )
+
+
+@api_bp.get("/admin/profiles")
+@login_required
+def admin_profiles():
+    error = _require_admin()
+    if error:
+        return error
+
+    limit = _page_limit(ADMIN_GENERATION_PAGE_SIZE, ADMIN_GENERATION_PAGE_MAX)
+    items = profiling.list_profiles(limit)
+    for item in items:
+        item["url"] = url_for("api.admin_profile", request_id=item["request_id"])
+    return _json({"profiles": items})
+
+
+@api_bp.get("/admin/profiles/<request_id>")
+@login_required
+def admin_profile(request_id: str):
+    error = _require_admin()
+    if error:
+        return error
+
+    path = profiling.profile_path(request_id)
+    if path is None:
+        abort(404)
+    # speedscope（https://www.speedscope.app）へそのまま読み込める JSON
+    return send_file(
+        path,
+        mimetype="application/json",
+        as_attachment=request.args.get("download") == "1",
+        download_name=path.name,
+    )
+
+
 @api_bp.post("/admin/users")
 @login_required
 def admin_create_user():
@@ -404,6 +549,7 @@ def admin_update_user_status(user_id: int):
     user.is_active = is_active
     db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return _json({"user": _serialize_admin_user(user)})
 
 
@@ -428,6 +574,7 @@ def admin_reset_password(user_id: int):
     user.set_password(password)
     db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return _json({"user": _serialize_admin_user(user)})
 
 
@@ -450,6 +597,7 @@ def admin_update_user_role(user_id: int):
     user.role = "admin"
     db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return _json({"user": _serialize_admin_user(user)})
 
 
@@ -590,15 +738,17 @@ def create_generation():
 @api_bp.get("/generations")
 @login_required
 def list_generations():
+    # アセットは selectinload で1クエリにまとめて読み込む（生成ごとに問い合わせない）
     generations = (
-        Generation.query.filter_by(user_id=current_user.id)
+        Generation.query.options(selectinload(Generation.assets))
+        .filter_by(user_id=current_user.id)
         .order_by(Generation.created_at.desc())
         .limit(20)
         .all()
     )
     payload = []
     for generation in generations:
-        assets = GenerationAsset.query.filter_by(generation_id=generation.id).all()
+        assets = sorted(generation.assets, key=lambda asset: asset.id)
         payload.append(
             {
                 "generation": _serialize_generation(generation),
@@ -633,21 +783,28 @@ def asset(asset_id: int):
     )
     if not asset_row:
         abort(404)
-    if not asset_row.object_name:
+    if not asset_row.object_name or asset_row.storage_state == "failed":
         abort(404)
-    raw_bytes = storage.load_bytes(
-        storage_backend=asset_row.storage_backend,
-        bucket_name=asset_row.bucket,
-        object_name=asset_row.object_name,
-        local_dir_key="GENERATION_IMAGE_DIR",
-        default_local_dir="generated_images",
-    )
-    if raw_bytes is None:
+    body = None
+    if asset_row.storage_state == "pending":
+        # 後追いアップロードが終わるまではスプールから配信する
+        spooled = upload_spool.read(asset_row.object_name)
+        body = BytesIO(spooled) if spooled is not None else None
+    if body is None:
+        body = storage.open_object(
+            storage_backend=asset_row.storage_backend,
+            bucket_name=asset_row.bucket,
+            object_name=asset_row.object_name,
+            local_dir_key="GENERATION_IMAGE_DIR",
+            default_local_dir="generated_images",
+            expected_sha256=asset_row.sha256,
+        )
+    if body is None:
         abort(404)
     download = request.args.get("download") == "1"
     filename = f"generated_image{generation_service.extension_for_mime_type(asset_row.mime_type)}"
     return send_file(
-        BytesIO(raw_bytes),
+        body,
         mimetype=asset_row.mime_type,
         as_attachment=download,
         download_name=filename,
@@ -665,15 +822,19 @@ def chat_modes():
 @login_required
 def chat_sessions():
     _ensure_chat_enabled()
-    sessions = (
-        ChatSession.query.filter_by(user_id=current_user.id)
-        .order_by(ChatSession.updated_at.desc())
-        .all()
+    limit = _page_limit(CHAT_SESSION_PAGE_SIZE, CHAT_SESSION_PAGE_MAX)
+    rows, has_more = chat_service.list_session_rows(
+        current_user.id,
+        before_id=_parse_int_arg("before_id"),
+        limit=limit,
+    )
+    return _json(
+        {
+            "sessions": [_serialize_chat_session_row(row) for row in rows],
+            "has_more": has_more,
+            "next_before_id": rows[-1].id if has_more and rows else None,
+        }
     )
-    if not sessions:
-        session = chat_service.create_session(current_user.id, title="新しいチャット")
-        sessions = [session]
-    return _json({"sessions": [_serialize_chat_session(session) for session in sessions]})
 
 
 @api_bp.post("/chat/sessions")
@@ -691,7 +852,23 @@ def create_chat_session():
 def chat_session_detail(session_id: int):
     _ensure_chat_enabled()
     session = _session_or_404(session_id)
-    return _json({"session": _serialize_chat_session(session, include_messages=True)})
+    limit = _page_limit(CHAT_MESSAGE_PAGE_SIZE, CHAT_MESSAGE_PAGE_MAX)
+    message_page = chat_service.fetch_message_page(session, limit=limit)
+    return _json({"session": _serialize_chat_session(session, message_page=message_page)})
+
+
+@api_bp.get("/chat/sessions/<int:session_id>/messages")
+@login_required
+def chat_session_messages(session_id: int):
+    _ensure_chat_enabled()
+    session = _session_or_404(session_id)
+    limit = _page_limit(CHAT_MESSAGE_PAGE_SIZE, CHAT_MESSAGE_PAGE_MAX)
+    messages, has_more = chat_service.fetch_message_page(
+        session,
+        before_id=_parse_int_arg("before_id"),
+        limit=limit,
+    )
+    return _json(_serialize_chat_message_page(messages, has_more))
 
 
 @api_bp.post("/chat/sessions/<int:session_id>/messages")
@@ -708,35 +885,33 @@ def chat_messages(session_id: int):
         return _error("メッセージまたは画像を入力してください。", 400)
 
     try:
-        attachments = []
-        images = []
-        for index, file in enumerate(files):
-            stored = chat_service.save_uploaded_image(file, label=f"添付画像{index + 1}")
-            attachments.append(stored)
-            raw_bytes, filename, mime_type = generation_service.read_uploaded_bytes(
-                file,
-                label="添付画像",
-                reset_stream=True,
+        uploads = chat_service.decode_uploaded_images(files)
+        # 返信の生成を先に開始し、その間に添付画像の保存とユーザーメッセージの記録を行う
+        pending_reply = chat_service.start_multimodal_reply(
+            session,
+            user_message,
+            [upload.image for upload in uploads],
+        )
+        try:
+            attachments = chat_service.store_decoded_images(uploads)
+
+            chat_service.add_message(
+                session=session,
+                role="user",
+                text=user_message,
+                mode_id="text_chat",
+                attachments=attachments,
             )
-            image = generation_service.decode_image_bytes(
-                raw_bytes,
-                label="添付画像",
-                filename=filename,
-                mime_type=mime_type,
-                convert_to_rgb=True,
+            chat_service.update_session_title(session, user_message)
+        except Exception:
+            # 記録に失敗したターンの返信は誰も読まないので、呼び出しを取り消す（実行中なら待って捨てる）
+            db.session.rollback()
+            generation_service.discard_model_call(
+                pending_reply, f"chat turn could not be recorded (session={session_id})"
             )
-            images.append(image)
-
-        chat_service.add_message(
-            session=session,
-            role="user",
-            text=user_message,
-            mode_id="text_chat",
-            attachments=attachments,
-        )
-        chat_service.update_session_title(session, user_message)
+            raise
 
-        reply = chat_service.generate_multimodal_reply(session, user_message, images)
+        reply = pending_reply.result()
         assistant_message = chat_service.add_message(
             session=session,
             role="assistant",
@@ -745,8 +920,20 @@ def chat_messages(session_id: int):
         )
 
         chat_service.touch_session(session)
+        chat_service.schedule_summary_update(session)
     except MissingApiKeyError:
         return _error("APIキーが設定されていません。", 400)
+    except chat_service.AttachmentIngestError as exc:
+        return _json(
+            {
+                "error": str(exc),
+                "errors": [
+                    {"index": error.index, "filename": error.filename, "error": error.message}
+                    for error in exc.errors
+                ],
+            },
+            400,
+        )
     except generation_service.GenerationError as exc:
         return _error(str(exc), 400)
     except Exception as exc:  # noqa: BLE001
@@ -771,7 +958,7 @@ def chat_asset(attachment_id: int):
     if not attachment.object_name:
         abort(404)
 
-    raw_bytes = chat_service.load_chat_image_bytes(attachment)
-    if raw_bytes is None:
+    body = chat_service.open_chat_image(attachment)
+    if body is None:
         abort(404)
-    return send_file(BytesIO(raw_bytes), mimetype=attachment.mime_type)
+    return send_file(body, mimetype=attachment.mime_type)
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from services import metrics
+
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+def _authorized() -> bool:
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        # トークンなしで公開するのは開発・テスト時だけ（本番でルート名やリクエスト数を匿名に見せない）
+        return bool(current_app.config.get("DEBUG") or current_app.config.get("TESTING"))
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(header[len("Bearer ") :], token)
+
+
+@metrics_bp.get("/metrics")
+def prometheus_metrics():
+    if not current_app.config.get("METRICS_ENABLED"):
+        abort(404)
+    if not _authorized():
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    payload, content_type = metrics.render_latest()
+    return Response(payload, content_type=content_type)